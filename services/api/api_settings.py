@@ -28,16 +28,102 @@ class Settings(BaseSettings):
         description="API authentication key (minimum 32 characters)",
     )
     cache_ttl: int = Field(
-        default=60, ge=0, le=3600, description="Cache TTL in seconds"
+        default=60, ge=0, le=86400, description="Cache TTL in seconds"
+    )
+    cache_stale_ttl: int = Field(
+        default=60,
+        ge=0,
+        le=3600,
+        description="Seconds past cache_ttl a score may be served stale while "
+        "it is refreshed in the background",
     )
     api_rate_limit: int = Field(
         default=100, ge=1, le=10000, description="Requests per minute per IP"
     )
+    rate_limit_mode: str = Field(
+        default="redis",
+        pattern="^(redis|local)$",
+        description="redis = exact sliding-window log per request; local = "
+        "in-process token buckets reconciled with Redis in batches",
+    )
+    rate_limit_sync_ms: int = Field(
+        default=1000,
+        ge=100,
+        le=60000,
+        description="local mode: milliseconds between Redis reconciliations",
+    )
     cors_origins: str = Field(
         default="http://localhost:3000",
         description="Comma-separated CORS origins",
     )
 
+    # Request logging (api_requests in ClickHouse)
+    request_log_buffer_size: int = Field(
+        default=10000,
+        ge=100,
+        le=1000000,
+        description="Max buffered request-log rows; further rows are dropped",
+    )
+    request_log_batch_size: int = Field(
+        default=1000, ge=1, le=100000, description="Rows per api_requests INSERT"
+    )
+    request_log_flush_ms: int = Field(
+        default=1000,
+        ge=50,
+        le=60000,
+        description="Max milliseconds between request-log flushes",
+    )
+
+    # In-process asn_registry score snapshot (0 = disabled: always query Postgres)
+    score_snapshot_refresh_ms: int = Field(
+        default=5000,
+        ge=0,
+        le=3600000,
+        description="Milliseconds between incremental score snapshot refreshes",
+    )
+
+    # Local IP -> ASN longest-prefix-match index (built from bgp_events)
+    ip_index_refresh_s: int = Field(
+        default=900,
+        ge=0,
+        le=86400,
+        description="Seconds between IP-to-ASN index rebuilds (0 = Team Cymru only)",
+    )
+    ip_index_window_hours: int = Field(
+        default=24,
+        ge=1,
+        le=720,
+        description="bgp_events look-back defining the routing view indexed",
+    )
+
+    # DNS answers (domain A records, Team Cymru TXT), reused for their TTL
+    dns_cache_size: int = Field(
+        default=50000,
+        ge=0,
+        le=10000000,
+        description="Max cached DNS answers per worker (0 = no caching)",
+    )
+    domain_risk_concurrency: int = Field(
+        default=50,
+        ge=1,
+        le=1000,
+        description="Concurrent DNS lookups per batch domain-risk request",
+    )
+
+    # Streaming bulk risk check (/v1/tools/bulk-risk-check/stream)
+    bulk_stream_chunk_size: int = Field(
+        default=1000,
+        ge=1,
+        le=50000,
+        description="ASNs per Postgres lookup of a streaming bulk check",
+    )
+    bulk_stream_max_asns: int = Field(
+        default=1000000,
+        ge=1,
+        le=100000000,
+        description="Max ASNs per streaming bulk check request",
+    )
+
     # Logging
     log_level: str = Field(default="INFO", description="Log level")
     log_format: str = Field(default="json", description="Log format: json or text")
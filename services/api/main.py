@@ -1,16 +1,23 @@
 # Copyright by Fabrizio Salmi (fabrizio.salmi@gmail.com)
 
 import time
+import math
+import bisect
 import orjson
 import httpx
 import dns.asyncresolver
+import dns.resolver
 import ipaddress
+import sys
 import hashlib
 import hmac
+import socket
 from cachetools import TTLCache
 import logging
 import urllib.parse
-from datetime import datetime
+from array import array
+from collections import Counter, deque
+from datetime import datetime, timedelta
 from contextlib import asynccontextmanager
 
 from fastapi import (
@@ -27,13 +34,13 @@ from fastapi import (
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
 from prometheus_fastapi_instrumentator import Instrumentator
-from fastapi.responses import ORJSONResponse, PlainTextResponse
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel, Field
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine
 from clickhouse_driver import Client
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Union
 import redis.asyncio as aioredis
 import asyncio
 import os
@@ -49,8 +56,9 @@ settings = Settings()
 
 # --- Local L1 Memory Cache ---
 # Used for super-fast reads before asking Redis (L2)
-# Max 5,000 items, TTL is set dynamically during insertion based on settings.cache_ttl
-l1_cache = TTLCache(maxsize=5000, ttl=settings.cache_ttl)
+# Max 5,000 items. Entries live until their hard expiry (cache_ttl +
+# cache_stale_ttl); freshness within that is tracked per entry (_is_fresh).
+l1_cache = TTLCache(maxsize=5000, ttl=settings.cache_ttl + settings.cache_stale_ttl)
 
 # --- Background task registry (keeps create_task references alive) ---
 _bg_tasks: set = set()
@@ -154,19 +162,144 @@ else
 end
 """
 
+# --- Rate Limiting Lua Script (Sliding Window Counter, batched) ---
+# Used by the "local" rate-limit mode to reconcile in-process buckets across
+# workers: KEYS are per-IP key prefixes, ARGV[1] the window, ARGV[2..] the
+# requests each IP made on this worker since the last sync. Each IP costs two
+# fixed-window counters (current + previous), regardless of request volume.
+# Returns the weighted cluster-wide count of the last window per IP.
+RATE_LIMIT_SYNC_SCRIPT = """
+local window = tonumber(ARGV[1])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local current = math.floor(now / window)
+local weight = 1 - (now - current * window) / window
+local counts = {}
+for i, prefix in ipairs(KEYS) do
+    local key = prefix .. ':' .. current
+    local hits = redis.call('INCRBY', key, ARGV[i + 1])
+    redis.call('EXPIRE', key, window * 2)
+    local previous = tonumber(redis.call('GET', prefix .. ':' .. (current - 1)) or '0')
+    counts[i] = math.floor(hits + previous * weight)
+end
+return counts
+"""
+
 # --- Constants ---
 ASN_MIN = 1
 ASN_MAX = 4294967295
 API_VERSION = "7.5.1"
-STATS_TOTAL_COUNT_CACHE_TTL = 300  # 5 minutes
+# Engine-maintained hash: field = integer score 0-100, value = number of
+# scored ASNs at that score (see RiskScorer._update_score_histogram).
+SCORE_HISTOGRAM_KEY = "stats:score_histogram"
 PEERINGDB_CACHE_TTL = 86400  # 24 hours
+# Pub/sub channel naming ASNs whose cached score changed, as a JSON list. The
+# engine publishes after every score write; each API worker evicts its own L1.
+CACHE_INVALIDATION_CHANNEL = "cache:invalidate"
+# score:gen:{asn} holds a random token replaced on every invalidation (here and
+# in the engine); a cache fill only writes if the token is unchanged since it
+# started reading, so a fill racing a score write cannot re-cache the old card.
+SCORE_GEN_TTL = 86400
+# Engine-materialized EDL feeds (see RiskScorer._update_edl): per threshold
+# edl:v1:{t}:asns, :version and :log, the versioned add/remove log.
+EDL_KEY_PREFIX = "edl:v1"
+# Score-change events for /v1/stream, one JSON object per message.
+STREAM_CHANNEL = "events:asn_updates"
+STREAM_MAX_WATCHED_ASNS = 1000
+
+
+# --- Cross-worker L1 invalidation ---
+def _evict_l1(asns) -> int:
+    """Drop the L1 score entries of `asns` (and stop answering them from the
+    score snapshot until it re-reads them); returns how many were cached."""
+    score_snapshot.mark_stale(asns)
+    return sum(l1_cache.pop(f"score:v4:{asn}", None) is not None for asn in asns)
+
+
+async def _invalidate_score_cache(*asns: int) -> int:
+    """Evict `asns` from L2 and from every worker's L1 (this one directly, the
+    others via CACHE_INVALIDATION_CHANNEL). Returns the number of L2 keys
+    deleted."""
+    _evict_l1(asns)
+    for asn in asns:
+        await redis_client.set(
+            f"score:gen:{asn}", os.urandom(8).hex(), ex=SCORE_GEN_TTL
+        )
+    deleted = await redis_client.delete(*(f"score:v4:{asn}" for asn in asns))
+    await redis_client.publish(CACHE_INVALIDATION_CHANNEL, orjson.dumps(list(asns)))
+    return deleted
+
+
+async def _l1_invalidation_listener() -> None:
+    """Evict L1 entries named on CACHE_INVALIDATION_CHANNEL for the lifetime of
+    the worker, resubscribing with backoff if Redis drops. Invalidations sent
+    while disconnected are lost, so L1 is cleared on every (re)subscribe."""
+    backoff = 1.0
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+            l1_cache.clear()
+            backoff = 1.0
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                try:
+                    _evict_l1(orjson.loads(message["data"]))
+                except (orjson.JSONDecodeError, TypeError):
+                    logger.warning(
+                        "cache_invalidation_bad_message",
+                        extra={"data": str(message["data"])[:80]},
+                    )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(
+                "cache_invalidation_listener_error",
+                extra={"error": str(e), "retry_in": backoff},
+            )
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 30.0)
 
 
 # --- Lifespan ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("startup", extra={"version": API_VERSION})
+    background = [
+        asyncio.create_task(_l1_invalidation_listener()),
+        asyncio.create_task(request_log.run()),
+    ]
+    if settings.ip_index_refresh_s > 0:
+        background.append(
+            asyncio.create_task(ip_index.run(settings.ip_index_refresh_s))
+        )
+    if settings.score_snapshot_refresh_ms > 0:
+        background.append(
+            asyncio.create_task(
+                score_snapshot.run(settings.score_snapshot_refresh_ms / 1000)
+            )
+        )
+    if local_rate_limiter is not None:
+        background.append(
+            asyncio.create_task(
+                local_rate_limiter.run(settings.rate_limit_sync_ms / 1000)
+            )
+        )
     yield
+    for task in background:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    # Write what is still buffered before the worker exits
+    await request_log.flush()
     await redis_client.aclose()
     logger.info("shutdown")
 
@@ -337,12 +470,22 @@ class HistoryPoint(BaseModel):
     score: int
 
 
+class HistoryBucket(HistoryPoint):
+    # score is the rounded bucket average
+    min: int
+    max: int
+    avg: float
+    samples: int
+
+
 class PaginatedHistory(BaseModel):
     asn: int
     total: int
     offset: int
     limit: int
-    data: List[HistoryPoint]
+    resolution: Optional[str] = None
+    next_cursor: Optional[str] = None
+    data: List[Union[HistoryBucket, HistoryPoint]]
 
 
 class UpstreamPeer(BaseModel):
@@ -369,6 +512,14 @@ class BulkAnalysisRequest(BaseModel):
     asns: List[int] = Field(..., max_length=1000)
 
 
+class IpRiskRequest(BaseModel):
+    ips: List[str] = Field(..., min_length=1, max_length=10000)
+
+
+class DomainRiskRequest(BaseModel):
+    domains: List[str] = Field(..., min_length=1, max_length=1000)
+
+
 # --- Helpers ---
 
 
@@ -384,6 +535,22 @@ def _stable_etag(value: str) -> str:
     return f'W/"{hashlib.sha256(value.encode()).hexdigest()[:16]}"'
 
 
+def _percentile_from_histogram(
+    histogram: Optional[dict], score: int
+) -> Optional[float]:
+    """Share of scored ASNs with a strictly lower total score, read off the
+    101-bucket score histogram. None when the histogram is missing or empty."""
+    if not histogram:
+        return None
+    counts = [0] * 101
+    for bucket, n in histogram.items():
+        counts[int(bucket)] = int(n)
+    total = sum(counts)
+    if total <= 0:
+        return None
+    return sum(counts[: max(0, min(score, 101))]) / total * 100.0
+
+
 def _client_ip(request: Request) -> str:
     """Resolve the real client IP behind the reverse proxy.
 
@@ -401,6 +568,615 @@ def _client_ip(request: Request) -> str:
     return request.client.host if request.client else "0.0.0.0"
 
 
+# --- Buffered request logging ---
+# api_requests rows go into a bounded in-process buffer that one background
+# flusher writes as multi-row INSERTs (every request_log_batch_size rows or
+# request_log_flush_ms), instead of one INSERT — and one tiny ClickHouse part —
+# per request. If ClickHouse falls behind, new rows are dropped and counted
+# rather than queued without bound or competing with user queries for _ch_pool.
+class RequestLogBuffer:
+    INSERT = """INSERT INTO api_requests
+        (timestamp, endpoint, method, status_code, response_time_ms, cache_hit, client_ip, error_message)
+        VALUES"""
+
+    def __init__(self, max_rows: int, batch_size: int, flush_interval: float) -> None:
+        self.rows: deque = deque()
+        self.max_rows = max_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._wakeup = asyncio.Event()
+
+    def append(self, row: tuple) -> None:
+        if len(self.rows) >= self.max_rows:
+            self.dropped += 1
+            return
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> int:
+        """Write everything buffered, batch by batch. A failed batch is dropped
+        (and counted) instead of retried so a ClickHouse outage can't pile up
+        behind it. Returns the number of rows written."""
+        written = 0
+        while self.rows:
+            batch = [
+                self.rows.popleft() for _ in range(min(self.batch_size, len(self.rows)))
+            ]
+            try:
+                await _ch_execute(self.INSERT, batch)
+                written += len(batch)
+            except Exception as exc:
+                self.dropped += len(batch)
+                logger.warning(
+                    "ch_request_log_failed",
+                    extra={"error": str(exc), "rows": len(batch)},
+                )
+                break
+        if self.dropped > self._reported_dropped:
+            logger.warning(
+                "ch_request_log_dropped",
+                extra={
+                    "dropped": self.dropped - self._reported_dropped,
+                    "dropped_total": self.dropped,
+                },
+            )
+            self._reported_dropped = self.dropped
+        return written
+
+    async def run(self) -> None:
+        """Flush loop for the worker's lifetime (started/stopped in lifespan)."""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+
+request_log = RequestLogBuffer(
+    settings.request_log_buffer_size,
+    settings.request_log_batch_size,
+    settings.request_log_flush_ms / 1000,
+)
+
+
+# --- Local rate limiting ---
+class LocalRateLimiter:
+    """Per-IP token buckets enforced in process (rate_limit_mode=local), so the
+    request path makes no Redis call. Every `sync()` pushes the requests each IP
+    made here since the last sync to Redis in one RATE_LIMIT_SYNC_SCRIPT call
+    and caps each bucket at what the cluster-wide count leaves of the limit.
+    Enforcement across workers is therefore approximate, lagging by at most one
+    sync interval."""
+
+    def __init__(self, limit: int, window: int, max_clients: int = 100000) -> None:
+        self.limit = limit
+        self.window = window
+        self.rate = limit / window  # tokens refilled per second
+        # ip -> [tokens, monotonic ts]; an idle bucket refills completely within
+        # `window`, so expiring it then is the same as keeping it full.
+        self.buckets = TTLCache(maxsize=max_clients, ttl=window)
+        self.pending: Counter = Counter()
+
+    def _tokens(self, ip: str, now: float) -> float:
+        bucket = self.buckets.get(ip)
+        if bucket is None:
+            return float(self.limit)
+        return min(float(self.limit), bucket[0] + (now - bucket[1]) * self.rate)
+
+    def acquire(self, ip: str) -> tuple:
+        """Take one token: (allowed, remaining, retry_after_seconds)."""
+        now = time.monotonic()
+        tokens = self._tokens(ip, now)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+            self.pending[ip] += 1
+        self.buckets[ip] = [tokens, now]
+        retry_after = 0 if allowed else math.ceil((1 - tokens) / self.rate)
+        return allowed, int(tokens), retry_after
+
+    async def sync(self) -> None:
+        pending, self.pending = self.pending, Counter()
+        if not pending:
+            return
+        ips = list(pending)
+        counts = await redis_client.eval(
+            RATE_LIMIT_SYNC_SCRIPT,
+            len(ips),
+            *(f"rlw:{ip}" for ip in ips),
+            self.window,
+            *(pending[ip] for ip in ips),
+        )
+        now = time.monotonic()
+        for ip, used in zip(ips, counts):
+            cap = max(0, self.limit - int(used))
+            self.buckets[ip] = [min(self._tokens(ip, now), cap), now]
+
+    async def run(self, interval: float) -> None:
+        """Reconcile loop for the worker's lifetime (started in lifespan). A
+        Redis outage leaves per-worker limits in force (fail open globally)."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.warning("rate_limit_sync_failed", extra={"error": str(e)})
+
+
+RATE_LIMIT_WINDOW = 60
+local_rate_limiter = (
+    LocalRateLimiter(settings.api_rate_limit, RATE_LIMIT_WINDOW)
+    if settings.rate_limit_mode == "local"
+    else None
+)
+
+
+def _rate_limited_response(trace_id: str, retry_after: int) -> ORJSONResponse:
+    return ORJSONResponse(
+        status_code=429,
+        content=ErrorEnvelope(
+            error=f"Rate limit exceeded. Try again in {retry_after} seconds.",
+            code="RATE_LIMITED",
+            request_id=trace_id,
+        ).model_dump(),
+        headers={
+            "X-RateLimit-Limit": str(settings.api_rate_limit),
+            "X-RateLimit-Remaining": "0",
+            "X-RateLimit-Reset": str(int(time.time()) + retry_after),
+            "X-Trace-ID": trace_id,
+            "Retry-After": str(retry_after),
+        },
+    )
+
+
+# --- In-process score snapshot ---
+# Incremental refreshes re-read rows scored up to this long before the
+# watermark, so a batch committed after a refresh but timestamped before it
+# is still picked up; a full reload also catches non-scoring registry edits.
+SNAPSHOT_WATERMARK_OVERLAP = timedelta(seconds=30)
+SNAPSHOT_FULL_RELOAD_INTERVAL = 3600
+SNAPSHOT_COLUMNS = """
+    SELECT asn, name, country_code, total_score, risk_level,
+           hygiene_score, threat_score, stability_score, last_scored_at
+    FROM asn_registry
+"""
+
+
+class ScoreSnapshot:
+    """This worker's copy of asn_registry's score columns: sorted uint32 ASN
+    keys with parallel arrays (score columns as int8, -1 = NULL; risk level as
+    an index into `levels`). Lookups are a binary search with no network hop.
+
+    Refreshed incrementally by last_scored_at watermark. ASNs named in a cache
+    invalidation are treated as misses (callers go to Postgres) until the
+    next refresh that started after the invalidation."""
+
+    SCORE_COLUMNS = ("total_score", "hygiene_score", "threat_score", "stability_score")
+
+    def __init__(self) -> None:
+        self.ready = False
+        self.asns = array("I")
+        self.scores = tuple(array("b") for _ in self.SCORE_COLUMNS)
+        self.level = array("B")
+        self.levels: list = []
+        self.names: list = []
+        self.countries: list = []
+        self.watermark: Optional[datetime] = None
+        self.loaded_at = 0.0
+        self._stale: Dict[int, float] = {}
+
+    def __len__(self) -> int:
+        return len(self.asns)
+
+    def mark_stale(self, asns) -> None:
+        stamp = time.monotonic()
+        for asn in asns:
+            self._stale[int(asn)] = stamp
+
+    def _level_code(self, level) -> int:
+        try:
+            return self.levels.index(level)
+        except ValueError:
+            self.levels.append(level)
+            return len(self.levels) - 1
+
+    def _index(self, asn: int) -> int:
+        i = bisect.bisect_left(self.asns, asn)
+        return i if i < len(self.asns) and self.asns[i] == asn else -1
+
+    def _set(self, i: int, row) -> None:
+        for col, value in zip(self.scores, (row[3], row[5], row[6], row[7])):
+            col[i] = -1 if value is None else value
+        self.level[i] = self._level_code(row[4])
+        self.names[i] = row[1]
+        self.countries[i] = row[2]
+
+    def _insert(self, i: int, row) -> None:
+        self.asns.insert(i, row[0])
+        for col in self.scores:
+            col.insert(i, -1)
+        self.level.insert(i, 0)
+        self.names.insert(i, None)
+        self.countries.insert(i, None)
+        self._set(i, row)
+
+    def get(self, asn: int) -> Optional[dict]:
+        """asn_registry card (asn, name, country_code, the four scores and
+        risk_level) or None if unknown here, stale or not loaded yet."""
+        if not self.ready or asn in self._stale:
+            return None
+        i = self._index(asn)
+        if i < 0:
+            return None
+        total, hygiene, threat, stability = (
+            None if col[i] < 0 else col[i] for col in self.scores
+        )
+        return {
+            "asn": asn,
+            "name": self.names[i],
+            "country_code": self.countries[i],
+            "total_score": total,
+            "risk_level": self.levels[self.level[i]],
+            "hygiene_score": hygiene,
+            "threat_score": threat,
+            "stability_score": stability,
+        }
+
+    def at_most(self, max_score: float) -> Optional[list]:
+        """Sorted ASNs with total_score <= max_score, or None when the snapshot
+        cannot answer for the whole registry (not loaded, or stale entries)."""
+        if not self.ready or self._stale:
+            return None
+        return [
+            asn
+            for asn, score in zip(self.asns, self.scores[0])
+            if 0 <= score <= max_score
+        ]
+
+    def _forget_stale(self, started: float) -> None:
+        # Invalidations are published after the write commits, so a read that
+        # started later has seen every change they announced.
+        self._stale = {a: t for a, t in self._stale.items() if t > started}
+
+    def _advance(self, rows) -> None:
+        stamps = [r[8] for r in rows if r[8] is not None]
+        if stamps and (self.watermark is None or max(stamps) > self.watermark):
+            self.watermark = max(stamps)
+
+    async def load(self) -> None:
+        """Full reload, swapped in without an await in between."""
+        started = time.monotonic()
+        async with pg_engine.begin() as conn:
+            result = await conn.execute(text(SNAPSHOT_COLUMNS + " ORDER BY asn"))
+            rows = result.fetchall()
+        fresh = ScoreSnapshot()
+        fresh.asns = array("I", (r[0] for r in rows))
+        fresh.scores = tuple(array("b", [0]) * len(rows) for _ in self.SCORE_COLUMNS)
+        fresh.level = array("B", [0]) * len(rows)
+        fresh.names = [None] * len(rows)
+        fresh.countries = [None] * len(rows)
+        for i, row in enumerate(rows):
+            fresh._set(i, row)
+        self.asns, self.scores, self.level = fresh.asns, fresh.scores, fresh.level
+        self.levels, self.names, self.countries = (
+            fresh.levels,
+            fresh.names,
+            fresh.countries,
+        )
+        self.watermark = None
+        self._advance(rows)
+        self._forget_stale(started)
+        self.loaded_at = started
+        self.ready = True
+
+    async def refresh(self) -> int:
+        """Apply rows scored since the watermark; returns how many were read."""
+        started = time.monotonic()
+        since = (self.watermark or datetime(1970, 1, 1)) - SNAPSHOT_WATERMARK_OVERLAP
+        async with pg_engine.begin() as conn:
+            result = await conn.execute(
+                text(SNAPSHOT_COLUMNS + " WHERE last_scored_at > :since ORDER BY asn"),
+                {"since": since},
+            )
+            rows = result.fetchall()
+        for row in rows:
+            i = self._index(row[0])
+            if i < 0:
+                self._insert(bisect.bisect_left(self.asns, row[0]), row)
+            else:
+                self._set(i, row)
+        self._advance(rows)
+        self._forget_stale(started)
+        return len(rows)
+
+    async def run(self, interval: float) -> None:
+        """Keep the snapshot current for the lifetime of the worker."""
+        while True:
+            try:
+                if (
+                    not self.ready
+                    or time.monotonic() - self.loaded_at
+                    >= SNAPSHOT_FULL_RELOAD_INTERVAL
+                ):
+                    await self.load()
+                    logger.info("score_snapshot_loaded", extra={"asns": len(self)})
+                else:
+                    await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("score_snapshot_refresh_failed", extra={"error": str(e)})
+            await asyncio.sleep(interval)
+
+
+score_snapshot = ScoreSnapshot()
+
+
+# --- DNS answer cache ---
+# Answers are reused until their record TTL runs out, capped here; NXDOMAIN and
+# empty answers are remembered for DNS_NEGATIVE_TTL. Timeouts are not cached.
+DNS_CACHE_MAX_TTL = 3600
+DNS_NEGATIVE_TTL = 60
+dns_cache = TTLCache(maxsize=max(settings.dns_cache_size, 1), ttl=DNS_CACHE_MAX_TTL)
+
+
+async def _resolve(name: str, rdtype: str) -> List[str]:
+    """Text of the `rdtype` records of `name`, from dns_cache while their TTL
+    lasts. Raises dns.exception.DNSException like the resolver; a cached
+    negative answer raises the same type (NXDOMAIN or NoAnswer) again."""
+    key = (name.lower().rstrip("."), rdtype)
+    now = time.monotonic()
+    hit = dns_cache.get(key)
+    if hit is not None and hit[0] > now:
+        expires, records, error = hit
+        if error is not None:
+            raise error()
+        return records
+    try:
+        answers = await dns.asyncresolver.resolve(name, rdtype)
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+        if settings.dns_cache_size:
+            dns_cache[key] = (now + DNS_NEGATIVE_TTL, None, type(e))
+        raise
+    records = [rdata.to_text() for rdata in answers]
+    if settings.dns_cache_size:
+        dns_cache[key] = (now + answers.rrset.ttl, records, None)
+    return records
+
+
+# --- Local IP -> origin ASN index ---
+# Latest origin of every prefix announced within the look-back window.
+IP_INDEX_QUERY = """
+    SELECT prefix, argMax(asn, timestamp)
+    FROM bgp_events
+    WHERE timestamp > now() - INTERVAL %(hours)s HOUR
+    GROUP BY prefix
+"""
+# Shorter announcements (default routes, leaked supernets) are not indexed.
+IP_INDEX_MIN_LENGTH = {4: 8, 6: 16}
+
+
+def _parse_prefix(prefix: str) -> tuple:
+    """(IP version, prefix length, network address as int) of a CIDR string,
+    host bits masked off. inet_pton-based: ipaddress.ip_network is several
+    times slower over a full routing table. Raises ValueError or OSError."""
+    addr, _, plen = prefix.partition("/")
+    if ":" in addr:
+        version, bits = 6, 128
+        packed = socket.inet_pton(socket.AF_INET6, addr)
+    else:
+        version, bits = 4, 32
+        packed = socket.inet_pton(socket.AF_INET, addr)
+    length = int(plen) if plen else bits
+    if not 0 <= length <= bits:
+        raise ValueError(f"bad prefix length: {prefix}")
+    host = bits - length
+    return version, length, int.from_bytes(packed, "big") >> host << host
+
+
+class PrefixIndex:
+    """Longest-prefix match from IP to origin ASN over the routing view in
+    bgp_events. One sorted table of network addresses (with a parallel uint32
+    ASN array) per prefix length, longest first: a lookup is one bisect per
+    announced length until a table holds the masked address."""
+
+    def __init__(self) -> None:
+        self.tables: Dict[int, list] = {4: [], 6: []}
+        self.size = 0
+
+    @staticmethod
+    def _build(routes) -> tuple:
+        groups: Dict[tuple, dict] = {}
+        for prefix, asn in routes:
+            try:
+                version, length, network = _parse_prefix(prefix)
+            except (ValueError, OSError, AttributeError):
+                continue
+            if length >= IP_INDEX_MIN_LENGTH[version]:
+                groups.setdefault((version, length), {})[network] = asn
+        tables: Dict[int, list] = {4: [], 6: []}
+        for (version, length), entries in sorted(
+            groups.items(), key=lambda item: -item[0][1]
+        ):
+            keys = sorted(entries)
+            # IPv6 networks do not fit an array typecode; keep them as ints
+            tables[version].append(
+                (
+                    length,
+                    array("I", keys) if version == 4 else keys,
+                    array("I", (entries[k] for k in keys)),
+                )
+            )
+        return tables, sum(len(g) for g in groups.values())
+
+    def load(self, routes) -> None:
+        """Replace the index with one built from (prefix, asn) rows."""
+        self.tables, self.size = self._build(routes)
+
+    def lookup(self, ip) -> Optional[tuple]:
+        """(origin ASN, matched prefix) of the most specific indexed prefix
+        covering `ip` (a string or ipaddress object), or None."""
+        addr = ipaddress.ip_address(ip)
+        value, bits = int(addr), addr.max_prefixlen
+        for length, keys, asns in self.tables[addr.version]:
+            network = value >> (bits - length) << (bits - length)
+            i = bisect.bisect_left(keys, network)
+            if i < len(keys) and keys[i] == network:
+                return asns[i], f"{type(addr)(network)}/{length}"
+        return None
+
+    async def refresh(self) -> None:
+        rows = await _ch_execute(
+            IP_INDEX_QUERY, {"hours": settings.ip_index_window_hours}
+        )
+        # CPU-bound over ~1M prefixes: keep it off the event loop
+        await asyncio.to_thread(self.load, rows)
+
+    async def run(self, interval: float) -> None:
+        """Rebuild the index every `interval` seconds for the worker's lifetime."""
+        while True:
+            try:
+                await self.refresh()
+                logger.info("ip_index_built", extra={"prefixes": self.size})
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("ip_index_refresh_failed", extra={"error": str(e)})
+            await asyncio.sleep(interval)
+
+
+ip_index = PrefixIndex()
+
+
+async def _cymru_origin(ip: str) -> Optional[tuple]:
+    """(origin ASN, prefix) from Team Cymru's origin/origin6 DNS zones, or
+    None if the lookup fails."""
+    addr = ipaddress.ip_address(ip)
+    if addr.version == 4:
+        name = addr.reverse_pointer.removesuffix(".in-addr.arpa")
+        zone = "origin.asn.cymru.com"
+    else:
+        name = addr.reverse_pointer.removesuffix(".ip6.arpa")
+        zone = "origin6.asn.cymru.com"
+    try:
+        for record in await _resolve(f"{name}.{zone}", "TXT"):
+            fields = [f.strip() for f in record.strip('"').split("|")]
+            # Multiple origins ("13335 13335"): pick the first
+            return int(fields[0].split()[0]), fields[1] if len(fields) > 1 else None
+    except Exception as e:
+        logger.warning("cymru_resolution_failed", extra={"ip": ip, "error": str(e)})
+    return None
+
+
+async def _origin_asn(ip: str) -> Optional[tuple]:
+    """(origin ASN, prefix, source) of `ip`: the local BGP index, falling back
+    to Team Cymru when the index has no covering prefix (or is not built)."""
+    hit = ip_index.lookup(ip)
+    if hit is not None:
+        return (*hit, "bgp")
+    hit = await _cymru_origin(ip)
+    return None if hit is None else (*hit, "cymru")
+
+
+# --- WebSocket stream fan-out ---
+class StreamHub:
+    """Fans STREAM_CHANNEL out to this worker's /v1/stream clients over a single
+    Redis subscription, started with the first client and stopped with the
+    last. Each client gets a bounded queue and optional filters; a client that
+    falls `queue_max` messages behind is sent None (close) and dropped."""
+
+    def __init__(self, queue_max: int = 100) -> None:
+        self.queue_max = queue_max
+        self.clients: Dict[asyncio.Queue, tuple] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def join(
+        self, asns: Optional[frozenset] = None, level_change: bool = False
+    ) -> asyncio.Queue:
+        # One spare slot so the close marker always fits
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_max + 1)
+        self.clients[queue] = (asns, level_change)
+        loop = asyncio.get_running_loop()
+        # A task left over from another (since closed) event loop never runs
+        # again, so it counts as stopped.
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+        return queue
+
+    def leave(self, queue: asyncio.Queue) -> None:
+        """Forget `queue`; the last client out stops the subscription. Kept
+        synchronous so it also completes when the caller is being cancelled."""
+        self.clients.pop(queue, None)
+        if not self.clients and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    @staticmethod
+    def _matches(event, asns: Optional[frozenset], level_change: bool) -> bool:
+        if not isinstance(event, dict):
+            return False
+        if asns is not None and event.get("asn") not in asns:
+            return False
+        if level_change and event.get("risk_level") == event.get("previous_risk_level"):
+            return False
+        return True
+
+    def publish(self, data: str) -> None:
+        """Queue `data` for every client whose filters match; the event is
+        parsed at most once, and only if some client filters."""
+        event = None
+        for queue, (asns, level_change) in list(self.clients.items()):
+            if asns is not None or level_change:
+                if event is None:
+                    try:
+                        event = orjson.loads(data)
+                    except orjson.JSONDecodeError:
+                        event = False
+                if not self._matches(event, asns, level_change):
+                    continue
+            if queue.qsize() >= self.queue_max:
+                # Client cannot keep up: close it rather than buffer without bound
+                queue.put_nowait(None)
+                del self.clients[queue]
+            else:
+                queue.put_nowait(data)
+
+    async def _run(self) -> None:
+        """Relay STREAM_CHANNEL to publish(), resubscribing with backoff if
+        Redis drops. Clients stay connected across reconnects."""
+        backoff = 1.0
+        while True:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.subscribe(STREAM_CHANNEL)
+                backoff = 1.0
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.publish(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(
+                    "stream_subscriber_error",
+                    extra={"error": str(e), "retry_in": backoff},
+                )
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+
+stream_hub = StreamHub()
+
+
 # --- Middleware ---
 
 # Paths exempt from rate limiting: liveness/readiness probes and the metrics
@@ -419,48 +1195,40 @@ async def request_middleware(request: Request, call_next):
     request.state.trace_id = trace_id
     request.state.cache_hit = False
 
-    # Rate Limiting (atomic) — keyed on the real client IP, not the proxy's.
+    # Rate Limiting — keyed on the real client IP, not the proxy's.
     client_ip = _client_ip(request)
-    window = 60
+    window = RATE_LIMIT_WINDOW
     remaining = settings.api_rate_limit
 
     if request.url.path not in RATE_LIMIT_EXEMPT_PATHS:
-        rate_limit_key = f"rl:{client_ip}"
-        try:
-            current = await redis_client.eval(
-                RATE_LIMIT_SCRIPT,
-                1,
-                rate_limit_key,
-                window,
-                settings.api_rate_limit,
-            )
-            remaining = max(0, settings.api_rate_limit - current)
-
-            if current > settings.api_rate_limit:
-                ttl = await redis_client.ttl(rate_limit_key)
-                return ORJSONResponse(
-                    status_code=429,
-                    content=ErrorEnvelope(
-                        error=f"Rate limit exceeded. Try again in {ttl} seconds.",
-                        code="RATE_LIMITED",
-                        request_id=trace_id,
-                    ).model_dump(),
-                    headers={
-                        "X-RateLimit-Limit": str(settings.api_rate_limit),
-                        "X-RateLimit-Remaining": "0",
-                        "X-RateLimit-Reset": str(int(time.time()) + ttl),
-                        "X-Trace-ID": trace_id,
-                        "Retry-After": str(ttl),
-                    },
+        if local_rate_limiter is not None:
+            allowed, remaining, retry_after = local_rate_limiter.acquire(client_ip)
+            if not allowed:
+                return _rate_limited_response(trace_id, retry_after)
+        else:
+            rate_limit_key = f"rl:{client_ip}"
+            try:
+                current = await redis_client.eval(
+                    RATE_LIMIT_SCRIPT,
+                    1,
+                    rate_limit_key,
+                    window,
+                    settings.api_rate_limit,
+                )
+                remaining = max(0, settings.api_rate_limit - current)
+
+                if current > settings.api_rate_limit:
+                    ttl = await redis_client.ttl(rate_limit_key)
+                    return _rate_limited_response(trace_id, ttl)
+            except Exception as e:
+                # Fail OPEN: a rate-limiter outage must not turn every request
+                # into a 503. Serve the request (L1/Redis/PG may still answer) and
+                # log loudly so the Redis problem is visible without cascading
+                # into an outage.
+                logger.warning(
+                    "rate_limit_unavailable_fail_open",
+                    extra={"trace_id": trace_id, "error": str(e)},
                 )
-        except Exception as e:
-            # Fail OPEN: a rate-limiter outage must not turn every request into a
-            # 503. Serve the request (L1/Redis/PG may still answer) and log loudly
-            # so the Redis problem is visible without cascading into an outage.
-            logger.warning(
-                "rate_limit_unavailable_fail_open",
-                extra={"trace_id": trace_id, "error": str(e)},
-            )
 
     response = await call_next(request)
     process_time = (time.time() - start_time) * 1000
@@ -472,36 +1240,21 @@ async def request_middleware(request: Request, call_next):
     response.headers["X-RateLimit-Reset"] = str(int(time.time()) + window)
     response.headers["X-Trace-ID"] = trace_id
 
-    # Async ClickHouse request logging (fire-and-forget with error logging)
+    # ClickHouse request logging (buffered; written by request_log.run)
     endpoint = request.url.path
     if endpoint.startswith("/v1/asn"):
-        cache_hit = getattr(request.state, "cache_hit", False)
-
-        async def _log_to_ch() -> None:
-            try:
-                await _ch_execute(
-                    """INSERT INTO api_requests
-                    (timestamp, endpoint, method, status_code, response_time_ms, cache_hit, client_ip, error_message)
-                    VALUES""",
-                    [
-                        (
-                            datetime.now(),
-                            endpoint,
-                            request.method,
-                            response.status_code,
-                            process_time,
-                            1 if cache_hit else 0,
-                            client_ip,
-                            "",
-                        )
-                    ],
-                )
-            except Exception as exc:
-                logger.warning("ch_request_log_failed", extra={"error": str(exc)})
-
-        _task = asyncio.create_task(_log_to_ch())
-        _bg_tasks.add(_task)
-        _task.add_done_callback(_bg_tasks.discard)
+        request_log.append(
+            (
+                datetime.now(),
+                endpoint,
+                request.method,
+                response.status_code,
+                process_time,
+                1 if getattr(request.state, "cache_hit", False) else 0,
+                client_ip,
+                "",
+            )
+        )
 
     return response
 
@@ -524,7 +1277,9 @@ def read_root():
             "/v1/asn/{asn}/peeringdb",
             "/v1/tools/compare",
             "/v1/tools/bulk-risk-check",
+            "/v1/tools/bulk-risk-check/stream",
             "/v1/tools/domain-risk",
+            "/v1/tools/ip-risk",
             "/v1/whitelist",
             "/v1/stream",
             "/feeds/edl",
@@ -689,52 +1444,9 @@ def generate_penalty_details(result: dict) -> List[PenaltyDetail]:
     return details
 
 
-@app.get("/v1/asn/{asn}", response_model=RiskScoreResponse, tags=["Scoring"])
-async def get_asn_score(
-    asn: int, response: Response, request: Request, api_key: str = Depends(get_api_key)
-):
-    """Get the detailed risk score card for a specific ASN."""
-    _validate_asn(asn)
-    trace_id = getattr(request.state, "trace_id", "")
-
-    cache_key = f"score:v3:{asn}"
-
-    # Check L1 cache (In-memory)
-    cached_l1 = l1_cache.get(cache_key)
-    if cached_l1:
-        request.state.cache_hit = True
-        response.headers["X-Cache-Tier"] = "L1"
-        etag = _stable_etag(cached_l1["last_updated"])
-        if request.headers.get("if-none-match") == etag:
-            return Response(status_code=304)
-        response.headers["ETag"] = etag
-        response.headers["Cache-Control"] = f"public, max-age={settings.cache_ttl}"
-        return cached_l1
-
-    try:
-        # Check L2 cache (Redis)
-        cached = await redis_client.get(cache_key)
-        if cached:
-            request.state.cache_hit = True
-            response.headers["X-Cache-Tier"] = "L2"
-            data = orjson.loads(cached)
-            # Hydrate L1
-            l1_cache[cache_key] = data
-
-            etag = _stable_etag(data["last_updated"])
-            if request.headers.get("if-none-match") == etag:
-                return Response(status_code=304)
-            response.headers["ETag"] = etag
-            response.headers["Cache-Control"] = f"public, max-age={settings.cache_ttl}"
-            return data
-        request.state.cache_hit = False
-    except Exception as e:
-        logger.error(
-            "cache_read_error",
-            extra={"asn": asn, "trace_id": trace_id, "error": str(e)},
-        )
-        request.state.cache_hit = False
-
+async def _build_score_payload(asn: int) -> Optional[dict]:
+    """Assemble the /v1/asn/{asn} score card from Postgres (plus the score
+    histogram for rank_percentile). None when the ASN is not in the registry."""
     query = text("""
         SELECT r.asn, r.name, r.country_code, r.registry,
                r.total_score, r.risk_level, r.last_scored_at, r.downstream_score,
@@ -751,11 +1463,10 @@ async def get_asn_score(
         WHERE r.asn = :asn
     """)
 
-    cache_key_total = "stats:asn_total_count"
     try:
-        total_count_cached = await redis_client.get(cache_key_total)
+        histogram = await redis_client.hgetall(SCORE_HISTOGRAM_KEY)
     except Exception:
-        total_count_cached = None
+        histogram = None
 
     async def _fetch_db_data():
         async with pg_engine.begin() as conn:
@@ -765,42 +1476,38 @@ async def get_asn_score(
                 return None
 
             r_dict = dict(row)
-            score = r_dict["total_score"]
-
-            if total_count_cached:
-                t_count = int(total_count_cached)
-            else:
-                t_count_res = await conn.execute(
-                    text("SELECT count(*) FROM asn_registry")
+            percentile = _percentile_from_histogram(histogram, r_dict["total_score"])
+            if percentile is not None:
+                return r_dict, percentile
+
+            # Histogram not built yet (fresh deployment / Redis flushed): fall
+            # back to range counts over the registry.
+            t_count = (
+                await conn.execute(
+                    text(
+                        "SELECT count(*) FROM asn_registry "
+                        "WHERE last_scored_at IS NOT NULL"
+                    )
                 )
-                t_count = t_count_res.scalar()
-
-            c_lower_res = await conn.execute(
-                text("SELECT count(*) FROM asn_registry WHERE total_score < :score"),
-                {"score": score},
-            )
-            c_lower = c_lower_res.scalar()
-
-            return r_dict, t_count, c_lower
+            ).scalar()
+            c_lower = (
+                await conn.execute(
+                    text(
+                        "SELECT count(*) FROM asn_registry "
+                        "WHERE last_scored_at IS NOT NULL AND total_score < :score"
+                    ),
+                    {"score": r_dict["total_score"]},
+                )
+            ).scalar()
+            return r_dict, (c_lower / t_count * 100.0) if t_count else 0.0
 
     db_res = await _fetch_db_data()
-
     if not db_res:
-        raise HTTPException(status_code=404, detail="ASN not found or not yet scored")
+        return None
 
-    result, total_count, count_lower = db_res
+    result, percentile = db_res
     score = result["total_score"]
 
-    if not total_count_cached and total_count:
-        try:
-            await redis_client.setex(
-                cache_key_total, STATS_TOTAL_COUNT_CACHE_TTL, total_count
-            )
-        except Exception as e:
-            logger.warning("stats_cache_write_error", extra={"error": str(e)})
-
-    percentile = (count_lower / total_count * 100.0) if total_count > 0 else 0.0
-
     level = result["risk_level"]
     if level == "UNKNOWN":
         level = (
@@ -811,7 +1518,7 @@ async def get_asn_score(
 
     details = generate_penalty_details(result)
 
-    response_data = {
+    return {
         "asn": result["asn"],
         "name": result["name"],
         "country_code": result["country_code"],
@@ -856,20 +1563,260 @@ async def get_asn_score(
         "details": [d.model_dump() for d in details],
     }
 
+
+# --- Single-flight cache fills ---
+# A popular ASN expiring from L1/L2 must not send every concurrent request to
+# Postgres. Within a process, concurrent misses for a key await one shared
+# Future; across processes the filler holds a short Redis lease and the others
+# poll L2 for its result, filling it themselves only if the lease lapses.
+SCORE_FILL_LEASE_MS = 5000
+SCORE_FILL_POLL_INTERVAL = 0.05
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+# KEYS: cache entry, score:gen:{asn}. ARGV: generation read before the fill
+# ("" = none), ttl, entry. Refuses the write if an invalidation intervened.
+CACHE_WRITE_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[3], 'EX', ARGV[2])
+return 1
+"""
+_inflight: Dict[str, asyncio.Future] = {}
+
+
+# --- Stale-while-revalidate ---
+# Cached scores carry a soft expiry (cache_ttl) inside a hard one (cache_ttl +
+# cache_stale_ttl, the L1/Redis TTL). Between the two the entry is served as-is
+# (X-Cache-Tier: L1-STALE / L2-STALE) while one background fill refreshes it.
+#
+# An entry holds the final response: the JSON body (validated against
+# RiskScoreResponse once, at fill time) and its ETag, so a hit is served as raw
+# bytes with no decode / validate / re-encode. In Redis it is stored as
+# "<soft_expires> <etag> <body>" and split, never parsed, on read.
+def _cache_entry(data: dict) -> dict:
+    return {
+        "body": orjson.dumps(RiskScoreResponse.model_validate(data).model_dump()),
+        "etag": _stable_etag(data["last_updated"]),
+        "soft_expires": time.time() + settings.cache_ttl,
+    }
+
+
+def _encode_cache_entry(entry: dict) -> bytes:
+    return b"%.3f %s %s" % (
+        entry["soft_expires"],
+        entry["etag"].encode(),
+        entry["body"],
+    )
+
+
+def _decode_cache_entry(raw) -> dict:
+    if isinstance(raw, bytes):
+        raw = raw.decode()
+    soft_expires, etag, body = raw.split(" ", 2)
+    return {"body": body.encode(), "etag": etag, "soft_expires": float(soft_expires)}
+
+
+def _is_fresh(entry: dict) -> bool:
+    return time.time() < entry["soft_expires"]
+
+
+def _revalidate_in_background(asn: int, cache_key: str) -> None:
+    """Refresh a stale entry off the request path. No-op while a fill for the
+    key is already in flight in this worker."""
+    if cache_key in _inflight:
+        return
+
+    async def _refresh() -> None:
+        try:
+            await _single_flight(cache_key, lambda: _fill_score_cache(asn, cache_key))
+        except Exception as e:
+            logger.warning(
+                "cache_revalidate_failed", extra={"asn": asn, "error": str(e)}
+            )
+
+    task = asyncio.create_task(_refresh())
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+
+
+def _serve_cached(request: Request, entry: dict, tier: Optional[str]) -> Response:
+    """Score card response straight from a cache entry: ETag (304 on
+    If-None-Match) and X-Cache-Tier (`tier`, None for a fresh fill)."""
+    request.state.cache_hit = tier is not None
+    headers = {"ETag": entry["etag"]}
+    if tier:
+        headers["X-Cache-Tier"] = tier
+    if request.headers.get("if-none-match") == entry["etag"]:
+        return Response(status_code=304, headers=headers)
+    max_age = 0 if tier and tier.endswith("-STALE") else settings.cache_ttl
+    headers["Cache-Control"] = f"public, max-age={max_age}"
+    return Response(
+        content=entry["body"], media_type="application/json", headers=headers
+    )
+
+
+async def _single_flight(key: str, fill):
+    """Run `fill()` once per key at a time; concurrent callers share its result
+    (or exception). A follower whose leader was cancelled takes over."""
+    fut = _inflight.get(key)
+    if fut is not None:
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            if not fut.cancelled():
+                raise
+            return await _single_flight(key, fill)
+
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
+    try:
+        result = await fill()
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # mark retrieved: followers may not exist
+        raise
+    else:
+        fut.set_result(result)
+        return result
+    finally:
+        _inflight.pop(key, None)
+
+
+async def _fill_score_cache(asn: int, cache_key: str) -> Optional[dict]:
+    """Cross-process half of the single-flight: take the fill lease for
+    `cache_key`, or wait for whoever holds it to write L2. Returns the cache
+    entry (None if the ASN is unknown). Redis errors fail open (fill without
+    the lease)."""
+    lock_key = f"lock:{cache_key}"
+    token = os.urandom(8).hex()
     try:
-        await redis_client.setex(
-            cache_key, settings.cache_ttl, orjson.dumps(response_data)
+        leader = bool(
+            await redis_client.set(lock_key, token, nx=True, px=SCORE_FILL_LEASE_MS)
         )
-        # Sync to L1 Memory Cache
-        l1_cache[cache_key] = response_data
+    except Exception:
+        leader, token = False, None
+
+    if not leader and token is not None:
+        deadline = time.monotonic() + SCORE_FILL_LEASE_MS / 1000
+        try:
+            while time.monotonic() < deadline:
+                await asyncio.sleep(SCORE_FILL_POLL_INTERVAL)
+                cached = await redis_client.get(cache_key)
+                if cached:
+                    entry = _decode_cache_entry(cached)
+                    if _is_fresh(entry):
+                        l1_cache[cache_key] = entry
+                        return entry
+                # Lease released without a fill (ASN not found / filler error)
+                if not await redis_client.exists(lock_key):
+                    break
+        except Exception as e:
+            logger.warning("cache_fill_wait_error", extra={"asn": asn, "error": str(e)})
+
+    gen_key = f"score:gen:{asn}"
+    try:
+        # Read before Postgres: an invalidation from here on replaces it
+        try:
+            generation = await redis_client.get(gen_key) or ""
+        except Exception:
+            generation = None
+        response_data = await _build_score_payload(asn)
+        if response_data is None:
+            return None
+        entry = _cache_entry(response_data)
+        # Sync to L1 Memory Cache first: an eviction arriving while the write
+        # is in flight then removes it like any other entry.
+        l1_cache[cache_key] = entry
+        written = False
+        try:
+            if generation is not None:
+                written = await redis_client.eval(
+                    CACHE_WRITE_SCRIPT,
+                    2,
+                    cache_key,
+                    gen_key,
+                    generation,
+                    settings.cache_ttl + settings.cache_stale_ttl,
+                    _encode_cache_entry(entry),
+                )
+        except Exception as e:
+            logger.error("cache_write_error", extra={"asn": asn, "error": str(e)})
+        if not written:
+            # Invalidated during the fill (or Redis failed): the card may
+            # predate the new score, so serve it once but don't cache it.
+            if l1_cache.get(cache_key) is entry:
+                l1_cache.pop(cache_key, None)
+        return entry
+    finally:
+        if leader:
+            try:
+                await redis_client.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+            except Exception:
+                pass  # the lease expires on its own
+
+
+@app.get("/v1/asn/{asn}", response_model=RiskScoreResponse, tags=["Scoring"])
+async def get_asn_score(
+    asn: int, response: Response, request: Request, api_key: str = Depends(get_api_key)
+):
+    """Get the detailed risk score card for a specific ASN."""
+    _validate_asn(asn)
+    trace_id = getattr(request.state, "trace_id", "")
+
+    cache_key = f"score:v4:{asn}"
+
+    # Check L1 cache (In-memory)
+    stale = None
+    cached_l1 = l1_cache.get(cache_key)
+    if cached_l1:
+        if _is_fresh(cached_l1):
+            return _serve_cached(request, cached_l1, "L1")
+        stale = ("L1-STALE", cached_l1)
+
+    try:
+        # Check L2 cache (Redis) — another worker may have refreshed it already
+        cached = await redis_client.get(cache_key)
+        if cached:
+            entry = _decode_cache_entry(cached)
+            if _is_fresh(entry):
+                # Hydrate L1
+                l1_cache[cache_key] = entry
+                return _serve_cached(request, entry, "L2")
+            stale = ("L2-STALE", entry)
+        request.state.cache_hit = False
     except Exception as e:
-        logger.error("cache_write_error", extra={"asn": asn, "error": str(e)})
+        logger.error(
+            "cache_read_error",
+            extra={"asn": asn, "trace_id": trace_id, "error": str(e)},
+        )
+        request.state.cache_hit = False
+
+    if stale:
+        tier, entry = stale
+        _revalidate_in_background(asn, cache_key)
+        return _serve_cached(request, entry, tier)
+
+    entry = await _single_flight(cache_key, lambda: _fill_score_cache(asn, cache_key))
+    if entry is None:
+        raise HTTPException(status_code=404, detail="ASN not found or not yet scored")
+    return _serve_cached(request, entry, None)
 
-    etag = _stable_etag(response_data["last_updated"])
-    response.headers["ETag"] = etag
-    response.headers["Cache-Control"] = f"public, max-age={settings.cache_ttl}"
 
-    return response_data
+# Bucket start per history `resolution`. Bucket starts are unique, so a
+# bucket cursor never skips rows: every row of an older bucket is earlier.
+HISTORY_BUCKETS = {
+    "hour": ("toStartOfHour(timestamp)", 3600),
+    "day": ("toStartOfDay(timestamp)", 86400),
+    "week": ("toDateTime(toMonday(timestamp))", 604800),
+}
 
 
 @app.get("/v1/asn/{asn}/history", response_model=PaginatedHistory, tags=["Analytics"])
@@ -879,14 +1826,22 @@ async def get_asn_history(
     offset: int = 0,
     limit: int = 200,
     api_key: str = Depends(get_api_key),
+    cursor: Optional[str] = None,
+    resolution: Optional[str] = None,
+    estimate: bool = False,
 ):
     """
-    **Get the historical score trend with pagination.**
+    **Get the historical score trend, newest first.**
 
     Parameters:
     * `days`: Number of days of history (default: 30, max: 365)
-    * `offset`: Skip first N records (default: 0)
     * `limit`: Max records to return (default: 200, max: 1000)
+    * `cursor`: `next_cursor` of the previous page (`<timestamp>,<seen>`);
+      returns the records after it (keyset pagination on timestamp)
+    * `offset`: Skip first N records (default: 0; deprecated, use `cursor`)
+    * `resolution`: `hour`, `day` or `week` to return one min/max/avg bucket
+      per interval, aggregated in ClickHouse, instead of every score point
+    * `estimate`: return an upper-bound `total` without counting rows
     """
     _validate_asn(asn)
     days = min(days, 365)
@@ -894,39 +1849,116 @@ async def get_asn_history(
     offset = max(offset, 0)
     if offset > 100_000:
         raise HTTPException(status_code=400, detail="offset too large (max 100000)")
+    if resolution is not None and resolution not in HISTORY_BUCKETS:
+        raise HTTPException(
+            status_code=400, detail="resolution must be one of: hour, day, week"
+        )
+    before, skip = None, 0
+    if cursor is not None:
+        if offset:
+            raise HTTPException(
+                status_code=400, detail="Use either cursor or offset, not both"
+            )
+        stamp, _, seen = cursor.rpartition(",")
+        try:
+            before, skip = datetime.fromisoformat(stamp), int(seen)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if not 0 <= skip <= 100_000:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    window = "asn = %(asn)s AND timestamp > now() - INTERVAL %(days)s DAY"
+    # Score points can share a second, so the cursor is the last timestamp
+    # returned plus how many rows at it were already returned: the next page
+    # starts at that timestamp and skips them (ties are ordered by score).
+    # Bucketed pages start strictly before the last bucket.
+    page = window
+    if before is not None:
+        op = "<" if resolution else "<="
+        page += f" AND timestamp {op} %(before)s"
+    # The MergeTree key is (asn, timestamp): both the window and the cursor
+    # are primary-key ranges, so a page reads only its own granules.
+    if resolution is None:
+        count_query = f"SELECT count() FROM asn_score_history WHERE {window}"
+        data_query = f"""
+        SELECT timestamp, score
+        FROM asn_score_history
+        WHERE {page}
+        ORDER BY timestamp DESC, score DESC
+        LIMIT %(limit)s OFFSET %(offset)s
+        """
+    else:
+        bucket, _ = HISTORY_BUCKETS[resolution]
+        count_query = (
+            f"SELECT uniqExact({bucket}) FROM asn_score_history WHERE {window}"
+        )
+        data_query = f"""
+        SELECT {bucket} AS bucket, min(score), max(score), avg(score), count()
+        FROM asn_score_history
+        WHERE {page}
+        GROUP BY bucket
+        ORDER BY bucket DESC
+        LIMIT %(limit)s OFFSET %(offset)s
+        """
+    params = {
+        "asn": asn,
+        "days": days,
+        "limit": limit,
+        "offset": offset + skip,
+        "before": before,
+    }
 
-    count_query = """
-    SELECT count(*)
-    FROM asn_score_history
-    WHERE asn = %(asn)s AND timestamp > now() - INTERVAL %(days)s DAY
-    """
-    # Use a cursor-based WHERE clause to avoid expensive OFFSET scans.
-    # The data is already ordered (asn, timestamp) by the MergeTree key;
-    # an explicit ORDER BY DESC is still needed to return newest-first.
-    data_query = """
-    SELECT timestamp, score
-    FROM asn_score_history
-    WHERE asn = %(asn)s AND timestamp > now() - INTERVAL %(days)s DAY
-    ORDER BY timestamp DESC
-    LIMIT %(limit)s OFFSET %(offset)s
-    """
-    params = {"asn": asn, "days": days, "limit": limit, "offset": offset}
+    async def _total() -> int:
+        if not estimate:
+            return (await _ch_execute(count_query, params))[0][0]
+        if resolution is not None:
+            return days * 86400 // HISTORY_BUCKETS[resolution][1] + 1
+        # Rows in the granules the primary key selects (database, table,
+        # parts, rows, marks): an upper bound, no data is read.
+        plan = await _ch_execute(
+            f"EXPLAIN ESTIMATE SELECT score FROM asn_score_history WHERE {window}",
+            params,
+        )
+        return sum(row[3] for row in plan)
 
     try:
-        total_res = await _ch_execute(count_query, {"asn": asn, "days": days})
-        total = total_res[0][0]
-        data = await _ch_execute(data_query, params)
-        return {
-            "asn": asn,
-            "total": total,
-            "offset": offset,
-            "limit": limit,
-            "data": [{"timestamp": str(ts), "score": int(score)} for ts, score in data],
-        }
+        total, data = await asyncio.gather(_total(), _ch_execute(data_query, params))
     except Exception as e:
         logger.error("history_query_error", extra={"asn": asn, "error": str(e)})
         raise HTTPException(status_code=503, detail="Metrics database unavailable")
 
+    if resolution is None:
+        points = [{"timestamp": str(ts), "score": int(score)} for ts, score in data]
+    else:
+        points = [
+            {
+                "timestamp": str(ts),
+                "score": round(avg),
+                "min": int(lo),
+                "max": int(hi),
+                "avg": round(avg, 2),
+                "samples": int(n),
+            }
+            for ts, lo, hi, avg, n in data
+        ]
+    next_cursor = None
+    if len(points) == limit:
+        last, seen = points[-1]["timestamp"], 0
+        if resolution is None:
+            seen = sum(1 for p in points if p["timestamp"] == last)
+            if before is not None and str(before) == last:
+                seen += skip
+        next_cursor = f"{last},{seen}"
+    return {
+        "asn": asn,
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        "resolution": resolution,
+        "next_cursor": next_cursor,
+        "data": points,
+    }
+
 
 @app.post("/v1/whitelist", tags=["System"])
 async def add_to_whitelist(
@@ -946,8 +1978,8 @@ async def add_to_whitelist(
             )
             # pg_engine.begin() auto-commits on context exit — explicit commit removed
 
-        # Invalidate cache for this ASN
-        await redis_client.delete(f"score:v3:{req.asn}")
+        # Invalidate cache for this ASN (L2 and every worker's L1)
+        await _invalidate_score_cache(req.asn)
 
         logger.info(
             "whitelist_add",
@@ -962,6 +1994,20 @@ async def add_to_whitelist(
         raise HTTPException(status_code=500, detail="Failed to update whitelist")
 
 
+async def _fetch_compare_rows(asn_a: int, asn_b: int) -> list:
+    query = text("""
+        SELECT r.asn, r.name, r.country_code,
+               r.total_score, r.risk_level,
+               r.hygiene_score, r.threat_score, r.stability_score
+        FROM asn_registry r
+        WHERE r.asn IN (:asn_a, :asn_b)
+    """)
+
+    async with pg_engine.begin() as conn:
+        result = await conn.execute(query, {"asn_a": asn_a, "asn_b": asn_b})
+        return result.mappings().fetchall()
+
+
 @app.get("/v1/tools/compare", tags=["Scoring"])
 async def compare_asns(
     asn_a: int = Query(..., description="First ASN to compare"),
@@ -975,17 +2021,13 @@ async def compare_asns(
     _validate_asn(asn_a)
     _validate_asn(asn_b)
 
-    query = text("""
-        SELECT r.asn, r.name, r.country_code,
-               r.total_score, r.risk_level, 
-               r.hygiene_score, r.threat_score, r.stability_score
-        FROM asn_registry r
-        WHERE r.asn IN (:asn_a, :asn_b)
-    """)
-
-    async with pg_engine.begin() as conn:
-        result = await conn.execute(query, {"asn_a": asn_a, "asn_b": asn_b})
-        rows = result.mappings().fetchall()
+    rows = [
+        r
+        for r in map(score_snapshot.get, dict.fromkeys((asn_a, asn_b)))
+        if r is not None
+    ]
+    if len(rows) != 2:
+        rows = await _fetch_compare_rows(asn_a, asn_b)
 
     if len(rows) != 2:
         found_asns = [r["asn"] for r in rows]
@@ -1024,6 +2066,42 @@ async def compare_asns(
     }
 
 
+BULK_QUERY = text("""
+    SELECT asn, total_score, risk_level, name
+    FROM asn_registry
+    WHERE asn = ANY(:asns)
+""")
+
+
+async def _bulk_rows(asns: list) -> dict:
+    """asn -> registry row: the score snapshot first, then one Postgres query
+    for whatever it cannot answer."""
+    rows = {}
+    missing = []
+    for asn in asns:
+        row = score_snapshot.get(asn)
+        if row is None:
+            missing.append(asn)
+        else:
+            rows[asn] = row
+    if missing:
+        async with pg_engine.begin() as conn:
+            result = await conn.execute(BULK_QUERY, {"asns": missing})
+            rows.update({r["asn"]: r for r in result.mappings().fetchall()})
+    return rows
+
+
+def _bulk_result(asn: int, row) -> dict:
+    if row is None:
+        return {"asn": asn, "score": None, "level": "UNKNOWN", "name": "Unknown"}
+    return {
+        "asn": asn,
+        "score": row["total_score"],
+        "level": row["risk_level"],
+        "name": row["name"],
+    }
+
+
 @app.post("/v1/tools/bulk-risk-check", tags=["Scoring"])
 async def bulk_risk_check(
     req: BulkAnalysisRequest, api_key: str = Depends(get_api_key)
@@ -1032,42 +2110,122 @@ async def bulk_risk_check(
     if len(req.asns) > 1000:
         raise HTTPException(status_code=400, detail="Max 1000 ASNs per request")
 
-    query = text("""
-        SELECT asn, total_score, risk_level, name
-        FROM asn_registry
-        WHERE asn = ANY(:asns)
-    """)
-
-    results = []
-    async with pg_engine.begin() as conn:
-        result = await conn.execute(query, {"asns": req.asns})
-        rows = result.mappings().fetchall()
-        row_map = {r["asn"]: r for r in rows}
-
-        for asn_id in req.asns:
-            if asn_id in row_map:
-                r = row_map[asn_id]
-                results.append(
-                    {
-                        "asn": asn_id,
-                        "score": r["total_score"],
-                        "level": r["risk_level"],
-                        "name": r["name"],
-                    }
-                )
-            else:
-                results.append(
-                    {
-                        "asn": asn_id,
-                        "score": None,
-                        "level": "UNKNOWN",
-                        "name": "Unknown",
-                    }
-                )
+    row_map = await _bulk_rows(req.asns)
+    results = [_bulk_result(asn_id, row_map.get(asn_id)) for asn_id in req.asns]
 
     return {"results": results, "total": len(results)}
 
 
+# Longest NDJSON line accepted by the streaming bulk check; {"asn": 4294967295}
+# is 19 bytes, the rest leaves room for whitespace and CRLF.
+BULK_STREAM_MAX_LINE = 256
+
+
+def _check_ndjson_line_length(line: bytes, line_no: int) -> None:
+    if len(line) > BULK_STREAM_MAX_LINE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Line {line_no} exceeds {BULK_STREAM_MAX_LINE} bytes",
+        )
+
+
+def _parse_ndjson_asn(line: bytes, line_no: int) -> int:
+    """One NDJSON line of a streaming bulk check: a bare ASN or {"asn": N}."""
+    try:
+        value = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        value = None
+    if isinstance(value, dict):
+        value = value.get("asn")
+    if type(value) is not int or not ASN_MIN <= value <= ASN_MAX:
+        raise HTTPException(
+            status_code=400, detail=f'Line {line_no}: expected an ASN or {{"asn": N}}'
+        )
+    return value
+
+
+async def _read_bulk_asns(request: Request) -> array:
+    """Parse a streaming bulk-check body as it arrives into a uint32 array
+    (4 bytes per ASN, whatever the encoding). The body is NDJSON, or packed
+    big-endian uint32 ASNs with Content-Type application/octet-stream.
+
+    The whole list is read before the first result is sent, so a bad line or
+    an oversized body can still get a 400/413 instead of a truncated 200 and
+    X-Total-ASNs is known up front. Memory stays bounded: at most
+    4 x bulk_stream_max_asns bytes for the array, plus one partial line of at
+    most BULK_STREAM_MAX_LINE bytes (longer lines are rejected)."""
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    binary = content_type == "application/octet-stream"
+    limit = settings.bulk_stream_max_asns
+    asns = array("I")
+    pending = b""
+    line_no = 0
+    async for chunk in request.stream():
+        pending += chunk
+        if binary:
+            block = array("I")
+            block.frombytes(pending[: len(pending) - len(pending) % 4])
+            pending = pending[len(block) * 4 :]
+            if sys.byteorder == "little":
+                block.byteswap()
+            if block and min(block) < ASN_MIN:
+                raise HTTPException(status_code=400, detail="ASN 0 is not valid")
+            asns.extend(block)
+        else:
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                line_no += 1
+                _check_ndjson_line_length(line, line_no)
+                if line.strip():
+                    asns.append(_parse_ndjson_asn(line, line_no))
+            _check_ndjson_line_length(pending, line_no + 1)
+        if len(asns) > limit:
+            raise HTTPException(
+                status_code=413, detail=f"Max {limit} ASNs per streaming request"
+            )
+    if binary and pending:
+        raise HTTPException(
+            status_code=400, detail="Binary body length must be a multiple of 4"
+        )
+    if pending.strip():
+        asns.append(_parse_ndjson_asn(pending, line_no + 1))
+        if len(asns) > limit:
+            raise HTTPException(
+                status_code=413, detail=f"Max {limit} ASNs per streaming request"
+            )
+    return asns
+
+
+async def _stream_bulk_results(asns: array):
+    """One NDJSON result line per requested ASN, in request order, looked up
+    bulk_stream_chunk_size ASNs at a time. A Postgres connection is only held
+    for a chunk's snapshot misses, never while the client reads."""
+    size = settings.bulk_stream_chunk_size
+    for i in range(0, len(asns), size):
+        chunk = asns[i : i + size].tolist()
+        row_map = await _bulk_rows(chunk)
+        yield b"".join(
+            orjson.dumps(_bulk_result(asn, row_map.get(asn))) + b"\n" for asn in chunk
+        )
+
+
+@app.post("/v1/tools/bulk-risk-check/stream", tags=["Scoring"])
+async def bulk_risk_check_stream(request: Request, api_key: str = Depends(get_api_key)):
+    """
+    Streaming bulk check for large ASN inventories. Accepts NDJSON (one ASN or
+    {"asn": N} per line) or a packed big-endian uint32 array
+    (Content-Type: application/octet-stream) of up to bulk_stream_max_asns ASNs,
+    and streams one NDJSON result per ASN back in request order. The whole body
+    is read and validated before the first result is sent.
+    """
+    asns = await _read_bulk_asns(request)
+    return StreamingResponse(
+        _stream_bulk_results(asns),
+        media_type="application/x-ndjson",
+        headers={"X-Total-ASNs": str(len(asns))},
+    )
+
+
 @app.get(
     "/v1/asn/{asn}/upstreams", response_model=PeerPressureResponse, tags=["Scoring"]
 )
@@ -1153,11 +2311,9 @@ async def get_peer_pressure(asn: int, api_key: str = Depends(get_api_key)):
 
 @app.delete("/v1/internal/cache/{asn}", tags=["System"], include_in_schema=False)
 async def invalidate_cache(asn: int, api_key: str = Depends(get_api_key)):
-    """Called by the scoring engine after score updates to bust stale cache."""
-    cache_key = f"score:v3:{asn}"
-    # Evict from both L1 (in-process) and L2 (Redis) to prevent stale reads
-    l1_cache.pop(cache_key, None)
-    deleted = await redis_client.delete(cache_key)
+    """Manually bust a cached score. Evicts L2 and, via the invalidation
+    channel, the L1 of every API worker — not just the one serving this call."""
+    deleted = await _invalidate_score_cache(asn)
     return {"invalidated": bool(deleted)}
 
 
@@ -1185,8 +2341,13 @@ async def get_asn_history_compat(
     offset: int = 0,
     limit: int = 200,
     api_key: str = Depends(get_api_key),
+    cursor: Optional[str] = None,
+    resolution: Optional[str] = None,
+    estimate: bool = False,
 ):
-    return await get_asn_history(asn, days, offset, limit, api_key)
+    return await get_asn_history(
+        asn, days, offset, limit, api_key, cursor, resolution, estimate
+    )
 
 
 @app.post("/whitelist", tags=["System"], include_in_schema=False)
@@ -1213,22 +2374,125 @@ async def get_peer_pressure_compat(asn: int, api_key: str = Depends(get_api_key)
     return await get_peer_pressure(asn, api_key)
 
 
+# Rendered EDL per threshold as (version, bytes); re-read only on a version bump.
+_edl_bodies: Dict[int, tuple] = {}
+
+
+async def _edl_body(threshold: int, version: int) -> tuple:
+    """Rendered EDL of a materialized threshold, from the in-process copy
+    while `version` is current. Set and version are read in one MULTI so the
+    body always matches the version it is stored under."""
+    cached = _edl_bodies.get(threshold)
+    if cached is not None and cached[0] >= version:
+        return cached
+
+    async def fill():
+        key = f"{EDL_KEY_PREFIX}:{threshold}"
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.get(f"{key}:version")
+        pipe.smembers(f"{key}:asns")
+        current, members = await pipe.execute()
+        lines = (f"AS{asn}" for asn in sorted(int(m) for m in members))
+        entry = (int(current or 0), "\n".join(lines).encode())
+        _edl_bodies[threshold] = entry
+        return entry
+
+    return await _single_flight(f"edl:{threshold}:{version}", fill)
+
+
+async def _edl_diff(threshold: int, since: int) -> tuple:
+    """(version, net "+ASx" / "-ASx" changes since `since`). The diff is None
+    when the log no longer reaches back to `since` (client must re-sync)."""
+    key = f"{EDL_KEY_PREFIX}:{threshold}"
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.get(f"{key}:version")
+    pipe.zrange(f"{key}:log", 0, 0, withscores=True)
+    pipe.zrangebyscore(f"{key}:log", since + 1, "+inf")
+    version, oldest, entries = await pipe.execute()
+    version = int(version or 0)
+    if since > version:
+        return version, None
+    if since == version:
+        return version, ""
+    if not oldest or oldest[0][1] > since + 1:
+        return version, None
+    # The log holds only real membership changes, so an ASN's first op after
+    # `since` tells whether it was listed then; the set itself says whether it
+    # is listed now. Anything in between cancels out.
+    was_listed: Dict[int, bool] = {}
+    for member in entries:
+        op = member.split(":", 1)[1]
+        was_listed.setdefault(int(op[1:]), op[0] == "-")
+    if not was_listed:
+        return version, ""
+    asns = sorted(was_listed)
+    listed = await redis_client.smismember(f"{key}:asns", [str(a) for a in asns])
+    return version, "\n".join(
+        f"{'+' if now else '-'}AS{asn}"
+        for asn, now in zip(asns, listed)
+        if bool(now) != was_listed[asn]
+    )
+
+
 @app.get("/feeds/edl", tags=["Integrations"])
 async def get_edl_feed(
+    request: Request,
     max_score: float = Query(50.0, ge=0.0, le=100.0),
+    since: Optional[int] = Query(
+        None, ge=0, description="Return +/- changes since this X-EDL-Version"
+    ),
     api_key: str = Depends(get_api_key),
 ):
     """
     Feed for Firewalls (Palo Alto EDL, Fortinet, etc).
     Returns a plaintext list of ASNs (ASXXXX) below the maximum given risk score.
 
+    Thresholds the engine materializes (EDL_THRESHOLDS) are served from Redis
+    with a version ETag (304 on If-None-Match) and support `?since=` diffs;
+    410 means the version is unknown or too old and the full list must be
+    re-fetched. Other thresholds are served from the score snapshot, or
+    Postgres while it is loading or has unrefreshed entries.
+
     Requires `X-API-Key` (Palo Alto/Fortinet EDL sources support a custom
     header / basic auth) — without it this endpoint would dump the entire
     scored ASN inventory to any anonymous caller.
     """
+    if max_score.is_integer():
+        threshold = int(max_score)
+        try:
+            version = await redis_client.get(f"{EDL_KEY_PREFIX}:{threshold}:version")
+            if version is not None:
+                if since is not None:
+                    version, diff = await _edl_diff(threshold, since)
+                    headers = {"X-EDL-Version": str(version)}
+                    if diff is None:
+                        return PlainTextResponse("", status_code=410, headers=headers)
+                    return PlainTextResponse(diff, headers=headers)
+                version = int(version)
+                headers = {"X-EDL-Version": str(version)}
+                etag = f'W/"edl-{threshold}-{version}"'
+                if request.headers.get("if-none-match") == etag:
+                    return Response(status_code=304, headers={**headers, "ETag": etag})
+                version, body = await _edl_body(threshold, version)
+                return PlainTextResponse(
+                    body,
+                    headers={
+                        "X-EDL-Version": str(version),
+                        "ETag": f'W/"edl-{threshold}-{version}"',
+                    },
+                )
+        except Exception as e:
+            logger.warning("edl_materialized_read_failed", extra={"error": str(e)})
+
+    if since is not None:
+        return PlainTextResponse("", status_code=410)
+
     try:
 
         async def _fetch_edl():
+            listed = score_snapshot.at_most(max_score)
+            if listed is not None:
+                return [f"AS{asn}" for asn in listed]
             async with pg_engine.begin() as conn:
                 result = await conn.execute(
                     text(
@@ -1239,8 +2503,11 @@ async def get_edl_feed(
                 rows = result.fetchall()
                 return [f"AS{row[0]}" for row in rows]
 
-        edl_lines = await _fetch_edl()
-        return PlainTextResponse("\n".join(edl_lines))
+        body = "\n".join(await _fetch_edl())
+        etag = _stable_etag(body)
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        return PlainTextResponse(body, headers={"ETag": etag})
     except Exception as e:
         logger.error("edl_generation_error", extra={"error": str(e)})
         return PlainTextResponse("", status_code=500)
@@ -1248,7 +2515,14 @@ async def get_edl_feed(
 
 @app.websocket("/v1/stream")
 async def websocket_firehose(
-    websocket: WebSocket, api_key: Optional[str] = Query(default=None)
+    websocket: WebSocket,
+    api_key: Optional[str] = Query(default=None),
+    asns: Optional[str] = Query(
+        default=None, description="Comma-separated ASNs to watch (max 1000)"
+    ),
+    level_change: bool = Query(
+        default=False, description="Only events where the risk level changed"
+    ),
 ):
     """
     Real-time firehose of ASN score updates over WebSocket.
@@ -1257,8 +2531,11 @@ async def websocket_firehose(
     and proxy access logs). The `api_key` query param remains as a fallback for
     browser clients that cannot set handshake headers.
 
-    Architecture: bounded asyncio.Queue + producer/consumer task split.
-    - QUEUE_MAX: max messages buffered per connection; excess drops the client (OOM guard).
+    Architecture: one shared Redis subscription per worker (StreamHub) feeding a
+    bounded asyncio.Queue per connection, filtered server-side by `asns` and
+    `level_change`.
+    - QUEUE_MAX (StreamHub.queue_max): max messages buffered per connection;
+      excess drops the client (OOM guard).
     - SEND_TIMEOUT: force-disconnect stalled clients that can't drain their TCP buffer in time.
     - HEARTBEAT_INTERVAL: periodic ping to reap zombie connections (silent disconnects).
     """
@@ -1269,26 +2546,24 @@ async def websocket_firehose(
         await websocket.close(code=1008)
         return
 
-    QUEUE_MAX = 100
+    watched = None
+    if asns:
+        try:
+            watched = frozenset(int(a) for a in asns.split(",") if a.strip())
+        except ValueError:
+            watched = frozenset({0})
+        if (
+            not watched
+            or len(watched) > STREAM_MAX_WATCHED_ASNS
+            or not all(ASN_MIN <= a <= ASN_MAX for a in watched)
+        ):
+            await websocket.close(code=1008, reason="invalid asns filter")
+            return
+
     SEND_TIMEOUT = 5.0
     HEARTBEAT_INTERVAL = 30.0
 
-    queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_MAX)
-    pubsub = redis_client.pubsub()
-    await pubsub.subscribe("events:asn_updates")
-
-    async def _producer() -> None:
-        """Read from Redis pubsub and push into the bounded queue."""
-        try:
-            async for message in pubsub.listen():
-                if message["type"] == "message":
-                    if queue.full():
-                        # Client cannot keep up — poison the queue so consumer exits.
-                        await queue.put(None)
-                        return
-                    await queue.put(message["data"])
-        except Exception:
-            await queue.put(None)
+    queue = stream_hub.join(watched, level_change)
 
     async def _consumer() -> None:
         """Drain the queue to the WebSocket with per-send timeout and heartbeat."""
@@ -1306,24 +2581,27 @@ async def websocket_firehose(
             except asyncio.TimeoutError:
                 continue  # nothing in queue; loop back to send heartbeat
             if data is None:
-                # Poison pill from producer (overflow or error) — close cleanly.
+                # Close marker from the hub (client fell behind) — close cleanly.
                 await websocket.close(code=1008)
                 return
             await asyncio.wait_for(websocket.send_text(data), timeout=SEND_TIMEOUT)
 
-    producer_task = asyncio.create_task(_producer())
+    async def _receiver() -> None:
+        """Return as soon as the client disconnects; client messages are ignored."""
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    tasks = [asyncio.create_task(_consumer()), asyncio.create_task(_receiver())]
     try:
-        await _consumer()
+        done, _pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
     except (WebSocketDisconnect, asyncio.TimeoutError):
         logger.info("ws_firehose_disconnect")
     finally:
-        producer_task.cancel()
-        try:
-            await pubsub.unsubscribe("events:asn_updates")
-        finally:
-            # Release the dedicated pubsub connection back to the pool — without
-            # this every WS client permanently leaks a Redis connection.
-            await pubsub.aclose()
+        stream_hub.leave(queue)
+        for task in tasks:
+            task.cancel()
 
 
 @app.get("/v1/asn/{asn}/peeringdb", tags=["Enrichment"])
@@ -1390,8 +2668,7 @@ async def get_domain_risk(
     """
     try:
         # Step 1: Resolve Domain to IP
-        answers = await dns.asyncresolver.resolve(domain, "A")
-        ip_address = answers[0].to_text()
+        ip_address = (await _resolve(domain, "A"))[0]
 
         # SSRF Protection
         ip_obj = ipaddress.ip_address(ip_address)
@@ -1407,23 +2684,9 @@ async def get_domain_risk(
             status_code=400, detail=f"Could not resolve domain: {domain}"
         )
 
-    # Step 2: Resolve IP to ASN via Cymru
-    reversed_ip = ".".join(reversed(ip_address.split(".")))
-    query_str = f"{reversed_ip}.origin.asn.cymru.com"
-
-    asn = None
-    try:
-        answers = await dns.asyncresolver.resolve(query_str, "TXT")
-        for rdata in answers:
-            txt = rdata.to_text().strip('"')
-            # Extract ASN, handle multiple ASNs like "13335 13335" by picking the first
-            asn_str = txt.split("|")[0].strip()
-            asn = int(asn_str.split()[0])
-            break
-    except Exception as e:
-        logger.warning(
-            "cymru_resolution_failed", extra={"ip": ip_address, "error": str(e)}
-        )
+    # Step 2: Resolve IP to ASN (local BGP index, Team Cymru as fallback)
+    origin = await _origin_asn(ip_address)
+    asn = origin[0] if origin else None
 
     if not asn:
         return {
@@ -1433,18 +2696,20 @@ async def get_domain_risk(
             "error": "Could not map IP to an ASN",
         }
 
-    # Step 3: Fetch Risk Data from our DB
-    query_db = text("""
-        SELECT r.asn, r.name, r.country_code,
-               r.total_score, r.risk_level, 
-               r.hygiene_score, r.threat_score, r.stability_score
-        FROM asn_registry r
-        WHERE r.asn = :asn
-    """)
+    # Step 3: Fetch Risk Data (score snapshot, else our DB)
+    row = score_snapshot.get(asn)
+    if row is None:
+        query_db = text("""
+            SELECT r.asn, r.name, r.country_code,
+                   r.total_score, r.risk_level, 
+                   r.hygiene_score, r.threat_score, r.stability_score
+            FROM asn_registry r
+            WHERE r.asn = :asn
+        """)
 
-    async with pg_engine.begin() as conn:
-        result = await conn.execute(query_db, {"asn": asn})
-        row = result.mappings().fetchone()
+        async with pg_engine.begin() as conn:
+            result = await conn.execute(query_db, {"asn": asn})
+            row = result.mappings().fetchone()
 
     asn_data = dict(row) if row else {"asn": asn, "status": "Not scored yet"}
 
@@ -1454,3 +2719,122 @@ async def get_domain_risk(
         "asn": asn,
         "infrastructure_risk": asn_data,
     }
+
+
+@app.post("/v1/tools/domain-risk", tags=["Scoring", "Enrichment"])
+async def domain_risk_batch(
+    req: DomainRiskRequest, api_key: str = Depends(get_api_key)
+):
+    """
+    Batch form of GET /v1/tools/domain-risk for up to 1000 domains. A records
+    are resolved concurrently through the DNS answer cache, each distinct IP
+    is mapped to its origin ASN once, and all ASNs are scored with one
+    registry lookup.
+    """
+    semaphore = asyncio.Semaphore(settings.domain_risk_concurrency)
+
+    async def _a_record(domain: str):
+        async with semaphore:
+            try:
+                return domain, (await _resolve(domain, "A"))[0]
+            except Exception:
+                return domain, None
+
+    async def _origin(ip: str):
+        async with semaphore:
+            return ip, await _origin_asn(ip)
+
+    resolved = dict(
+        await asyncio.gather(*(_a_record(d) for d in dict.fromkeys(req.domains)))
+    )
+    public_ips = {
+        ip for ip in resolved.values() if ip and ipaddress.ip_address(ip).is_global
+    }
+    origins = dict(await asyncio.gather(*(_origin(ip) for ip in public_ips)))
+    row_map = await _bulk_rows(sorted({o[0] for o in origins.values() if o}))
+
+    results = []
+    for domain in req.domains:
+        ip = resolved[domain]
+        if ip is None:
+            results.append(
+                {"domain": domain, "asn": None, "error": "Could not resolve domain"}
+            )
+            continue
+        origin = origins.get(ip, "Domain resolves to a local or private IP")
+        if not isinstance(origin, tuple):
+            error = origin or "Could not map IP to an ASN"
+            results.append(
+                {"domain": domain, "resolved_ip": ip, "asn": None, "error": error}
+            )
+            continue
+        asn, prefix, source = origin
+        results.append(
+            {
+                "domain": domain,
+                "resolved_ip": ip,
+                "prefix": prefix,
+                "source": source,
+                **_bulk_result(asn, row_map.get(asn)),
+            }
+        )
+    return {"results": results, "total": len(results)}
+
+
+# Concurrent Team Cymru lookups per ip-risk request (index misses only)
+IP_RISK_CYMRU_CONCURRENCY = 20
+
+
+@app.post("/v1/tools/ip-risk", tags=["Scoring", "Enrichment"])
+async def ip_risk_check(req: IpRiskRequest, api_key: str = Depends(get_api_key)):
+    """
+    Map up to 10000 IPs to their origin ASN and infrastructure risk score.
+    Origins come from the local BGP longest-prefix-match index, with Team
+    Cymru as the fallback for IPs it does not cover; all ASNs are then scored
+    with one registry lookup.
+    """
+    origins: Dict[str, object] = {}
+    fallback = []
+    for ip in dict.fromkeys(req.ips):
+        try:
+            addr = ipaddress.ip_address(ip.strip())
+        except ValueError:
+            origins[ip] = "Invalid IP address"
+            continue
+        if not addr.is_global:
+            origins[ip] = "Not a global IP address"
+            continue
+        hit = ip_index.lookup(addr)
+        if hit is None:
+            fallback.append(ip)
+        else:
+            origins[ip] = (*hit, "bgp")
+
+    semaphore = asyncio.Semaphore(IP_RISK_CYMRU_CONCURRENCY)
+
+    async def _cymru(ip: str):
+        async with semaphore:
+            return ip, await _cymru_origin(ip.strip())
+
+    for ip, hit in await asyncio.gather(*(_cymru(ip) for ip in fallback)):
+        origins[ip] = "Could not map IP to an ASN" if hit is None else (*hit, "cymru")
+
+    row_map = await _bulk_rows(
+        sorted({o[0] for o in origins.values() if isinstance(o, tuple)})
+    )
+    results = []
+    for ip in req.ips:
+        origin = origins[ip]
+        if isinstance(origin, str):
+            results.append({"ip": ip, "asn": None, "error": origin})
+            continue
+        asn, prefix, source = origin
+        results.append(
+            {
+                "ip": ip,
+                "prefix": prefix,
+                "source": source,
+                **_bulk_result(asn, row_map.get(asn)),
+            }
+        )
+    return {"results": results, "total": len(results)}
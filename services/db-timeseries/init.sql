@@ -90,6 +90,54 @@ FROM bgp_events
 WHERE countEqual(path, asn) > 3
 GROUP BY date, asn;
 
+-- Per-ASN daily signal partials (AggregatingMergeTree). The scorer merges a
+-- few hundred of these rows with uniqMerge/countMerge instead of re-scanning
+-- 90 days of raw bgp_events. Each view below fills only its own columns; the
+-- others default to empty states and combine on merge.
+CREATE TABLE IF NOT EXISTS asn_signal_daily (
+    date Date,
+    asn UInt32,
+    upstreams AggregateFunction(uniq, UInt32),
+    prefixes AggregateFunction(uniq, String),
+    transit_hops AggregateFunction(count),
+    blackholes AggregateFunction(count)
+) ENGINE = AggregatingMergeTree()
+PARTITION BY toYYYYMM(date)
+ORDER BY (asn, date)
+TTL date + INTERVAL 90 DAY DELETE;
+
+-- Distinct upstreams and originated prefixes, keyed on the origin ASN
+CREATE MATERIALIZED VIEW IF NOT EXISTS asn_signal_announce_mv TO asn_signal_daily AS
+SELECT
+    toDate(timestamp) as date,
+    asn,
+    uniqState(upstream_as) as upstreams,
+    uniqState(prefix) as prefixes
+FROM bgp_events
+WHERE event_type = 'announce'
+GROUP BY date, asn;
+
+-- Transit appearances: one per event for every distinct non-origin hop
+CREATE MATERIALIZED VIEW IF NOT EXISTS asn_signal_transit_mv TO asn_signal_daily AS
+SELECT
+    toDate(timestamp) as date,
+    hop as asn,
+    countState() as transit_hops
+FROM bgp_events
+ARRAY JOIN arrayDistinct(arrayFilter(x -> x != path[length(path)], path)) as hop
+WHERE length(path) > 0
+GROUP BY date, asn;
+
+-- RFC 7999 blackhole community 65535:666 (= 4294902426)
+CREATE MATERIALIZED VIEW IF NOT EXISTS asn_signal_blackhole_mv TO asn_signal_daily AS
+SELECT
+    toDate(timestamp) as date,
+    asn,
+    countState() as blackholes
+FROM bgp_events
+WHERE has(community, 4294902426)
+GROUP BY date, asn;
+
 -- API Request Logging - 30 day retention
 CREATE TABLE IF NOT EXISTS api_requests (
     timestamp DateTime,
@@ -37,5 +37,29 @@ class EngineSettings(BaseSettings):
     )
     circuit_breaker_threshold: int = Field(default=5, ge=1, le=50)
     circuit_breaker_cooldown: int = Field(default=300, ge=30, le=3600)
+    rpki_vrp_path: str = Field(
+        default="",
+        description="VRP export (rpki-client/Routinator JSON or CSV) for local "
+        "RPKI validation; empty = query RIPE Stat",
+    )
+
+    # Materialized EDL feeds
+    edl_thresholds: str = Field(
+        default="49,50,69,89",
+        pattern=r"^\s*\d{1,3}\s*(,\s*\d{1,3}\s*)*$",
+        description="Comma-separated max_score thresholds whose EDL is kept "
+        "precomputed in Redis",
+    )
+
+    # Batch scoring
+    score_batch_size: int = Field(
+        default=500, ge=1, le=10000, description="ASNs per calculate_asn_scores task"
+    )
+    score_drain_max_batches: int = Field(
+        default=20,
+        ge=1,
+        le=1000,
+        description="Max calculate_asn_scores batches per drain_score_queue run",
+    )
 
     model_config = {"env_file": ".env", "env_file_encoding": "utf-8", "extra": "ignore"}
@@ -1,5 +1,8 @@
 # Copyright by Fabrizio Salmi (fabrizio.salmi@gmail.com)
 
+import os
+import csv
+import json
 import time
 import math
 import ipaddress
@@ -7,7 +10,7 @@ import urllib.parse
 import logging
 import threading
 from collections import Counter
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import Optional
 from concurrent.futures import ThreadPoolExecutor
 
@@ -39,6 +42,180 @@ PG_PASS_SAFE = urllib.parse.quote_plus(settings.postgres_password)
 
 ASN_MIN = 1
 ASN_MAX = 4294967295
+# Redis hash read by the API for rank_percentile: field = score, value = count.
+SCORE_HISTOGRAM_KEY = "stats:score_histogram"
+# API workers evict the in-process (L1) entries of ASNs published here.
+CACHE_INVALIDATION_CHANNEL = "cache:invalidate"
+# Score-delta events for the API's /v1/stream firehose: one JSON object per ASN
+# whose score or risk level changed, published with the cache invalidation.
+STREAM_CHANNEL = "events:asn_updates"
+SCORE_COMPONENTS = ("hygiene", "threat", "stability")
+# Per-ASN token the API's cache fills compare before writing (see api/main.py).
+SCORE_GEN_TTL = 86400
+# Materialized EDL feeds, one family of keys per threshold in edl_thresholds:
+# edl:v1:{t}:asns (set), :version (counter) and :log (zset of "{v}:+asn" /
+# "{v}:-asn" members scored by version) that the API diffs for ?since=.
+EDL_KEY_PREFIX = "edl:v1"
+EDL_LOG_VERSIONS = 1000
+EDL_THRESHOLDS = tuple(
+    sorted({int(t) for t in settings.edl_thresholds.split(",") if t.strip()})
+)
+# KEYS: asns set, version, log. ARGV[1] = versions of log to keep, then one
+# "+asn" / "-asn" op per ASN. Only ops that actually change the set are logged
+# (under one new version), so an ASN's logged ops always alternate; a batch
+# with no effective op leaves the version alone.
+EDL_UPDATE_SCRIPT = """
+local changed = {}
+for i = 2, #ARGV do
+    local op = ARGV[i]
+    local n
+    if string.sub(op, 1, 1) == '+' then
+        n = redis.call('SADD', KEYS[1], string.sub(op, 2))
+    else
+        n = redis.call('SREM', KEYS[1], string.sub(op, 2))
+    end
+    if n == 1 then
+        changed[#changed + 1] = op
+    end
+end
+local v = tonumber(redis.call('GET', KEYS[2]) or '0')
+if #changed == 0 and v > 0 then
+    return v
+end
+v = redis.call('INCR', KEYS[2])
+for _, op in ipairs(changed) do
+    redis.call('ZADD', KEYS[3], v, v .. ':' .. op)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', v - tonumber(ARGV[1]))
+return v
+"""
+
+
+def _parse_vrp_asn(value) -> int:
+    """VRP exports write the ASN as 13335 (rpki-client) or "AS13335"
+    (Routinator); accept both."""
+    if isinstance(value, str):
+        value = value.strip().upper().removeprefix("AS")
+    return int(value)
+
+
+def load_vrp_file(path: str) -> list:
+    """Read a Validated ROA Payload export into (asn, prefix, max_length)
+    tuples. Accepts the JSON export of rpki-client / Routinator
+    (``{"roas": [{"asn", "prefix", "maxLength"}, ...]}``) and their CSV export
+    (``ASN,IP Prefix,Max Length[,Trust Anchor[,Expires]]``). Malformed rows are
+    skipped."""
+    with open(path, encoding="utf-8") as f:
+        data = f.read()
+    if data.lstrip().startswith("{"):
+        rows = (
+            (r.get("asn"), r.get("prefix"), r.get("maxLength"))
+            for r in json.loads(data).get("roas", [])
+        )
+    else:
+        rows = (
+            (r[0], r[1], r[2])
+            for r in csv.reader(data.splitlines())
+            if len(r) >= 3 and r[0].strip().upper() != "ASN"
+        )
+    vrps = []
+    for asn, prefix, max_length in rows:
+        try:
+            vrps.append((_parse_vrp_asn(asn), prefix.strip(), int(max_length)))
+        except (AttributeError, TypeError, ValueError):
+            continue
+    return vrps
+
+
+class VrpIndex:
+    """In-memory RFC 6811 origin validation over a VRP set. VRPs are bucketed
+    by (IP version, prefix length) → network int, so validating a route is
+    one dict lookup per VRP prefix length that could cover it (at most 33 for
+    IPv4 / 129 for IPv6, far fewer in practice)."""
+
+    def __init__(self, vrps) -> None:
+        self._by_len = {4: {}, 6: {}}
+        self.size = 0
+        for asn, prefix, max_length in vrps:
+            try:
+                net = ipaddress.ip_network(prefix, strict=False)
+            except ValueError:
+                continue
+            bucket = self._by_len[net.version].setdefault(net.prefixlen, {})
+            bucket.setdefault(int(net.network_address), []).append((asn, max_length))
+            self.size += 1
+        self._lengths = {v: sorted(b) for v, b in self._by_len.items()}
+
+    def validate(self, asn: int, prefix: str) -> str:
+        """RPKI state of a route, named like RIPE Stat's rpki-validation so
+        _rpki_percentages treats both sources alike: 'valid', 'invalid_asn'
+        (covered, but no VRP for this origin), 'invalid_length' (origin
+        matches, prefix longer than maxLength) or 'unknown' (not covered, or
+        not a parseable prefix)."""
+        try:
+            net = ipaddress.ip_network(prefix, strict=False)
+        except ValueError:
+            return "unknown"
+        addr = int(net.network_address)
+        bits = net.max_prefixlen
+        covered = origin_match = False
+        for length in self._lengths[net.version]:
+            if length > net.prefixlen:
+                break
+            mask = ((1 << length) - 1) << (bits - length)
+            for vrp_asn, max_length in self._by_len[net.version][length].get(
+                addr & mask, ()
+            ):
+                covered = True
+                # AS0 VRPs (RFC 7607) never match an origin
+                if vrp_asn == asn and vrp_asn != 0:
+                    if net.prefixlen <= max_length:
+                        return "valid"
+                    origin_match = True
+        if not covered:
+            return "unknown"
+        return "invalid_length" if origin_match else "invalid_asn"
+
+
+class VrpSnapshot:
+    """The VRP file at ``path`` as a lazily (re)loaded VrpIndex. The file's
+    mtime is checked on every access and the index rebuilt when it changes, so
+    a validator cron that rewrites the export is picked up without a restart.
+    A failed reload keeps serving the previous index."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._index: Optional[VrpIndex] = None
+
+    def current(self) -> Optional[VrpIndex]:
+        if not self.path:
+            return None
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as e:
+            logger.warning(
+                "vrp_snapshot_unavailable", extra={"path": self.path, "error": str(e)}
+            )
+            return self._index
+        if mtime == self._mtime:
+            return self._index
+        with self._lock:
+            if mtime != self._mtime:
+                try:
+                    self._index = VrpIndex(load_vrp_file(self.path))
+                    logger.info(
+                        "vrp_snapshot_loaded",
+                        extra={"path": self.path, "vrps": self._index.size},
+                    )
+                except Exception as e:
+                    logger.warning(
+                        "vrp_snapshot_load_failed",
+                        extra={"path": self.path, "error": str(e)},
+                    )
+                self._mtime = mtime
+        return self._index
 
 
 class RiskScorer:
@@ -60,6 +237,7 @@ class RiskScorer:
         self.executor = ThreadPoolExecutor(max_workers=5)
         self._cb_lock = threading.Lock()
         self._cb_state = {"failures": 0, "last_failure": 0, "open": False}
+        self.vrp_snapshot = VrpSnapshot(settings.rpki_vrp_path)
 
     def calculate_score(self, asn: int, trace_id: str = "") -> int:
         """Orchestrates the scoring process for a single ASN."""
@@ -72,15 +250,17 @@ class RiskScorer:
 
         if self._check_whitelist(asn):
             logger.info("scoring_skip", extra={**extra, "reason": "whitelisted"})
-            self._save_score(
+            events = self._save_score(
                 asn, 100, {"hygiene": 0, "threat": 0, "stability": 0}, "LOW"
             )
+            self._invalidate_cache(asn, events)
             return 100
 
         signals = dict(self._get_or_create_signals(asn))
         derived = self._derive_signals_from_events(asn)  # threat intel
-        derived.update(self._derive_bgp_signals(asn))  # bogon + stub-transit
-        derived.update(self._derive_rpki(asn))  # RPKI validity (cached)
+        prefixes = self._get_originated_prefixes(asn, None)
+        derived.update(self._derive_bgp_signals(asn, prefixes))  # bogon, transit
+        derived.update(self._derive_rpki(asn, prefixes))  # RPKI validity (cached)
         if derived:
             signals.update(derived)
             self._persist_derived_signals(asn, derived)
@@ -88,20 +268,418 @@ class RiskScorer:
         final_score, breakdown, details, risk_level = self._apply_scoring_rules(
             signals, temporal_metrics
         )
-        self._save_score(asn, final_score, breakdown, risk_level, temporal_metrics)
+        events = self._save_score(
+            asn, final_score, breakdown, risk_level, temporal_metrics
+        )
 
-        # Invalidate API cache for this ASN
-        self._invalidate_cache(asn)
+        # Invalidate API cache for this ASN and announce the change
+        self._invalidate_cache(asn, events)
 
         return final_score
 
-    def _invalidate_cache(self, asn: int) -> None:
+    def calculate_scores(self, asns: list[int], trace_id: str = "") -> dict[int, int]:
+        """Batch counterpart of calculate_score(). Every ClickHouse metric family
+        is fetched with ONE `GROUP BY asn` query for the whole batch and every
+        Postgres table is touched with one round-trip, instead of ~20 queries
+        per ASN. Invalid ASNs are logged and skipped (not fatal for the batch).
+        Returns {asn: final_score}."""
+        batch = []
+        for asn in dict.fromkeys(asns):
+            if ASN_MIN <= asn <= ASN_MAX:
+                batch.append(asn)
+            else:
+                logger.warning("invalid_asn", extra={"asn": asn, "trace_id": trace_id})
+        if not batch:
+            return {}
+        logger.info(
+            "batch_scoring_start", extra={"asns": len(batch), "trace_id": trace_id}
+        )
+
+        whitelisted = self._whitelisted(batch)
+        to_score = [a for a in batch if a not in whitelisted]
+        results = [
+            (asn, 100, {"hygiene": 0, "threat": 0, "stability": 0}, "LOW", None)
+            for asn in batch
+            if asn in whitelisted
+        ]
+
+        if to_score:
+            signals_by_asn = self._get_or_create_signals_batch(to_score)
+            fam = self._fetch_metric_families(to_score)
+            neighbours = {
+                n
+                for asn in to_score
+                for n in fam["upstreams"].get(asn, []) + fam["downstreams"].get(asn, [])
+            }
+            registry = self._registry_rows(set(to_score) | neighbours)
+            self._submit_enrichment(
+                [
+                    a
+                    for a in to_score
+                    if registry.get(a, (None, 0))[0] in (None, "Unknown")
+                ]
+            )
+
+            derived_by_asn = {}
+            for asn in to_score:
+                derived = {}
+                if fam["threats"] is not None:
+                    derived.update(self._threat_signals(fam["threats"].get(asn, {})))
+                name = registry.get(asn, (None, 0))[0]
+                if name and name != "Unknown":
+                    derived["whois_entropy"] = self._shannon_entropy(name)
+                prefixes = fam["prefixes"].get(asn)
+                if prefixes:
+                    derived.update(
+                        self._bgp_signals(
+                            prefixes,
+                            fam["transit"].get(asn, 0),
+                            fam["bgp"].get(asn, {}).get("originated_30d", 0),
+                            fam["threats_spam"].get(asn, 0),
+                        )
+                    )
+                # VRP index (over the prefixes above) or Redis-cached RIPE Stat
+                derived.update(self._derive_rpki(asn, prefixes or []))
+                derived_by_asn[asn] = derived
+            self._persist_derived_signals_batch(derived_by_asn)
+
+            for asn in to_score:
+                signals = dict(signals_by_asn.get(asn, self._DEFAULT_SIGNALS))
+                signals.update(derived_by_asn[asn])
+                temporal = self._temporal_from_families(asn, fam, registry)
+                final_score, breakdown, _details, risk_level = (
+                    self._apply_scoring_rules(signals, temporal)
+                )
+                results.append((asn, final_score, breakdown, risk_level, temporal))
+
+        events = self._save_scores(results)
+        self._invalidate_caches([r[0] for r in results], events)
+        logger.info(
+            "batch_scoring_complete",
+            extra={
+                "asns": len(results),
+                "whitelisted": len(whitelisted),
+                "trace_id": trace_id,
+            },
+        )
+        return {r[0]: r[1] for r in results}
+
+    def registry_asns(self) -> list[int]:
+        """Every registered ASN, least recently scored first — the feed for a
+        full re-score through calculate_scores()."""
+        with self.pg_engine.connect() as conn:
+            rows = conn.execute(
+                text(
+                    "SELECT asn FROM asn_registry ORDER BY last_scored_at ASC NULLS FIRST"
+                )
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def _invalidate_cache(self, asn: int, events: Optional[list] = None) -> None:
         """Bust the API response cache after score update."""
+        self._invalidate_caches([asn], events)
+
+    def _invalidate_caches(
+        self, asns: list[int], events: Optional[list] = None
+    ) -> None:
+        """Bust the API response cache of a whole batch: one DEL for the shared
+        Redis entries plus one PUBLISH so every API worker drops its L1 copy,
+        in a single round trip. Score-delta `events` from _save_scores() go
+        out on STREAM_CHANNEL in the same flush, after the invalidation, so a
+        subscriber reacting to one never reads the superseded card."""
+        if not asns:
+            return
         try:
-            self.redis_client.delete(f"score:v3:{asn}")
+            pipe = self.redis_client.pipeline(transaction=False)
+            # New fill generation first: an API fill that read Postgres before
+            # this score was committed then cannot write its card back.
+            for asn in asns:
+                pipe.set(f"score:gen:{asn}", os.urandom(8).hex(), ex=SCORE_GEN_TTL)
+            pipe.delete(*(f"score:v4:{asn}" for asn in asns))
+            pipe.publish(CACHE_INVALIDATION_CHANNEL, json.dumps(list(asns)))
+            for event in events or ():
+                pipe.publish(STREAM_CHANNEL, json.dumps(event))
+            pipe.execute()
         except Exception as e:
             logger.warning(
-                "cache_invalidation_failed", extra={"asn": asn, "error": str(e)}
+                "cache_invalidation_failed", extra={"asns": len(asns), "error": str(e)}
+            )
+
+    # --- Batch scoring: one query per metric family / Postgres table ---
+
+    def _ch_rows(self, query: str, params: dict) -> Optional[list]:
+        """Like _ch_scalar() for multi-row family queries: None on failure so the
+        caller can leave the family's signals untouched instead of zeroing them."""
+        try:
+            return self.ch_client.execute(query, params)
+        except Exception as e:
+            logger.error("ch_query_error", extra={"query": query[:80], "error": str(e)})
+            return None
+
+    def _fetch_metric_families(self, asns: list[int]) -> dict:
+        """Run each ClickHouse metric family once for the whole batch.
+
+        Returns a dict of per-family maps keyed by ASN. `threats` is None when
+        its query failed (threat signals are then left as stored, exactly like
+        the single path); every other family degrades to "no data"."""
+        params = {
+            "asns": tuple(asns),
+            "days": self.PREFIX_LOOKBACK_DAYS,
+            "tdays": self.THREAT_SIGNAL_WINDOW_DAYS,
+            "ups": self.UPSTREAM_SAMPLE,
+            "downs": self.DOWNSTREAM_SAMPLE,
+        }
+        fam: dict = {}
+
+        # asn_signal_daily rollup: churn, prefix counts, blackholes, transit.
+        rows = self._ch_rows(
+            f"""SELECT asn, {self._ROLLUP_AGGREGATES}
+               FROM asn_signal_daily
+               WHERE asn IN %(asns)s AND date > today() - 90
+               GROUP BY asn""",
+            params,
+        )
+        fam["bgp"] = {
+            r[0]: {
+                "upstream_churn_90d": r[1],
+                "current_prefix_count": r[2],
+                "ddos_blackhole_count": r[3],
+                "originated_30d": r[4],
+            }
+            for r in rows or []
+        }
+        fam["transit"] = {r[0]: r[5] for r in rows or [] if r[5]}
+
+        # bgp_events, keyed on the origin ASN (its busiest first hops).
+        rows = self._ch_rows(
+            """SELECT asn, topK(%(ups)s)(upstream_as) FROM bgp_events
+               WHERE asn IN %(asns)s AND upstream_as != 0
+               AND timestamp > now() - INTERVAL 30 DAY
+               GROUP BY asn""",
+            params,
+        )
+        fam["upstreams"] = {r[0]: list(r[1]) for r in rows or []}
+
+        # bgp_events, keyed on the upstream ASN (who uses us as first hop).
+        rows = self._ch_rows(
+            """SELECT upstream_as, topK(%(downs)s)(asn) FROM bgp_events
+               WHERE upstream_as IN %(asns)s AND timestamp > now() - INTERVAL 30 DAY
+               GROUP BY upstream_as""",
+            params,
+        )
+        fam["downstreams"] = {r[0]: list(r[1]) for r in rows or []}
+
+        # Every prefix each origin announced in the lookback window, busiest
+        # first like _get_originated_prefixes (the RIPE RPKI sample takes the head).
+        rows = self._ch_rows(
+            """SELECT asn, prefix, count() AS n FROM bgp_events
+               WHERE asn IN %(asns)s AND event_type = 'announce'
+               AND timestamp > now() - INTERVAL %(days)s DAY
+               GROUP BY asn, prefix ORDER BY n DESC""",
+            params,
+        )
+        fam["prefixes"] = {}
+        for asn, prefix, _n in rows or []:
+            fam["prefixes"].setdefault(asn, []).append(prefix)
+
+        # threat_events: category breakdown (threat signals, recidivism, spam).
+        rows = self._ch_rows(
+            """SELECT asn, category, uniqExact(target_ip) AS ips, count() AS n
+               FROM threat_events
+               WHERE asn IN %(asns)s AND timestamp > now() - INTERVAL %(tdays)s DAY
+               GROUP BY asn, category""",
+            params,
+        )
+        fam["threats"] = None if rows is None else {}
+        fam["threats_spam"] = {}
+        for asn, category, ips, n in rows or []:
+            fam["threats"].setdefault(asn, {})[category] = {"ips": ips, "n": n}
+            if category == "spamhaus":
+                fam["threats_spam"][asn] = ips
+
+        # Daily rollups: 7-day withdrawals and the oracle's 14-day event counts.
+        rows = self._ch_rows(
+            """SELECT asn, sumIf(w, date > today() - 7), groupArrayIf(n, n > 0)
+               FROM (
+                   SELECT asn, date, sum(withdraw_count) AS w, sum(total_events) AS n
+                   FROM daily_metrics
+                   WHERE asn IN %(asns)s AND date > today() - 14
+                   GROUP BY asn, date)
+               GROUP BY asn""",
+            params,
+        )
+        fam["withdrawals"] = {r[0]: r[1] for r in rows or []}
+        for asn, _w, daily in rows or []:
+            fam["bgp"].setdefault(asn, {})["daily_counts"] = list(daily)
+        rows = self._ch_rows(
+            """SELECT asn, sum(prepends_count) FROM forensic_metrics
+               WHERE asn IN %(asns)s AND date > now() - INTERVAL 7 DAY
+               GROUP BY asn""",
+            params,
+        )
+        fam["prepends"] = {r[0]: r[1] for r in rows or []}
+        return fam
+
+    def _temporal_from_families(self, asn: int, fam: dict, registry: dict) -> dict:
+        """Assemble one ASN's temporal-metrics dict (same shape as
+        _calculate_temporal_metrics) from the batch families."""
+
+        def neighbour_scores(key: str) -> list:
+            return [registry[n][1] for n in fam[key].get(asn, []) if n in registry]
+
+        threats = (fam["threats"] or {}).get(asn, {})
+        return self._temporal_metrics(
+            fam["bgp"].get(asn, {}),
+            recent_withdrawals=fam["withdrawals"].get(asn, 0),
+            recent_threat_count=sum(c["n"] for c in threats.values()),
+            excessive_prepending_count=fam["prepends"].get(asn, 0),
+            upstream_scores=neighbour_scores("upstreams"),
+            downstream_scores=neighbour_scores("downstreams"),
+        )
+
+    def _temporal_metrics(
+        self,
+        bgp: dict,
+        recent_withdrawals: int,
+        recent_threat_count: int,
+        excessive_prepending_count: int,
+        upstream_scores: list,
+        downstream_scores: list,
+    ) -> dict:
+        """Shared tail of the single and batch paths: `bgp` carries the
+        bgp_events aggregates (churn, prefix count, blackholes, daily counts)."""
+        daily = bgp.get("daily_counts") or []
+        is_predictive_unstable = False
+        if daily:
+            mean_daily = sum(daily) / len(daily)
+            std_dev = math.sqrt(sum((c - mean_daily) ** 2 for c in daily) / len(daily))
+            is_predictive_unstable = self._is_predictive_unstable(mean_daily, std_dev)
+
+        current_prefix_count = bgp.get("current_prefix_count", 0)
+        return {
+            "upstream_churn_90d": bgp.get("upstream_churn_90d", 0),
+            "recent_withdrawals": recent_withdrawals or 0,
+            "current_prefix_count": current_prefix_count,
+            "recent_threat_count": recent_threat_count or 0,
+            "avg_upstream_score": self._mean_score(upstream_scores),
+            "is_predictive_unstable": is_predictive_unstable,
+            "downstream_score": self._mean_score(downstream_scores),
+            "zombie_status": current_prefix_count == 0,
+            "ddos_blackhole_count": bgp.get("ddos_blackhole_count", 0),
+            "excessive_prepending_count": excessive_prepending_count or 0,
+        }
+
+    def _whitelisted(self, asns: list[int]) -> set[int]:
+        try:
+            with self.pg_engine.connect() as conn:
+                rows = conn.execute(
+                    text("SELECT asn FROM asn_whitelist WHERE asn = ANY(:asns)"),
+                    {"asns": list(asns)},
+                ).fetchall()
+            return {r[0] for r in rows}
+        except Exception as e:
+            logger.error(
+                "whitelist_check_failed", extra={"asns": len(asns), "error": str(e)}
+            )
+            return set()
+
+    def _registry_rows(self, asns: set[int]) -> dict[int, tuple]:
+        """{asn: (name, total_score)} for the batch plus its neighbours."""
+        if not asns:
+            return {}
+        with self.pg_engine.connect() as conn:
+            rows = conn.execute(
+                text(
+                    "SELECT asn, name, total_score FROM asn_registry WHERE asn = ANY(:asns)"
+                ),
+                {"asns": list(asns)},
+            ).fetchall()
+        return {r[0]: (r[1], r[2]) for r in rows}
+
+    def _submit_enrichment(self, asns: list[int]) -> None:
+        for asn in asns:
+            self.executor.submit(self._run_enrichment, asn)
+
+    def _get_or_create_signals_batch(self, asns: list[int]) -> dict[int, dict]:
+        """Batch _get_or_create_signals: one SELECT, then create the registry and
+        signal rows of every ASN seen for the first time with insert-time
+        defaults."""
+        with self.pg_engine.connect() as conn:
+            rows = (
+                conn.execute(
+                    text("SELECT * FROM asn_signals WHERE asn = ANY(:asns)"),
+                    {"asns": list(asns)},
+                )
+                .mappings()
+                .fetchall()
+            )
+            found = {r["asn"]: r for r in rows}
+            missing = [a for a in asns if a not in found]
+            if missing:
+                conn.execute(
+                    text("""
+                    INSERT INTO asn_registry (asn, total_score)
+                    SELECT a, 100 FROM unnest(CAST(:asns AS BIGINT[])) AS a
+                    ON CONFLICT DO NOTHING
+                """),
+                    {"asns": missing},
+                )
+                conn.execute(
+                    text("""
+                    INSERT INTO asn_signals (
+                        asn, rpki_invalid_percent, rpki_unknown_percent,
+                        has_route_leaks, has_bogon_ads, prefix_granularity_score,
+                        is_stub_but_transit, spamhaus_listed, spam_emission_rate,
+                        botnet_c2_count, phishing_hosting_count, malware_distribution_count,
+                        has_peeringdb_profile, upstream_tier1_count, is_whois_private
+                    )
+                    SELECT a, 0.0, 0.0,
+                        FALSE, FALSE, 0,
+                        FALSE, FALSE, 0.0,
+                        0, 0, 0,
+                        TRUE, 1, FALSE
+                    FROM unnest(CAST(:asns AS BIGINT[])) AS a
+                    ON CONFLICT DO NOTHING
+                """),
+                    {"asns": missing},
+                )
+                conn.commit()
+        return found
+
+    def _persist_derived_signals_batch(self, derived_by_asn: dict[int, dict]) -> None:
+        """Batch _persist_derived_signals: ASNs are grouped by which derived
+        columns they carry (e.g. RPKI absent for some) and each group is written
+        with a single UPDATE ... FROM unnest()."""
+        groups: dict[tuple, list[int]] = {}
+        for asn, derived in derived_by_asn.items():
+            cols = tuple(c for c in self._DERIVED_COLUMNS if c in derived)
+            if cols:
+                groups.setdefault(cols, []).append(asn)
+        if not groups:
+            return
+        try:
+            with self.pg_engine.connect() as conn:
+                for cols, group in groups.items():
+                    set_clause = ", ".join(f"{c} = v.{c}" for c in cols)
+                    arrays = ", ".join(
+                        f"CAST(:{c} AS {self._DERIVED_COLUMNS[c]}[])" for c in cols
+                    )
+                    params = {c: [derived_by_asn[a][c] for a in group] for c in cols}
+                    params["asn"] = group
+                    conn.execute(
+                        text(f"""
+                        UPDATE asn_signals AS s SET {set_clause}
+                        FROM unnest(CAST(:asn AS BIGINT[]), {arrays})
+                            AS v(asn, {", ".join(cols)})
+                        WHERE s.asn = v.asn
+                    """),
+                        params,
+                    )
+                conn.commit()
+        except Exception as e:
+            logger.warning(
+                "signal_persist_failed",
+                extra={"asns": len(derived_by_asn), "error": str(e)},
             )
 
     def _get_or_create_signals(self, asn: int) -> dict:
@@ -137,48 +715,69 @@ class RiskScorer:
                     {"asn": asn},
                 )
                 conn.commit()
-                return {
-                    "rpki_invalid_percent": 0.0,
-                    "rpki_unknown_percent": 0.0,
-                    "has_route_leaks": False,
-                    "has_bogon_ads": False,
-                    "prefix_granularity_score": 0,
-                    "is_stub_but_transit": False,
-                    "spamhaus_listed": False,
-                    "spam_emission_rate": 0.0,
-                    "botnet_c2_count": 0,
-                    "phishing_hosting_count": 0,
-                    "malware_distribution_count": 0,
-                    "has_peeringdb_profile": True,
-                    "upstream_tier1_count": 1,
-                    "is_whois_private": False,
-                }
+                return dict(self._DEFAULT_SIGNALS)
             return result
 
     # How far back detections feed the discrete threat signals.
     THREAT_SIGNAL_WINDOW_DAYS = 30
     # BGP-derived signals
     PREFIX_LOOKBACK_DAYS = 7
-    PREFIX_SCAN_LIMIT = 200
     STUB_MAX_ORIGINATED_PREFIXES = 5
-    # RPKI validation (external, cached)
+    # RPKI validation (local VRP snapshot, else RIPE Stat: external, cached)
     RPKI_CACHE_TTL = 21600  # 6h
     RPKI_MAX_PREFIXES = 8
 
-    # Columns this class is allowed to materialize into asn_signals. Used both to
-    # build the partial UPDATE and to keep it injection-safe (keys are code-owned).
-    _DERIVED_COLUMNS = (
-        "spamhaus_listed",
-        "malware_distribution_count",
-        "has_route_leaks",
-        "has_bogon_ads",
-        "is_stub_but_transit",
-        "prefix_granularity_score",
-        "spam_emission_rate",
-        "whois_entropy",
-        "rpki_invalid_percent",
-        "rpki_unknown_percent",
-    )
+    # Neighbourhood: top-N upstreams / downstreams (by event count) averaged.
+    UPSTREAM_SAMPLE = 3
+    DOWNSTREAM_SAMPLE = 20
+
+    # Merged windows over the asn_signal_daily rollup, in order: upstream churn
+    # 90d, prefixes 2d, blackholes 7d, originated prefixes 30d, transit
+    # appearances 30d. Windows are calendar days ending today (`date > today()
+    # - N` is today plus the N-1 previous days), except the prefix count behind
+    # zombie_status: it also takes the day before, so it always spans at least
+    # the last 48 hours and an ASN announcing every other day is not a zombie.
+    # Callers filter date > today() - 90.
+    _ROLLUP_AGGREGATES = """uniqMergeIf(upstreams, date > today() - 90),
+           uniqMergeIf(prefixes, date >= today() - 2),
+           countMergeIf(blackholes, date > today() - 7),
+           uniqMergeIf(prefixes, date > today() - 30),
+           countMergeIf(transit_hops, date > today() - 30)"""
+
+    # Columns this class is allowed to materialize into asn_signals, mapped to
+    # their Postgres type (used to cast the unnest() arrays of the batch UPDATE).
+    # Used both to build the partial UPDATE and to keep it injection-safe (keys
+    # are code-owned).
+    _DERIVED_COLUMNS = {
+        "spamhaus_listed": "BOOLEAN",
+        "malware_distribution_count": "INTEGER",
+        "has_route_leaks": "BOOLEAN",
+        "has_bogon_ads": "BOOLEAN",
+        "is_stub_but_transit": "BOOLEAN",
+        "prefix_granularity_score": "INTEGER",
+        "spam_emission_rate": "NUMERIC",
+        "whois_entropy": "NUMERIC",
+        "rpki_invalid_percent": "NUMERIC",
+        "rpki_unknown_percent": "NUMERIC",
+    }
+
+    # Insert-time defaults of a freshly created asn_signals row.
+    _DEFAULT_SIGNALS = {
+        "rpki_invalid_percent": 0.0,
+        "rpki_unknown_percent": 0.0,
+        "has_route_leaks": False,
+        "has_bogon_ads": False,
+        "prefix_granularity_score": 0,
+        "is_stub_but_transit": False,
+        "spamhaus_listed": False,
+        "spam_emission_rate": 0.0,
+        "botnet_c2_count": 0,
+        "phishing_hosting_count": 0,
+        "malware_distribution_count": 0,
+        "has_peeringdb_profile": True,
+        "upstream_tier1_count": 1,
+        "is_whois_private": False,
+    }
 
     def _derive_signals_from_events(self, asn: int) -> dict:
         """Materialize discrete threat signals in Postgres from the detection
@@ -205,20 +804,28 @@ class RiskScorer:
             return {}
 
         by_cat = {row[0]: {"ips": row[1], "n": row[2]} for row in rows}
+        return self._threat_signals(by_cat)
+
+    @staticmethod
+    def _threat_signals(by_cat: dict) -> dict:
+        """Map per-category detection counts ({category: {"ips", "n"}}) onto the
+        discrete threat signals. Shared by the single and batch scoring paths."""
         return {
             "spamhaus_listed": by_cat.get("spamhaus", {}).get("n", 0) > 0,
             "malware_distribution_count": int(by_cat.get("malware", {}).get("ips", 0)),
             "has_route_leaks": by_cat.get("route_leak", {}).get("n", 0) > 0,
         }
 
-    def _get_originated_prefixes(self, asn: int, limit: int) -> list:
-        """Distinct prefixes this ASN originated (was last hop for) recently."""
+    def _get_originated_prefixes(self, asn: int, limit: Optional[int]) -> list:
+        """Distinct prefixes this ASN originated (was last hop for) recently,
+        busiest first; ``limit=None`` returns all of them."""
         try:
             rows = self.ch_client.execute(
                 """SELECT prefix, count() AS n FROM bgp_events
                    WHERE asn = %(asn)s AND event_type = 'announce'
                    AND timestamp > now() - INTERVAL %(days)s DAY
-                   GROUP BY prefix ORDER BY n DESC LIMIT %(lim)s""",
+                   GROUP BY prefix ORDER BY n DESC"""
+                + (" LIMIT %(lim)s" if limit is not None else ""),
                 {"asn": asn, "days": self.PREFIX_LOOKBACK_DAYS, "lim": limit},
             )
             return [r[0] for r in rows]
@@ -269,27 +876,34 @@ class RiskScorer:
     def _prefix_granularity(prefixes: list) -> int:
         """Percentage (0-100) of the ASN's own prefixes that are more-specifics
         of another prefix it also announces — i.e. self de-aggregation. 0 when
-        there is nothing to score. Penalised above 50."""
-        nets = []
+        there is nothing to score. Penalised above 50.
+
+        Sort-and-sweep in O(n log n): each prefix becomes an integer range
+        [first, last] per IP version; sorted by (first, prefixlen), a covering
+        prefix always precedes its more-specifics, and since CIDR ranges either
+        nest or are disjoint a stack of the open enclosing ranges is enough."""
+        counts: Counter = Counter()
         for p in prefixes:
             try:
-                nets.append(ipaddress.ip_network(p, strict=False))
+                net = ipaddress.ip_network(p, strict=False)
             except ValueError:
                 continue
-        if not nets:
+            first = int(net.network_address)
+            last = first | ((1 << (net.max_prefixlen - net.prefixlen)) - 1)
+            counts[(net.version, first, net.prefixlen, last)] += 1
+        if not counts:
             return 0
         covered = 0
-        for a in nets:
-            for b in nets:
-                if (
-                    a != b
-                    and a.version == b.version
-                    and a.prefixlen > b.prefixlen
-                    and a.subnet_of(b)
-                ):
-                    covered += 1
-                    break
-        return round(100 * covered / len(nets))
+        stack: list = []  # (version, last) of the enclosing ranges, outermost first
+        for key in sorted(counts):
+            version, first, _plen, last = key
+            while stack and (stack[-1][0] != version or stack[-1][1] < first):
+                stack.pop()
+            if stack:
+                # distinct and enclosed → a strictly shorter covering prefix
+                covered += counts[key]
+            stack.append((version, last))
+        return round(100 * covered / sum(counts.values()))
 
     def _whois_entropy(self, asn: int):
         """Entropy of the ASN's holder name (populated by enrichment). Returns
@@ -307,41 +921,30 @@ class RiskScorer:
             return None
         return self._shannon_entropy(name)
 
-    def _derive_bgp_signals(self, asn: int) -> dict:
+    def _derive_bgp_signals(self, asn: int, prefixes: list) -> dict:
         """Derive routing-hygiene / identity signals from the local BGP view in
         ClickHouse plus the enriched holder name — no fabricated data:
         has_bogon_ads, is_stub_but_transit, prefix_granularity_score,
-        spam_emission_rate (fraction of prefixes on Spamhaus), whois_entropy."""
+        spam_emission_rate (fraction of prefixes on Spamhaus), whois_entropy.
+        `prefixes` is the ASN's originated set (_get_originated_prefixes)."""
         derived = {}
         entropy = self._whois_entropy(asn)
         if entropy is not None:
             derived["whois_entropy"] = entropy
 
-        prefixes = self._get_originated_prefixes(asn, self.PREFIX_SCAN_LIMIT)
         if not prefixes:
             return derived
 
-        derived["has_bogon_ads"] = any(self._is_bogon(p) for p in prefixes)
-        derived["prefix_granularity_score"] = self._prefix_granularity(prefixes)
-
-        # transit_hops: events where this ASN is in the path but NOT the origin.
-        transit_hops = self._ch_scalar(
-            """SELECT count() FROM bgp_events
-               WHERE has(path, %(asn)s) AND length(path) > 0
-               AND path[length(path)] != %(asn)s
-               AND timestamp > now() - INTERVAL 30 DAY""",
-            {"asn": asn},
-        )
-        originated_30d = self._ch_scalar(
-            """SELECT uniqExact(prefix) FROM bgp_events
-               WHERE asn = %(asn)s AND event_type = 'announce'
-               AND timestamp > now() - INTERVAL 30 DAY""",
+        # transit_hops (path appearances other than as origin) and 30-day
+        # originated prefixes, merged from the asn_signal_daily rollup.
+        originated_30d, transit_hops = 0, 0
+        rows = self._ch_rows(
+            f"""SELECT {self._ROLLUP_AGGREGATES} FROM asn_signal_daily
+               WHERE asn = %(asn)s AND date > today() - 90""",
             {"asn": asn},
         )
-        derived["is_stub_but_transit"] = self._classify_stub_transit(
-            transit_hops, originated_30d
-        )
-
+        if rows:
+            originated_30d, transit_hops = rows[0][3], rows[0][4]
         # spam_emission_rate: fraction of the ASN's prefixes flagged by Spamhaus.
         spam_flagged = self._ch_scalar(
             """SELECT uniqExact(target_ip) FROM threat_events
@@ -349,6 +952,25 @@ class RiskScorer:
                AND timestamp > now() - INTERVAL 30 DAY""",
             {"asn": asn},
         )
+        derived.update(
+            self._bgp_signals(prefixes, transit_hops, originated_30d, spam_flagged)
+        )
+        return derived
+
+    @classmethod
+    def _bgp_signals(
+        cls, prefixes: list, transit_hops: int, originated_30d: int, spam_flagged: int
+    ) -> dict:
+        """Turn the raw BGP-view counts of one ASN into routing-hygiene signals.
+        Shared by the single and batch scoring paths; `prefixes` must be
+        non-empty (callers skip ASNs with no originated prefixes)."""
+        derived = {
+            "has_bogon_ads": any(cls._is_bogon(p) for p in prefixes),
+            "prefix_granularity_score": cls._prefix_granularity(prefixes),
+            "is_stub_but_transit": cls._classify_stub_transit(
+                transit_hops, originated_30d
+            ),
+        }
         total_prefixes = originated_30d or len(prefixes)
         if total_prefixes > 0:
             derived["spam_emission_rate"] = round(
@@ -371,10 +993,19 @@ class RiskScorer:
         unknown = total - invalid - valid
         return round(invalid / total * 100, 2), round(unknown / total * 100, 2)
 
-    def _derive_rpki(self, asn: int) -> dict:
-        """Validate the ASN's prefixes against RPKI via RIPE Stat and compute
-        invalid/unknown percentages. Cached in Redis (6h) and gated by the same
+    def _derive_rpki(self, asn: int, prefixes: Optional[list] = None) -> dict:
+        """Validate the ASN's prefixes against RPKI and compute invalid/unknown
+        percentages. `prefixes`, when the caller already fetched them, are the
+        originated prefixes busiest first. With a VRP snapshot configured every
+        one is validated locally; otherwise the RPKI_MAX_PREFIXES busiest are
+        checked via RIPE Stat, cached in Redis (6h) and gated by the same
         circuit breaker as enrichment so a RIPE outage can't stall scoring."""
+        vrps = self.vrp_snapshot.current()
+        if vrps is not None:
+            if prefixes is None:
+                prefixes = self._get_originated_prefixes(asn, None)
+            return self._derive_rpki_local(asn, vrps, prefixes)
+
         cache_key = f"rpki:v1:{asn}"
         try:
             cached = self.redis_client.get(cache_key)
@@ -397,7 +1028,9 @@ class RiskScorer:
                 self._cb_state["open"] = False
                 self._cb_state["failures"] = 0
 
-        prefixes = self._get_originated_prefixes(asn, self.RPKI_MAX_PREFIXES)
+        if prefixes is None:
+            prefixes = self._get_originated_prefixes(asn, self.RPKI_MAX_PREFIXES)
+        prefixes = prefixes[: self.RPKI_MAX_PREFIXES]
         if not prefixes:
             return {}
 
@@ -442,6 +1075,14 @@ class RiskScorer:
             pass
         return {"rpki_invalid_percent": inv_pct, "rpki_unknown_percent": unk_pct}
 
+    def _derive_rpki_local(self, asn: int, vrps: VrpIndex, prefixes: list) -> dict:
+        """RPKI percentages over all originated `prefixes` from the in-memory
+        VRP index — no network calls, so no cache or circuit breaker."""
+        pct = self._rpki_percentages([vrps.validate(asn, p) for p in prefixes])
+        if pct is None:
+            return {}
+        return {"rpki_invalid_percent": pct[0], "rpki_unknown_percent": pct[1]}
+
     def _persist_derived_signals(self, asn: int, derived: dict) -> None:
         """Write the derived signals back to asn_signals so both the score and
         the API's penalty breakdown reflect them. Handles partial dicts (e.g.
@@ -474,69 +1115,83 @@ class RiskScorer:
             return False
 
     def _calculate_temporal_metrics(self, asn: int) -> dict:
-        params = {"asn": asn}
-
-        upstream_churn_90d = self._ch_scalar(
-            "SELECT uniq(upstream_as) FROM bgp_events WHERE asn = %(asn)s AND event_type = 'announce' AND timestamp > now() - INTERVAL 90 DAY",
-            params,
-        )
-        recent_withdrawals = self._ch_scalar(
-            "SELECT sum(withdraw_count) FROM daily_metrics WHERE asn = %(asn)s AND date > now() - INTERVAL 7 DAY",
-            params,
-        )
-        current_prefix_count = self._ch_scalar(
-            "SELECT uniq(prefix) FROM bgp_events WHERE asn = %(asn)s AND timestamp > now() - INTERVAL 2 DAY",
-            params,
-        )
-        recent_threat_count = self._ch_scalar(
-            "SELECT count(*) FROM threat_events WHERE asn = %(asn)s AND timestamp > now() - INTERVAL 30 DAY",
-            params,
-        )
-
-        upstreams = self.ch_client.execute(
-            """SELECT upstream_as, count(*) as c FROM bgp_events
-            WHERE asn = %(asn)s AND upstream_as != 0 AND timestamp > now() - INTERVAL 30 DAY
-            GROUP BY upstream_as ORDER BY c DESC LIMIT 3""",
-            params,
+        """The temporal metrics of one ASN in a single ClickHouse round-trip.
+
+        Only the neighbour samples still need raw rows: one 30-day bgp_events
+        scan yields top upstreams (`asn = X`) and top downstreams
+        (`upstream_as = X`) as conditional aggregates. Churn, prefix count and
+        blackholes are merged from the asn_signal_daily rollup, the oracle's
+        daily counts come from daily_metrics, and the other rollup tables ride
+        along as scalar subqueries. Both neighbour samples are resolved with
+        one registry lookup.
+
+        This covers the temporal metrics only: calculate_score() still derives
+        signals with their own queries (threat categories, originated
+        prefixes, rollup transit counts, Spamhaus coverage)."""
+        rows = self.ch_client.execute(
+            f"""SELECT
+                   topKIf(%(ups)s)(upstream_as, asn = %(asn)s AND upstream_as != 0),
+                   topKIf(%(downs)s)(asn, upstream_as = %(asn)s),
+                   (SELECT {self._ROLLUP_AGGREGATES} FROM asn_signal_daily
+                    WHERE asn = %(asn)s AND date > today() - 90),
+                   (SELECT groupArray(n) FROM (
+                        SELECT sum(total_events) AS n FROM daily_metrics
+                        WHERE asn = %(asn)s AND date > today() - 14
+                        GROUP BY date HAVING n > 0)),
+                   (SELECT sum(withdraw_count) FROM daily_metrics
+                    WHERE asn = %(asn)s AND date > now() - INTERVAL 7 DAY),
+                   (SELECT count() FROM threat_events
+                    WHERE asn = %(asn)s AND timestamp > now() - INTERVAL 30 DAY),
+                   (SELECT sum(prepends_count) FROM forensic_metrics
+                    WHERE asn = %(asn)s AND date > now() - INTERVAL 7 DAY)
+               FROM bgp_events
+               WHERE (asn = %(asn)s OR upstream_as = %(asn)s)
+               AND timestamp > now() - INTERVAL 30 DAY""",
+            {"asn": asn, "ups": self.UPSTREAM_SAMPLE, "downs": self.DOWNSTREAM_SAMPLE},
         )
+        upstreams, downstreams, rollup, daily, withdrawals, threats, prepends = rows[0]
 
-        avg_upstream_score = 100.0
-        if upstreams:
-            upstream_asns = [u[0] for u in upstreams]
+        registry: dict = {}
+        neighbours = set(upstreams) | set(downstreams)
+        if neighbours:
             with self.pg_engine.connect() as conn:
-                res = conn.execute(
-                    text("SELECT total_score FROM asn_registry WHERE asn = ANY(:asns)"),
-                    {"asns": upstream_asns},
-                ).fetchall()
-                if res:
-                    avg_upstream_score = sum(r[0] for r in res) / len(res)
-
-        oracle_stats = self.ch_client.execute(
-            """SELECT avg(c) as u, stddevPop(c) as s FROM (
-                SELECT toDate(timestamp) as d, count(*) as c FROM bgp_events
-                WHERE asn = %(asn)s AND timestamp > now() - INTERVAL 14 DAY GROUP BY d
-            )""",
-            params,
+                registry = dict(
+                    conn.execute(
+                        text(
+                            "SELECT asn, total_score FROM asn_registry "
+                            "WHERE asn = ANY(:asns)"
+                        ),
+                        {"asns": sorted(neighbours)},
+                    ).fetchall()
+                )
+
+        return self._temporal_metrics(
+            {
+                "upstream_churn_90d": rollup[0],
+                "current_prefix_count": rollup[1],
+                "ddos_blackhole_count": rollup[2],
+                "daily_counts": list(daily),
+            },
+            recent_withdrawals=withdrawals,
+            recent_threat_count=threats,
+            excessive_prepending_count=prepends,
+            upstream_scores=[registry[u] for u in upstreams if u in registry],
+            downstream_scores=[registry[d] for d in downstreams if d in registry],
         )
-        is_predictive_unstable = False
-        if oracle_stats and oracle_stats[0][0]:
-            mean_daily = oracle_stats[0][0]
-            std_dev = oracle_stats[0][1]
-            if mean_daily > 10 and (std_dev / mean_daily) > 1.5:
-                is_predictive_unstable = True
 
-        return {
-            "upstream_churn_90d": upstream_churn_90d,
-            "recent_withdrawals": recent_withdrawals,
-            "current_prefix_count": current_prefix_count,
-            "recent_threat_count": recent_threat_count,
-            "avg_upstream_score": avg_upstream_score,
-            "is_predictive_unstable": is_predictive_unstable,
-            "downstream_score": self._analyze_downstreams(asn),
-            "zombie_status": current_prefix_count == 0,
-            "ddos_blackhole_count": self._analyze_bgp_communities(asn),
-            "excessive_prepending_count": self._analyze_traffic_engineering(asn),
-        }
+    @staticmethod
+    def _is_predictive_unstable(mean_daily: float, std_dev: float) -> bool:
+        """The "oracle": a busy ASN (>10 events/day) whose daily event volume
+        has a coefficient of variation above 1.5 is flagged as likely unstable."""
+        return mean_daily > 10 and (std_dev / mean_daily) > 1.5
+
+    @staticmethod
+    def _mean_score(scores: list, default: float = 100.0) -> float:
+        """Average registry score of a set of neighbours; neighbours we have
+        not scored are simply absent, and an empty set is neutral (100)."""
+        if not scores:
+            return default
+        return sum(scores) / len(scores)
 
     def _ch_scalar(self, query: str, params: dict, default: int = 0) -> int:
         try:
@@ -547,37 +1202,6 @@ class RiskScorer:
             logger.error("ch_query_error", extra={"query": query[:80], "error": str(e)})
         return default
 
-    def _analyze_bgp_communities(self, asn: int) -> int:
-        return self._ch_scalar(
-            "SELECT count() FROM bgp_events WHERE asn = %(asn)s AND timestamp > now() - INTERVAL 7 DAY AND has(community, 4294902426)",
-            {"asn": asn},
-        )
-
-    def _analyze_traffic_engineering(self, asn: int) -> int:
-        return self._ch_scalar(
-            "SELECT sum(prepends_count) FROM forensic_metrics WHERE asn = %(asn)s AND date > now() - INTERVAL 7 DAY",
-            {"asn": asn},
-        )
-
-    def _analyze_downstreams(self, asn: int) -> float:
-        downstreams = self.ch_client.execute(
-            """SELECT asn, count(*) as c FROM bgp_events
-            WHERE upstream_as = %(asn)s AND timestamp > now() - INTERVAL 30 DAY
-            GROUP BY asn ORDER BY c DESC LIMIT 20""",
-            {"asn": asn},
-        )
-        if not downstreams:
-            return 100.0
-        downstream_asns = [d[0] for d in downstreams]
-        with self.pg_engine.connect() as conn:
-            res = conn.execute(
-                text("SELECT total_score FROM asn_registry WHERE asn = ANY(:asns)"),
-                {"asns": downstream_asns},
-            ).fetchall()
-            if not res:
-                return 100.0
-            return sum(r[0] for r in res) / len(res)
-
     def _apply_scoring_rules(self, s: dict, t: dict) -> tuple[int, dict, list, str]:
         score = 100
         breakdown = {"hygiene": 0, "threat": 0, "stability": 0}
@@ -709,133 +1333,315 @@ class RiskScorer:
         breakdown: dict,
         risk_level: str,
         metrics: Optional[dict] = None,
-    ) -> None:
+    ) -> list[dict]:
+        return self._save_scores([(asn, score, breakdown, risk_level, metrics)])
+
+    def _save_scores(self, results: list) -> list[dict]:
+        """Persist a set of (asn, score, breakdown, risk_level, metrics) results:
+        one UPDATE per Postgres table (driven by unnest() arrays) and a single
+        ClickHouse history insert, however many ASNs were scored.
+
+        Returns one score-delta event per ASN whose total score or risk level
+        changed, for _invalidate_caches() to publish on STREAM_CHANNEL."""
+        if not results:
+            return []
         timestamp = datetime.now()
-        downstream_score = 100
-        is_zombie = False
-        ddos_bh = 0
-        excessive_prepend = 0
-
-        if metrics:
-            downstream_score = metrics.get("downstream_score", 100)
-            is_zombie = metrics.get("zombie_status", False)
-            ddos_bh = metrics.get("ddos_blackhole_count", 0)
-            excessive_prepend = metrics.get("excessive_prepending_count", 0)
-
-        # Clamp component scores: base is 100, penalties subtract — floor at 0, cap at 100
-        hygiene_score = max(0, min(100, 100 + breakdown["hygiene"]))
-        threat_score = max(0, min(100, 100 + breakdown["threat"]))
-        stability_score = max(0, min(100, 100 + breakdown["stability"]))
+        cols: dict[str, list] = {
+            k: []
+            for k in ("asn", "score", "h", "t", "s", "lvl", "ds", "zb", "bh", "ep")
+        }
+        for asn, score, breakdown, risk_level, metrics in results:
+            metrics = metrics or {}
+            cols["asn"].append(asn)
+            cols["score"].append(score)
+            # Clamp component scores: base is 100, penalties subtract — floor at 0, cap at 100
+            cols["h"].append(max(0, min(100, 100 + breakdown["hygiene"])))
+            cols["t"].append(max(0, min(100, 100 + breakdown["threat"])))
+            cols["s"].append(max(0, min(100, 100 + breakdown["stability"])))
+            cols["lvl"].append(risk_level)
+            cols["ds"].append(round(metrics.get("downstream_score", 100)))
+            cols["zb"].append(bool(metrics.get("zombie_status", False)))
+            cols["bh"].append(int(metrics.get("ddos_blackhole_count", 0)))
+            cols["ep"].append(int(metrics.get("excessive_prepending_count", 0)))
 
         with self.pg_engine.connect() as conn:
-            conn.execute(
+            # Lock the rows (in ASN order, so concurrent batches cannot
+            # deadlock) and read the scores being replaced. A concurrent writer
+            # of the same ASN blocks here until this transaction commits, so
+            # `old` is always the value the other writer left behind.
+            before = {
+                asn: rest
+                for asn, *rest in conn.execute(
+                    text("""
+                    SELECT asn, last_scored_at IS NOT NULL, total_score,
+                           risk_level, hygiene_score, threat_score, stability_score
+                    FROM asn_registry WHERE asn = ANY(CAST(:asn AS BIGINT[]))
+                    ORDER BY asn FOR UPDATE
+                """),
+                    {"asn": cols["asn"]},
+                ).fetchall()
+            }
+            updated = conn.execute(
                 text("""
-                UPDATE asn_registry
-                SET total_score = :score, hygiene_score = :h, threat_score = :t,
-                    stability_score = :s, risk_level = :risk_level,
-                    downstream_score = :ds, last_scored_at = :now
-                WHERE asn = :asn
+                UPDATE asn_registry AS r
+                SET total_score = v.score, hygiene_score = v.h, threat_score = v.t,
+                    stability_score = v.s, risk_level = v.lvl,
+                    downstream_score = v.ds, last_scored_at = :now
+                FROM unnest(
+                    CAST(:asn AS BIGINT[]), CAST(:score AS INTEGER[]),
+                    CAST(:h AS INTEGER[]), CAST(:t AS INTEGER[]),
+                    CAST(:s AS INTEGER[]), CAST(:lvl AS VARCHAR[]),
+                    CAST(:ds AS INTEGER[])
+                ) AS v(asn, score, h, t, s, lvl, ds)
+                WHERE r.asn = v.asn
+                RETURNING r.asn, r.total_score
             """),
-                {
-                    "score": score,
-                    "h": hygiene_score,
-                    "t": threat_score,
-                    "s": stability_score,
-                    "risk_level": risk_level,
-                    "ds": downstream_score,
-                    "now": timestamp,
-                    "asn": asn,
-                },
-            )
+                {**cols, "now": timestamp},
+            ).fetchall()
+            moves = [(asn, *before[asn][:2], new) for asn, new in updated]
             conn.execute(
                 text("""
-                UPDATE asn_signals
-                SET is_zombie_asn = :zombie, ddos_blackhole_count = :bh, excessive_prepending_count = :ep
-                WHERE asn = :asn
+                UPDATE asn_signals AS sg
+                SET is_zombie_asn = v.zb, ddos_blackhole_count = v.bh,
+                    excessive_prepending_count = v.ep
+                FROM unnest(
+                    CAST(:asn AS BIGINT[]), CAST(:zb AS BOOLEAN[]),
+                    CAST(:bh AS INTEGER[]), CAST(:ep AS INTEGER[])
+                ) AS v(asn, zb, bh, ep)
+                WHERE sg.asn = v.asn
             """),
                 {
-                    "zombie": is_zombie,
-                    "bh": ddos_bh,
-                    "ep": excessive_prepend,
-                    "asn": asn,
+                    "asn": cols["asn"],
+                    "zb": cols["zb"],
+                    "bh": cols["bh"],
+                    "ep": cols["ep"],
                 },
             )
+            # Still holding the row locks: Redis sees two writers' moves for
+            # one ASN in the same order Postgres commits them.
+            histogram_applied = self._update_score_histogram(moves)
+            edl_applied = self._update_edl(moves)
             conn.commit()
 
+        # A missing histogram or EDL is rebuilt from asn_registry on another
+        # connection, which only sees this batch once it is committed.
+        if not histogram_applied:
+            try:
+                self.rebuild_score_histogram()
+            except Exception as e:
+                logger.warning(
+                    "score_histogram_rebuild_failed", extra={"error": str(e)}
+                )
+        if not edl_applied:
+            try:
+                self.rebuild_edl()
+            except Exception as e:
+                logger.warning("edl_rebuild_failed", extra={"error": str(e)})
+
         try:
             self.ch_client.execute(
                 "INSERT INTO asn_score_history (timestamp, asn, score) VALUES",
-                [{"timestamp": datetime.now(), "asn": asn, "score": score}],
+                [
+                    {"timestamp": timestamp, "asn": asn, "score": score}
+                    for asn, score in zip(cols["asn"], cols["score"])
+                ],
             )
         except Exception as e:
-            logger.error("history_log_failed", extra={"asn": asn, "error": str(e)})
+            logger.error(
+                "history_log_failed", extra={"asns": len(results), "error": str(e)}
+            )
 
-        logger.info(
-            "scoring_complete",
-            extra={"asn": asn, "score": score, "risk_level": risk_level},
+        for asn, score, risk_level in zip(cols["asn"], cols["score"], cols["lvl"]):
+            logger.info(
+                "scoring_complete",
+                extra={"asn": asn, "score": score, "risk_level": risk_level},
+            )
+
+        current = {
+            asn: (score, lvl, parts)
+            for asn, score, lvl, *parts in zip(
+                cols["asn"], cols["score"], cols["lvl"], cols["h"], cols["t"], cols["s"]
+            )
+        }
+        stamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        events = []
+        for asn, _score in updated:
+            was_scored, old, old_lvl, *old_parts = before[asn]
+            score, lvl, parts = current[asn]
+            if was_scored and score == old and lvl == old_lvl:
+                continue
+            events.append(
+                {
+                    "asn": asn,
+                    "score": score,
+                    "previous_score": old if was_scored else None,
+                    "risk_level": lvl,
+                    "previous_risk_level": old_lvl,
+                    "changed": {
+                        name: [o, n]
+                        for name, o, n in zip(SCORE_COMPONENTS, old_parts, parts)
+                        if o != n
+                    },
+                    "timestamp": stamp,
+                }
+            )
+        return events
+
+    def _update_score_histogram(self, moves: list) -> bool:
+        """Keep the API's rank_percentile histogram in step with asn_registry.
+
+        `moves` are (asn, was_scored, old_score, new_score) rows from _save_scores:
+        a re-score moves one count between buckets, a first score only adds.
+        Returns False, applying nothing, if the histogram is missing: the caller
+        rebuilds it once its transaction has committed."""
+        try:
+            if not self.redis_client.exists(SCORE_HISTOGRAM_KEY):
+                return False
+            pipe = self.redis_client.pipeline(transaction=False)
+            for _asn, was_scored, old, new in moves:
+                if was_scored and old == new:
+                    continue
+                if was_scored:
+                    pipe.hincrby(SCORE_HISTOGRAM_KEY, old, -1)
+                pipe.hincrby(SCORE_HISTOGRAM_KEY, new, 1)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("score_histogram_update_failed", extra={"error": str(e)})
+        return True
+
+    def rebuild_score_histogram(self) -> int:
+        """Recount the score histogram (one field per integer score 0-100) from
+        the scored registry rows and swap it in atomically. Returns the number
+        of scored ASNs."""
+        with self.pg_engine.connect() as conn:
+            rows = conn.execute(text("""
+                SELECT total_score, count(*) FROM asn_registry
+                WHERE last_scored_at IS NOT NULL GROUP BY total_score
+            """)).fetchall()
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.delete(SCORE_HISTOGRAM_KEY)
+        if rows:
+            pipe.hset(SCORE_HISTOGRAM_KEY, mapping={str(sc): n for sc, n in rows})
+        pipe.execute()
+        return sum(n for _sc, n in rows)
+
+    def _apply_edl_ops(self, threshold: int, ops: list) -> int:
+        key = f"{EDL_KEY_PREFIX}:{threshold}"
+        return self.redis_client.eval(
+            EDL_UPDATE_SCRIPT,
+            3,
+            f"{key}:asns",
+            f"{key}:version",
+            f"{key}:log",
+            EDL_LOG_VERSIONS,
+            *ops,
         )
 
-    def _enrich_asn_metadata(self, asn: int, conn) -> None:
-        def run_enrichment():
-            with self._cb_lock:
-                if self._cb_state["open"]:
-                    if (
-                        time.time() - self._cb_state["last_failure"]
-                        > settings.circuit_breaker_cooldown
-                    ):
-                        self._cb_state["open"] = False
-                        self._cb_state["failures"] = 0
-                    else:
-                        return
+    def _update_edl(self, moves: list) -> bool:
+        """Apply the threshold crossings in `moves` to the materialized EDLs.
 
-            try:
-                url = f"https://stat.ripe.net/data/as-overview/data.json?resource={asn}"
-                resp = http_requests.get(url, timeout=settings.enrichment_timeout)
-                if resp.status_code == 200:
-                    data = resp.json().get("data", {})
-                    holder = data.get("holder", "Unknown")
-                    with self.pg_engine.connect() as local_conn:
-                        local_conn.execute(
-                            text(
-                                "UPDATE asn_registry SET name = :name WHERE asn = :asn"
-                            ),
-                            {"name": holder, "asn": asn},
-                        )
-                        local_conn.commit()
+        Only ASNs whose score crossed a threshold touch that threshold's list,
+        so the API re-renders a feed (and firewalls re-download it) only when
+        its content actually changed. Returns False, applying nothing, if an
+        EDL is missing: the caller rebuilds them after committing."""
+        try:
+            if not all(
+                self.redis_client.exists(f"{EDL_KEY_PREFIX}:{t}:version")
+                for t in EDL_THRESHOLDS
+            ):
+                return False
+            for t in EDL_THRESHOLDS:
+                ops = [
+                    f"+{asn}" if new <= t else f"-{asn}"
+                    for asn, _was_scored, old, new in moves
+                    if (old <= t) != (new <= t)
+                ]
+                if ops:
+                    self._apply_edl_ops(t, ops)
+        except Exception as e:
+            logger.warning("edl_update_failed", extra={"error": str(e)})
+        return True
+
+    def rebuild_edl(self) -> int:
+        """Diff every materialized EDL against asn_registry and apply the
+        difference as a regular versioned change, so ?since= clients pick up
+        any drift too. Returns the number of ASNs added or removed."""
+        changed = 0
+        with self.pg_engine.connect() as conn:
+            for t in EDL_THRESHOLDS:
+                rows = conn.execute(
+                    text("SELECT asn FROM asn_registry WHERE total_score <= :t"),
+                    {"t": t},
+                ).fetchall()
+                want = {str(r[0]) for r in rows}
+                key = f"{EDL_KEY_PREFIX}:{t}"
+                have = self.redis_client.smembers(f"{key}:asns")
+                ops = [f"+{asn}" for asn in want - have]
+                ops += [f"-{asn}" for asn in have - want]
+                if ops or not self.redis_client.exists(f"{key}:version"):
+                    self._apply_edl_ops(t, ops)
+                changed += len(ops)
+        return changed
+
+    def _run_enrichment(self, asn: int) -> None:
+        """Fetch holder name (RIPE Stat) and PeeringDB presence for one ASN.
+        Runs on self.executor, gated by the shared circuit breaker."""
+        with self._cb_lock:
+            if self._cb_state["open"]:
+                if (
+                    time.time() - self._cb_state["last_failure"]
+                    > settings.circuit_breaker_cooldown
+                ):
+                    self._cb_state["open"] = False
+                    self._cb_state["failures"] = 0
                 else:
-                    raise Exception(f"RIPE error: {resp.status_code}")
+                    return
 
-                pdb_url = f"https://www.peeringdb.com/api/net?asn={asn}"
-                pdb_resp = http_requests.get(
-                    pdb_url, timeout=settings.enrichment_timeout
-                )
-                if pdb_resp.status_code == 200:
-                    data = pdb_resp.json().get("data", [])
-                    has_pdb = len(data) > 0
-                    with self.pg_engine.connect() as local_conn:
-                        local_conn.execute(
-                            text(
-                                "UPDATE asn_signals SET has_peeringdb_profile = :pdb WHERE asn = :asn"
-                            ),
-                            {"pdb": has_pdb, "asn": asn},
-                        )
-                        local_conn.commit()
+        try:
+            url = f"https://stat.ripe.net/data/as-overview/data.json?resource={asn}"
+            resp = http_requests.get(url, timeout=settings.enrichment_timeout)
+            if resp.status_code == 200:
+                data = resp.json().get("data", {})
+                holder = data.get("holder", "Unknown")
+                with self.pg_engine.connect() as local_conn:
+                    local_conn.execute(
+                        text("UPDATE asn_registry SET name = :name WHERE asn = :asn"),
+                        {"name": holder, "asn": asn},
+                    )
+                    local_conn.commit()
+            else:
+                raise Exception(f"RIPE error: {resp.status_code}")
+
+            pdb_url = f"https://www.peeringdb.com/api/net?asn={asn}"
+            pdb_resp = http_requests.get(pdb_url, timeout=settings.enrichment_timeout)
+            if pdb_resp.status_code == 200:
+                data = pdb_resp.json().get("data", [])
+                has_pdb = len(data) > 0
+                with self.pg_engine.connect() as local_conn:
+                    local_conn.execute(
+                        text(
+                            "UPDATE asn_signals SET has_peeringdb_profile = :pdb WHERE asn = :asn"
+                        ),
+                        {"pdb": has_pdb, "asn": asn},
+                    )
+                    local_conn.commit()
 
-                with self._cb_lock:
-                    self._cb_state["failures"] = 0
+            with self._cb_lock:
+                self._cb_state["failures"] = 0
 
-            except Exception as e:
-                logger.warning("enrichment_failed", extra={"asn": asn, "error": str(e)})
-                with self._cb_lock:
-                    self._cb_state["failures"] += 1
-                    self._cb_state["last_failure"] = time.time()
-                    if self._cb_state["failures"] >= settings.circuit_breaker_threshold:
-                        self._cb_state["open"] = True
-                        logger.error(
-                            "circuit_breaker_open",
-                            extra={"reason": "external_api_failures"},
-                        )
+        except Exception as e:
+            logger.warning("enrichment_failed", extra={"asn": asn, "error": str(e)})
+            with self._cb_lock:
+                self._cb_state["failures"] += 1
+                self._cb_state["last_failure"] = time.time()
+                if self._cb_state["failures"] >= settings.circuit_breaker_threshold:
+                    self._cb_state["open"] = True
+                    logger.error(
+                        "circuit_breaker_open",
+                        extra={"reason": "external_api_failures"},
+                    )
 
+    def _enrich_asn_metadata(self, asn: int, conn) -> None:
         # Skip external enrichment when we already know this ASN's holder name.
         # Previously RIPE + PeeringDB were hit on EVERY re-score (up to 50 ASNs
         # every 10s from the scanner) — a self-inflicted DoS on external APIs.
@@ -849,4 +1655,4 @@ class RiskScorer:
         except Exception:
             pass
 
-        self.executor.submit(run_enrichment)
+        self.executor.submit(self._run_enrichment, asn)
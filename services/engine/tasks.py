@@ -1,6 +1,7 @@
 # Copyright by Fabrizio Salmi (fabrizio.salmi@gmail.com)
 
 import logging
+import time
 
 from celery import Celery
 from pythonjsonlogger.json import JsonFormatter as JsonLogFormatter
@@ -26,6 +27,39 @@ logger = logging.getLogger("engine.tasks")
 app = Celery("tasks", broker=settings.broker_url)
 scorer = RiskScorer()
 
+# --- Coalescing score queue (producers live in services/ingestor) ---
+# Member score = priority * SCORE_PRIORITY_BAND + due unix time; priority 0
+# (threat) drains before 1 (leak) before 2 (churn).
+SCORE_QUEUE_KEY = "score:pending"
+SCORE_LAST_DISPATCH_KEY = "score:last_dispatch"
+SCORE_PRIORITY_BAND = 10_000_000_000
+SCORE_PRIORITY_LEVELS = 3
+
+# Atomically pop up to `limit` due ASNs, highest priority first, stamping each
+# one's dispatch time (the producers' minimum re-score interval counts from it).
+# KEYS: queue, last-dispatch hash. ARGV: now, limit, band, levels.
+SCORE_POP_SCRIPT = """
+local now = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local band = tonumber(ARGV[3])
+local out = {}
+for p = 0, tonumber(ARGV[4]) - 1 do
+    local lo = p * band
+    local due = redis.call('ZRANGEBYSCORE', KEYS[1], lo, lo + now,
+                           'LIMIT', 0, limit - #out)
+    for _, asn in ipairs(due) do
+        redis.call('ZREM', KEYS[1], asn)
+        redis.call('HSET', KEYS[2], asn, ARGV[1])
+        out[#out + 1] = asn
+    end
+    if #out >= limit then
+        break
+    end
+end
+return out
+"""
+_pop_due_scores = scorer.redis_client.register_script(SCORE_POP_SCRIPT)
+
 
 @app.task(bind=True)
 def calculate_asn_score(self, asn: int, trace_id: str = "") -> int:
@@ -42,3 +76,88 @@ def calculate_asn_score(self, asn: int, trace_id: str = "") -> int:
     except Exception as e:
         logger.error("task_failed", extra={**extra, "error": str(e)})
         raise
+
+
+@app.task(bind=True)
+def calculate_asn_scores(self, asns: list[int], trace_id: str = "") -> int:
+    """
+    Batch variant of calculate_asn_score: scores a whole list of ASNs with one
+    query per metric family (see RiskScorer.calculate_scores).
+    Returns the number of ASNs scored.
+    """
+    extra = {"asns": len(asns), "trace_id": trace_id, "task_id": self.request.id}
+    try:
+        logger.info("batch_task_received", extra=extra)
+        scores = scorer.calculate_scores(asns, trace_id=trace_id)
+        logger.info("batch_task_complete", extra={**extra, "scored": len(scores)})
+        return len(scores)
+    except Exception as e:
+        logger.error("batch_task_failed", extra={**extra, "error": str(e)})
+        raise
+
+
+@app.task(bind=True)
+def rescore_registry(self, trace_id: str = "") -> int:
+    """
+    Full re-score: feed every registered ASN (stalest first) to
+    calculate_asn_scores in chunks of settings.score_batch_size.
+    Returns the number of batches dispatched. Also recounts the score
+    histogram and re-syncs the materialized EDLs, correcting any drift in
+    their incremental updates.
+    """
+    try:
+        scorer.rebuild_score_histogram()
+    except Exception as e:
+        logger.warning("score_histogram_rebuild_failed", extra={"error": str(e)})
+    try:
+        scorer.rebuild_edl()
+    except Exception as e:
+        logger.warning("edl_rebuild_failed", extra={"error": str(e)})
+    asns = scorer.registry_asns()
+    size = settings.score_batch_size
+    batches = 0
+    for i in range(0, len(asns), size):
+        calculate_asn_scores.delay(asns[i : i + size], trace_id=trace_id)
+        batches += 1
+    logger.info(
+        "rescore_dispatched",
+        extra={"asns": len(asns), "batches": batches, "task_id": self.request.id},
+    )
+    return batches
+
+
+@app.task(bind=True)
+def drain_score_queue(self, trace_id: str = "") -> int:
+    """
+    Drain the coalescing score queue: pop due ASNs (threat hits first, churn
+    scans last) and fan them out as calculate_asn_scores batches, up to
+    settings.score_drain_max_batches per run. Returns the number of ASNs
+    dispatched.
+    """
+    size = settings.score_batch_size
+    dispatched = 0
+    for _ in range(settings.score_drain_max_batches):
+        asns = [
+            int(a)
+            for a in _pop_due_scores(
+                keys=[SCORE_QUEUE_KEY, SCORE_LAST_DISPATCH_KEY],
+                args=[
+                    int(time.time()),
+                    size,
+                    SCORE_PRIORITY_BAND,
+                    SCORE_PRIORITY_LEVELS,
+                ],
+            )
+        ]
+        if not asns:
+            break
+        calculate_asn_scores.delay(asns, trace_id=trace_id)
+        dispatched += len(asns)
+        if len(asns) < size:
+            break
+    if dispatched:
+        logger.info(
+            "score_queue_drained",
+            extra={"asns": dispatched, "task_id": self.request.id},
+        )
+    return dispatched
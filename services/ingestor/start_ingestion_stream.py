@@ -1,13 +1,18 @@
 # Copyright by Fabrizio Salmi (fabrizio.salmi@gmail.com)
 
+import argparse
 import asyncio
-import ipaddress
+import bisect
+import bz2
+import gzip
 import os
 import re
+import socket
 import threading
 import time
 import json
 import logging
+import multiprocessing
 from datetime import datetime
 
 import websockets
@@ -33,6 +38,145 @@ REDIS_URL = os.getenv("BROKER_URL", "redis://broker-cache:6379/0")
 THREAT_INTEL_INTERVAL = 21600  # 6 hours
 ROUTE_LEAK_SCAN_INTERVAL = 300  # 5 minutes
 
+# RIS Live collectors to subscribe to (comma-separated, e.g. "rrc00,rrc01,rrc21").
+# Each worker process runs its own websocket, parser and ClickHouse batcher;
+# RIS_WORKERS=0 means one process per collector, N>0 shards them over N.
+RIS_COLLECTORS = [
+    c.strip() for c in os.getenv("RIS_COLLECTORS", "rrc21").split(",") if c.strip()
+]
+RIS_WORKERS = int(os.getenv("RIS_WORKERS", "0"))
+RIS_WORKER_CHECK_INTERVAL = 5  # seconds between worker liveness checks
+
+# bgp_events insert batching: flush at BGP_BATCH_SIZE rows or once the oldest
+# buffered row is BGP_FLUSH_INTERVAL seconds old, whichever comes first.
+BGP_BATCH_SIZE = int(os.getenv("BGP_BATCH_SIZE", "1000"))
+BGP_FLUSH_INTERVAL = float(os.getenv("BGP_FLUSH_INTERVAL", "2.0"))
+
+# --- Score-request scheduler (coalescing queue in front of Celery) ---
+# Producers ZADD ASNs into SCORE_QUEUE_KEY instead of sending one task per hit;
+# the engine's drain_score_queue task pops due ASNs in priority order. Member
+# score = priority * SCORE_PRIORITY_BAND + due unix time, so a bucket never
+# overlaps the next and lower = sooner. Keys are shared with services/engine.
+SCORE_QUEUE_KEY = "score:pending"
+SCORE_LAST_DISPATCH_KEY = "score:last_dispatch"  # hash asn -> unix time
+SCORE_PRIORITY_BAND = 10_000_000_000
+SCORE_PRIORITY = {"threat": 0, "leak": 1, "churn": 2}
+SCORE_MIN_INTERVAL = int(os.getenv("SCORE_MIN_INTERVAL", "300"))
+SCORE_DRAIN_INTERVAL = float(os.getenv("SCORE_DRAIN_INTERVAL", "5"))
+
+# Enqueue: due = max(now, last dispatch + min interval). ZADD LT keeps the
+# earliest/highest-priority request when an ASN is already pending.
+# KEYS: queue, last-dispatch hash. ARGV: now, min_interval, band offset, asns...
+SCORE_ENQUEUE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local min_interval = tonumber(ARGV[2])
+local band = tonumber(ARGV[3])
+local added = 0
+for i = 4, #ARGV do
+    local last = tonumber(redis.call('HGET', KEYS[2], ARGV[i]) or '0')
+    local due = math.max(now, last + min_interval)
+    added = added + redis.call('ZADD', KEYS[1], 'LT', band + due, ARGV[i])
+end
+return added
+"""
+
+
+def _prefix_bounds(prefix: str) -> tuple[int, int, int]:
+    """(IP version, first address, last address) of a CIDR string as ints.
+    Host bits are masked off. Uses inet_pton rather than ipaddress.ip_network,
+    which is several times slower on million-route loops. Raises ValueError or
+    OSError on malformed input."""
+    addr, _, plen = prefix.partition("/")
+    if ":" in addr:
+        version, bits = 6, 128
+        packed = socket.inet_pton(socket.AF_INET6, addr)
+    else:
+        version, bits = 4, 32
+        packed = socket.inet_pton(socket.AF_INET, addr)
+    length = int(plen) if plen else bits
+    if not 0 <= length <= bits:
+        raise ValueError(f"bad prefix length: {prefix}")
+    host = (1 << (bits - length)) - 1
+    start = int.from_bytes(packed, "big") & ~host
+    return version, start, start | host
+
+
+BGP_EVENT_COLUMNS = (
+    "timestamp",
+    "asn",
+    "prefix",
+    "event_type",
+    "upstream_as",
+    "path",
+    "community",
+)
+BGP_INSERT_QUERY = f"INSERT INTO bgp_events ({', '.join(BGP_EVENT_COLUMNS)}) VALUES"
+
+
+class BgpBatch:
+    """Column-wise bgp_events buffer: one list per column, inserted with
+    columnar=True. Rows of one RIS message share the timestamp, path and
+    community objects instead of each carrying its own copy."""
+
+    __slots__ = ("columns", "started")
+
+    def __init__(self) -> None:
+        self.columns: tuple[list, ...] = tuple([] for _ in BGP_EVENT_COLUMNS)
+        self.started = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.columns[0])
+
+    def append(self, timestamp, asn, prefix, event_type, upstream_as, path, community):
+        ts, a, pfx, et, up, pth, comm = self.columns
+        ts.append(timestamp)
+        a.append(asn)
+        pfx.append(prefix)
+        et.append(event_type)
+        up.append(upstream_as)
+        pth.append(path)
+        comm.append(community)
+
+    def due(self, max_rows: int, max_age: float) -> bool:
+        n = len(self)
+        return n >= max_rows or (n > 0 and time.monotonic() - self.started >= max_age)
+
+
+class PrefixIntervals:
+    """The union of a set of CIDR blocks as sorted, disjoint [start, end]
+    integer intervals per address family. Built once per feed refresh;
+    overlaps() is a binary search instead of a scan over every block."""
+
+    def __init__(self, prefixes) -> None:
+        spans: dict[int, list] = {4: [], 6: []}
+        for p in prefixes:
+            try:
+                version, start, end = _prefix_bounds(p)
+            except (ValueError, OSError):
+                continue
+            spans[version].append((start, end))
+        self._starts: dict[int, list] = {}
+        self._ends: dict[int, list] = {}
+        for version, items in spans.items():
+            merged: list = []
+            for start, end in sorted(items):
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self._starts[version] = [m[0] for m in merged]
+            self._ends[version] = [m[1] for m in merged]
+
+    def __len__(self) -> int:
+        return len(self._starts[4]) + len(self._starts[6])
+
+    def overlaps(self, version: int, start: int, end: int) -> bool:
+        # Ends are sorted too (intervals are disjoint): the first interval
+        # ending at/after `start` is the only candidate.
+        ends = self._ends[version]
+        i = bisect.bisect_left(ends, start)
+        return i < len(ends) and self._starts[version][i] <= end
+
 
 class DataIngestor:
     def __init__(self) -> None:
@@ -43,71 +187,121 @@ class DataIngestor:
         self._ch_lock = threading.Lock()
         self.redis_client = redis.Redis.from_url(REDIS_URL)
         self.celery_app = Celery("ingestor", broker=REDIS_URL)
+        self._enqueue_scores = self.redis_client.register_script(SCORE_ENQUEUE_SCRIPT)
         self.running = True
 
-    def _ch_execute_sync(self, query: str, params=None):
+    def _ch_execute_sync(self, query: str, params=None, **kwargs):
         """Thread-safe wrapper around ch_client.execute()."""
         with self._ch_lock:
             if params is not None:
-                return self.ch_client.execute(query, params)
-            return self.ch_client.execute(query)
+                return self.ch_client.execute(query, params, **kwargs)
+            return self.ch_client.execute(query, **kwargs)
+
+    def request_scores(self, asns, priority: str) -> int:
+        """Queue ASNs for scoring at `priority` ("threat" > "leak" > "churn").
+        Duplicates coalesce, and an ASN dispatched less than
+        SCORE_MIN_INTERVAL seconds ago becomes due only once it elapses.
+        Returns the number of ASNs newly queued."""
+        asns = {int(a) for a in asns}
+        if not asns:
+            return 0
+        try:
+            return self._enqueue_scores(
+                keys=[SCORE_QUEUE_KEY, SCORE_LAST_DISPATCH_KEY],
+                args=[
+                    int(time.time()),
+                    SCORE_MIN_INTERVAL,
+                    SCORE_PRIORITY[priority] * SCORE_PRIORITY_BAND,
+                    *sorted(asns),
+                ],
+            )
+        except Exception as e:
+            logger.warning(
+                "score_enqueue_failed priority=%s asns=%s error=%s",
+                priority,
+                len(asns),
+                e,
+            )
+            return 0
+
+    def _score_queue_due(self, now: int) -> bool:
+        """True if any priority band holds an ASN due by `now`. Entries still
+        inside their minimum interval are pending but not due."""
+        pipe = self.redis_client.pipeline(transaction=False)
+        for p in sorted(set(SCORE_PRIORITY.values())):
+            lo = p * SCORE_PRIORITY_BAND
+            pipe.zrangebyscore(SCORE_QUEUE_KEY, lo, lo + now, start=0, num=1)
+        return any(pipe.execute())
+
+    async def dispatch_score_queue(self) -> None:
+        """Trigger the engine's drain_score_queue whenever a queued ASN is due;
+        the engine pops due ASNs atomically, so overlapping drains are safe."""
+        logger.info("score_dispatcher_start interval=%ss", SCORE_DRAIN_INTERVAL)
+        while self.running:
+            try:
+                if self._score_queue_due(int(time.time())):
+                    self.celery_app.send_task("tasks.drain_score_queue")
+            except Exception as e:
+                logger.error("score_dispatch_error error=%s", e)
+            await asyncio.sleep(SCORE_DRAIN_INTERVAL)
 
-    async def connect_ripe_ris(self) -> None:
-        """Connects to RIPE RIS Live WebSocket to process REAL BGP updates."""
+    async def connect_ripe_ris(self, collectors: list[str]) -> None:
+        """Connects to RIPE RIS Live WebSocket to process REAL BGP updates from
+        `collectors`, all multiplexed over one websocket."""
         uri = "wss://ris-live.ripe.net/v1/ws/"
-        logger.info("ris_connecting uri=%s", uri)
+        label = ",".join(collectors)
+        logger.info("ris_connecting uri=%s hosts=%s", uri, label)
 
         backoff = 1
         while self.running:
             try:
                 async with websockets.connect(uri) as websocket:
                     backoff = 1
-                    subscribe_msg = {
-                        "type": "ris_subscribe",
-                        "data": {
-                            "host": "rrc21",
-                            "type": "UPDATE",
-                            "require": "announcements",
-                        },
-                    }
-                    await websocket.send(json.dumps(subscribe_msg))
-                    logger.info("ris_subscribed host=rrc21")
-
-                    batch: list[dict] = []
-                    last_flush = time.time()
+                    for host in collectors:
+                        subscribe_msg = {
+                            "type": "ris_subscribe",
+                            "data": {
+                                "host": host,
+                                "type": "UPDATE",
+                                "require": "announcements",
+                            },
+                        }
+                        await websocket.send(json.dumps(subscribe_msg))
+                    logger.info("ris_subscribed hosts=%s", label)
+
+                    batch = BgpBatch()
 
                     async for message in websocket:
                         data = json.loads(message)
                         if data["type"] == "ris_message":
-                            parsed_list = self._parse_ripe_message(data["data"])
-                            if parsed_list:
-                                batch.extend(parsed_list)
+                            self._parse_ripe_message(data["data"], batch)
 
-                        if len(batch) >= 1000 or (
-                            time.time() - last_flush > 2.0 and batch
-                        ):
-                            await self._flush_bgp_batch(batch, "REAL")
-                            batch = []
-                            last_flush = time.time()
+                        if batch.due(BGP_BATCH_SIZE, BGP_FLUSH_INTERVAL):
+                            await self._flush_bgp_batch(batch, label)
+                            batch = BgpBatch()
 
             except Exception as e:
                 logger.warning("ris_connection_error error=%s backoff=%ss", e, backoff)
                 await asyncio.sleep(backoff)
                 backoff = min(60, backoff * 2)
 
-    def _parse_ripe_message(self, msg: dict) -> list[dict] | None:
-        """Robust Multi-Prefix Parsing."""
+    def _parse_ripe_message(
+        self, msg: dict, batch: BgpBatch, timestamp: datetime | None = None
+    ) -> int:
+        """Robust Multi-Prefix Parsing. Appends one row per announced prefix to
+        `batch` and returns how many were added (0 for unusable messages).
+        Rows are stamped with `timestamp` (replay) or the current time (live)."""
         try:
             path = msg.get("path", [])
             if not path:
-                return None
+                return 0
 
-            origin_asn = path[-1]
-            upstream_asn = path[-2] if len(path) > 1 else 0
+            origin_asn = int(path[-1])
+            upstream_asn = int(path[-2]) if len(path) > 1 else 0
 
             announcements = msg.get("announcements", [])
             if not announcements:
-                return None
+                return 0
 
             communities: list[int] = []
             raw_comms = msg.get("communities", [])
@@ -121,40 +315,139 @@ class DataIngestor:
                 except (TypeError, ValueError):
                     continue
 
-            events = []
+            # Shared by every row of this message (AS_SETs are dropped).
+            int_path = [int(p) for p in path if isinstance(p, int)]
+            now = timestamp or datetime.now()
+            added = 0
             for announce in announcements:
-                prefixes = announce.get("prefixes", [])
-                for prefix in prefixes:
-                    events.append(
-                        {
-                            "timestamp": datetime.now(),
-                            "asn": int(origin_asn),
-                            "prefix": str(prefix),
-                            "event_type": "announce",
-                            "upstream_as": int(upstream_asn),
-                            "path": [int(p) for p in path if isinstance(p, int)],
-                            "community": communities,
-                        }
+                for prefix in announce.get("prefixes", []):
+                    batch.append(
+                        now,
+                        origin_asn,
+                        str(prefix),
+                        "announce",
+                        upstream_asn,
+                        int_path,
+                        communities,
                     )
-            return events
-        except (KeyError, ValueError, TypeError) as e:
+                    added += 1
+            return added
+        except (KeyError, ValueError, TypeError, AttributeError) as e:
             logger.debug("parse_error error=%s", e)
-            return None
+            return 0
 
-    async def _flush_bgp_batch(self, batch: list[dict], source_label: str) -> None:
-        if not batch:
-            return
+    async def _flush_bgp_batch(self, batch: BgpBatch, source_label: str) -> bool:
+        if not len(batch):
+            return True
         try:
             loop = asyncio.get_running_loop()
             await loop.run_in_executor(
                 None,
-                lambda b=batch: self._ch_execute_sync(
-                    "INSERT INTO bgp_events (timestamp, asn, prefix, event_type, upstream_as, path, community) VALUES",
-                    b,
+                lambda cols=list(batch.columns): self._ch_execute_sync(
+                    BGP_INSERT_QUERY, cols, columnar=True
                 ),
             )
         except Exception as e:
-            logger.error("bgp_flush_error source=%s error=%s", source_label, e)
+            logger.error(
+                "bgp_flush_error source=%s rows=%s error=%s",
+                source_label,
+                len(batch),
+                e,
+            )
+            return False
+        return True
+
+    async def replay(self, path: str, fmt: str = "jsonl", rate: float = 0.0) -> dict:
+        """Drive a recorded dump through the live parse -> BgpBatch -> insert
+        pipeline. Rows keep their recorded timestamps, so this doubles as a
+        bgp_events backfill. `rate` replays at N x wall-clock speed (0 = as
+        fast as possible). Returns throughput and flush-latency stats."""
+        messages = iter_mrt_updates(path) if fmt == "mrt" else iter_ris_jsonl(path)
+        stats = {"messages": 0, "events": 0, "flushes": 0, "flush_errors": 0}
+        flush_ms: list[float] = []
+
+        async def flush(batch: BgpBatch) -> None:
+            t0 = time.perf_counter()
+            ok = await self._flush_bgp_batch(batch, f"replay:{path}")
+            flush_ms.append((time.perf_counter() - t0) * 1000)
+            stats["flushes"] += 1
+            stats["flush_errors"] += not ok
+
+        batch = BgpBatch()
+        started = time.perf_counter()
+        first_ts = None
+        for msg in messages:
+            ts = msg.get("timestamp")
+            if rate > 0 and ts is not None:
+                first_ts = ts if first_ts is None else first_ts
+                ahead = (ts - first_ts) / rate - (time.perf_counter() - started)
+                if ahead > 0:
+                    await asyncio.sleep(ahead)
+            stats["messages"] += 1
+            stamp = datetime.fromtimestamp(ts) if ts is not None else None
+            stats["events"] += self._parse_ripe_message(msg, batch, stamp)
+            if batch.due(BGP_BATCH_SIZE, BGP_FLUSH_INTERVAL):
+                await flush(batch)
+                batch = BgpBatch()
+        if len(batch):
+            await flush(batch)
+
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        flush_ms = sorted(flush_ms) or [0.0]
+        stats.update(
+            {
+                "seconds": round(elapsed, 3),
+                "messages_per_s": round(stats["messages"] / elapsed, 1),
+                "events_per_s": round(stats["events"] / elapsed, 1),
+                "flush_ms_p50": round(flush_ms[len(flush_ms) // 2], 2),
+                "flush_ms_p95": round(flush_ms[int(len(flush_ms) * 0.95)], 2),
+                "flush_ms_max": round(flush_ms[-1], 2),
+            }
+        )
+        logger.info(
+            "replay_complete path=%s %s",
+            path,
+            " ".join(f"{k}={v}" for k, v in stats.items()),
+        )
+        return stats
+
+    @staticmethod
+    def _correlate_threats(
+        active_routes: list, threat_prefixes: set[str], threat_ips: set[str]
+    ) -> list[dict]:
+        """Match active (prefix, asn) routes against the threat feeds and return
+        one threat_events row per flagged route. Spamhaus exact matches win over
+        CINS/URLHaus network-address matches, which win over Spamhaus overlaps."""
+        drop = PrefixIntervals(threat_prefixes)
+        now = datetime.now()
+        events = []
+        for route_prefix, route_asn in active_routes:
+            if route_prefix in threat_prefixes:
+                source_match = "Spamhaus (Exact)"
+            elif route_prefix.split("/")[0] in threat_ips:
+                source_match = "CINS/URLHaus (NetAddr Match)"
+            else:
+                try:
+                    if not drop.overlaps(*_prefix_bounds(route_prefix)):
+                        continue
+                except (ValueError, OSError, TypeError, AttributeError):
+                    continue
+                source_match = "Spamhaus (Overlap)"
+            events.append(
+                {
+                    "timestamp": now,
+                    "asn": route_asn,
+                    "source": source_match,
+                    # Precise category so the scorer can derive the right
+                    # signal (spamhaus_listed vs malware count).
+                    "category": (
+                        "spamhaus" if source_match.startswith("Spamhaus") else "malware"
+                    ),
+                    "target_ip": route_prefix,
+                    "description": f"{source_match} detection on {route_prefix}",
+                }
+            )
+        return events
 
     async def fetch_threat_intelligence(self) -> None:
         """Fetches REAL Threat Intel Feeds and correlates them. Runs every 6 hours."""
@@ -238,82 +531,35 @@ class DataIngestor:
                     len(active_routes),
                 )
 
-                found_threats = 0
-
-                bad_networks_obj = []
-                for tp in threat_prefixes:
-                    try:
-                        bad_networks_obj.append(ipaddress.ip_network(tp))
-                    except ValueError:
-                        pass
+                # CPU-bound over ~1M routes: keep it off the event loop.
+                loop = asyncio.get_running_loop()
+                threat_events = await loop.run_in_executor(
+                    None,
+                    self._correlate_threats,
+                    active_routes,
+                    threat_prefixes,
+                    threat_ips,
+                )
 
-                for route_prefix, route_asn in active_routes:
+                if threat_events:
                     try:
-                        source_match = None
-
-                        if route_prefix in threat_prefixes:
-                            source_match = "Spamhaus (Exact)"
-
-                        if not source_match:
-                            net_addr = route_prefix.split("/")[0]
-                            if net_addr in threat_ips:
-                                source_match = "CINS/URLHaus (NetAddr Match)"
-
-                        if not source_match:
-                            route_net = ipaddress.ip_network(route_prefix)
-                            for bad_net in bad_networks_obj:
-                                if bad_net.overlaps(route_net):
-                                    source_match = "Spamhaus (Overlap)"
-                                    break
-
-                        if source_match:
-                            # Precise category so the scorer can derive the
-                            # right signal (spamhaus_listed vs malware count).
-                            category = (
-                                "spamhaus"
-                                if source_match.startswith("Spamhaus")
-                                else "malware"
-                            )
-                            threat_event = [
-                                {
-                                    "timestamp": datetime.now(),
-                                    "asn": route_asn,
-                                    "source": source_match,
-                                    "category": category,
-                                    "target_ip": route_prefix,
-                                    "description": f"{source_match} detection on {route_prefix}",
-                                }
-                            ]
-
-                            _loop = asyncio.get_running_loop()
-                            _fut = _loop.run_in_executor(
-                                None,
-                                lambda te=threat_event: self._ch_execute_sync(
-                                    "INSERT INTO threat_events (timestamp, asn, source, category, target_ip, description) VALUES",
-                                    te,
-                                ),
-                            )
-
-                            def _log_ch_threat_error(fut):
-                                exc = fut.exception()
-                                if exc:
-                                    logger.warning(
-                                        "ch_threat_insert_failed error=%s", exc
-                                    )
-
-                            _fut.add_done_callback(_log_ch_threat_error)
-                            self.celery_app.send_task(
-                                "tasks.calculate_asn_score", args=[route_asn]
-                            )
-                            found_threats += 1
-
-                    except (ValueError, TypeError):
-                        continue
+                        await loop.run_in_executor(
+                            None,
+                            lambda: self._ch_execute_sync(
+                                "INSERT INTO threat_events (timestamp, asn, source, category, target_ip, description) VALUES",
+                                threat_events,
+                            ),
+                        )
+                    except Exception as e:
+                        logger.warning("ch_threat_insert_failed error=%s", e)
 
-                    if found_threats % 100 == 0 and found_threats > 0:
-                        await asyncio.sleep(0)
+                    self.request_scores({ev["asn"] for ev in threat_events}, "threat")
 
-                logger.info("threat_correlation_complete flagged=%s", found_threats)
+                logger.info(
+                    "threat_correlation_complete flagged=%s asns=%s",
+                    len(threat_events),
+                    len({ev["asn"] for ev in threat_events}),
+                )
 
             except Exception as e:
                 logger.error("threat_intel_error error=%s", e)
@@ -338,12 +584,10 @@ class DataIngestor:
                 )
 
                 if rows:
-                    logger.info("scanner_found active_asns=%s", len(rows))
-                    for row in rows:
-                        asn = row[0]
-                        self.celery_app.send_task(
-                            "tasks.calculate_asn_score", args=[asn]
-                        )
+                    queued = self.request_scores((row[0] for row in rows), "churn")
+                    logger.info(
+                        "scanner_found active_asns=%s queued=%s", len(rows), queued
+                    )
 
             except Exception as e:
                 logger.error("scanner_error error=%s", e)
@@ -424,9 +668,7 @@ class DataIngestor:
                                         )
 
                                 _fut.add_done_callback(_log_ch_leak_error)
-                                self.celery_app.send_task(
-                                    "tasks.calculate_asn_score", args=[asn]
-                                )
+                                self.request_scores([asn], "leak")
                                 leaks_found += 1
 
                     except (ValueError, TypeError):
@@ -452,14 +694,178 @@ class DataIngestor:
                 logger.warning("waiting_for_deps error=%s", e)
                 await asyncio.sleep(2)
 
-        task3 = asyncio.create_task(self.connect_ripe_ris())
+        task3 = asyncio.create_task(self.supervise_ris_workers())
         task4 = asyncio.create_task(self.scan_noisy_neighbors())
         task5 = asyncio.create_task(self.fetch_threat_intelligence())
         task6 = asyncio.create_task(self.detect_route_leaks())
+        task7 = asyncio.create_task(self.dispatch_score_queue())
 
-        await asyncio.gather(task3, task4, task5, task6)
+        await asyncio.gather(task3, task4, task5, task6, task7)
 
+    async def supervise_ris_workers(self) -> None:
+        """Run one RIS worker process per collector shard and restart any that
+        exit. Workers share nothing with this process but configuration."""
+        ctx = multiprocessing.get_context("spawn")
+        workers: dict[int, multiprocessing.Process] = {}
+        shards = shard_collectors(RIS_COLLECTORS, RIS_WORKERS)
+        logger.info("ris_workers_starting workers=%s shards=%s", len(shards), shards)
+        try:
+            while self.running:
+                for i, shard in enumerate(shards):
+                    proc = workers.get(i)
+                    if proc is not None and proc.is_alive():
+                        continue
+                    if proc is not None:
+                        logger.warning(
+                            "ris_worker_exited hosts=%s exitcode=%s",
+                            ",".join(shard),
+                            proc.exitcode,
+                        )
+                    proc = ctx.Process(
+                        target=run_ris_worker,
+                        args=(shard,),
+                        name=f"ris-{'-'.join(shard)}",
+                        daemon=True,
+                    )
+                    proc.start()
+                    workers[i] = proc
+                await asyncio.sleep(RIS_WORKER_CHECK_INTERVAL)
+        finally:
+            for proc in workers.values():
+                proc.terminate()
 
-if __name__ == "__main__":
+
+def shard_collectors(collectors: list[str], workers: int) -> list[list[str]]:
+    """Split collectors round-robin over `workers` processes (0 = one each)."""
+    if workers <= 0 or workers >= len(collectors):
+        return [[c] for c in collectors]
+    return [collectors[i::workers] for i in range(workers)]
+
+
+def run_ris_worker(collectors: list[str]) -> None:
+    """Worker-process entry point: a private DataIngestor (own ClickHouse,
+    Redis and Celery clients) streaming `collectors` until killed."""
     ingestor = DataIngestor()
-    asyncio.run(ingestor.start())
+    asyncio.run(ingestor.connect_ripe_ris(collectors))
+
+
+def _open_dump(path: str, mode: str = "rt"):
+    """Open a dump file, transparently decompressing .gz / .bz2."""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    if path.endswith(".bz2"):
+        return bz2.open(path, mode)
+    return open(path, mode)
+
+
+def iter_ris_jsonl(path: str):
+    """Yield RIS Live message payloads from a JSON-lines recording. Lines may be
+    full websocket frames ({"type": "ris_message", "data": {...}}) or bare
+    payloads; other frame types and malformed lines are skipped."""
+    with _open_dump(path) as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                frame = json.loads(line)
+            except ValueError:
+                continue
+            if "data" in frame and "type" in frame:
+                if frame["type"] != "ris_message":
+                    continue
+                frame = frame["data"]
+            if isinstance(frame, dict):
+                yield frame
+
+
+def iter_mrt_updates(path: str):
+    """Yield BGP4MP UPDATEs from an MRT dump (RIS updates.*.gz, RouteViews
+    *.bz2) converted to the RIS Live payload shape _parse_ripe_message reads.
+    Needs the optional `mrtparse` package."""
+    try:
+        import mrtparse
+    except ImportError as e:
+        raise SystemExit("MRT replay needs mrtparse: pip install mrtparse") from e
+
+    def code(field):
+        # mrtparse encodes enums as {code: name}
+        return next(iter(field)) if isinstance(field, dict) else field
+
+    for entry in mrtparse.Reader(path):
+        data = entry.data
+        msg = data.get("bgp_message")
+        if code(data.get("type")) not in (16, 17) or not msg or code(msg["type"]) != 2:
+            continue
+        path_attr: list = []
+        communities: list = []
+        prefixes = [f"{n['prefix']}/{n['length']}" for n in msg.get("nlri", [])]
+        for attr in msg.get("path_attributes", []):
+            attr_type = code(attr["type"])
+            if attr_type in (2, 17):  # AS_PATH / AS4_PATH
+                path_attr = []
+                for seg in attr["value"]:
+                    asns = [int(a) for a in seg["value"]]
+                    # AS_SEQUENCE flattens; AS_SET stays nested like RIS Live
+                    path_attr.extend(asns if code(seg["type"]) == 2 else [asns])
+            elif attr_type == 8:  # COMMUNITY
+                communities = [[int(x) for x in c.split(":")] for c in attr["value"]]
+            elif attr_type == 14:  # MP_REACH_NLRI
+                prefixes += [
+                    f"{n['prefix']}/{n['length']}"
+                    for n in attr["value"].get("nlri", [])
+                ]
+        if prefixes:
+            yield {
+                "timestamp": float(code(data["timestamp"])),
+                "path": path_attr,
+                "communities": communities,
+                "announcements": [{"prefixes": prefixes}],
+            }
+
+
+class NullClickHouse:
+    """ClickHouse stand-in for replay benchmarks: accepts inserts, counts
+    rows, stores nothing."""
+
+    def __init__(self) -> None:
+        self.rows = 0
+
+    def execute(self, query, params=None, **kwargs):
+        if params and kwargs.get("columnar"):
+            self.rows += len(params[0])
+        elif params:
+            self.rows += len(params)
+        return []
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="ASN risk BGP/threat ingestor")
+    sub = parser.add_subparsers(dest="command")
+    rp = sub.add_parser("replay", help="replay a recorded RIS/MRT dump")
+    rp.add_argument("path", help="RIS Live JSON-lines (.jsonl[.gz]) or MRT dump")
+    rp.add_argument("--format", choices=("jsonl", "mrt"), default="jsonl")
+    rp.add_argument(
+        "--rate",
+        type=float,
+        default=0.0,
+        help="replay at N x recorded wall-clock speed (default: max speed)",
+    )
+    rp.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="discard inserts (benchmark parsing/batching without ClickHouse)",
+    )
+    args = parser.parse_args(argv)
+
+    ingestor = DataIngestor()
+    if args.command == "replay":
+        if args.dry_run:
+            ingestor.ch_client = NullClickHouse()
+        asyncio.run(ingestor.replay(args.path, args.format, args.rate))
+    else:
+        asyncio.run(ingestor.start())
+
+
+if __name__ == "__main__":
+    main()
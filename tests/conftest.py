@@ -44,15 +44,17 @@ with (
 @pytest.fixture(autouse=True)
 def mock_dependencies():
     # Clear the module-level L1 in-memory cache so tests don't interfere with each other
-    from api.main import l1_cache
+    from api.main import dns_cache, l1_cache
 
     l1_cache.clear()
+    dns_cache.clear()
 
     mock_redis = AsyncMock()
     mock_redis.get = AsyncMock(return_value=None)
     mock_redis.setex = AsyncMock(return_value=True)
     mock_redis.eval = AsyncMock(return_value=1)
     mock_redis.ttl = AsyncMock(return_value=60)
+    mock_redis.hgetall = AsyncMock(return_value={})
     mock_redis.delete = AsyncMock(return_value=1)
     mock_redis.aclose = AsyncMock()
 
@@ -1,5 +1,11 @@
 # Copyright by Fabrizio Salmi (fabrizio.salmi@gmail.com)
 # Tests use realistic production-grade ASN data (Google/Cloudflare/RIPE NCC/M247)
+import asyncio
+import ipaddress
+import random
+import struct
+import time
+from datetime import datetime, timedelta
 import orjson
 import pytest
 from unittest.mock import patch, MagicMock, AsyncMock
@@ -128,6 +134,15 @@ ASN_9009_M247_HIGH_RISK = {
     "excessive_prepending_count": 6,
 }
 
+
+def _cache_entry(payload, soft_in=60):
+    """Redis value for a cached score card, fresh for another `soft_in` seconds."""
+    from api.main import _stable_etag
+
+    etag = _stable_etag(payload["last_updated"])
+    return f"{time.time() + soft_in:.3f} {etag} ".encode() + orjson.dumps(payload)
+
+
 # ---------------------------------------------------------------------------
 # Basic endpoint tests
 # ---------------------------------------------------------------------------
@@ -228,6 +243,128 @@ def test_rate_limit_headers_present(client):
     assert "X-Trace-ID" in response.headers
 
 
+# ---------------------------------------------------------------------------
+# Local (in-process) rate limiting
+# ---------------------------------------------------------------------------
+
+def test_local_rate_limit_mode_skips_redis(client, api_key, mock_dependencies):
+    from api.main import LocalRateLimiter, RATE_LIMIT_SCRIPT
+
+    mock_redis = mock_dependencies[0]
+    with patch("api.main.local_rate_limiter", LocalRateLimiter(2, 60)):
+        codes = [client.get("/v1/asn/0", headers={"X-API-Key": api_key}) for _ in range(3)]
+    assert [r.status_code for r in codes] == [400, 400, 429]
+    assert codes[0].headers["X-RateLimit-Remaining"] == "1"
+    assert codes[2].json()["code"] == "RATE_LIMITED"
+    assert int(codes[2].headers["Retry-After"]) == 30  # one token at 2/min
+    assert all(c.args[0] != RATE_LIMIT_SCRIPT for c in mock_redis.eval.await_args_list)
+
+
+def test_local_rate_limiter_refills_over_time():
+    from api.main import LocalRateLimiter
+
+    limiter = LocalRateLimiter(60, 60)  # 1 token/s
+    with patch("api.main.time.monotonic", return_value=1000.0):
+        assert [limiter.acquire("ip")[0] for _ in range(61)] == [True] * 60 + [False]
+    with patch("api.main.time.monotonic", return_value=1002.5):
+        assert limiter.acquire("ip")[:2] == (True, 1)
+    assert limiter.pending["ip"] == 61
+
+
+def test_local_rate_limiter_sync_caps_buckets_by_cluster_count(mock_dependencies):
+    from api.main import LocalRateLimiter, RATE_LIMIT_SYNC_SCRIPT
+
+    mock_redis = mock_dependencies[0]
+    limiter = LocalRateLimiter(10, 60)
+    for _ in range(3):
+        limiter.acquire("10.0.0.1")
+    limiter.acquire("10.0.0.2")
+    # other workers already used most of 10.0.0.1's budget
+    mock_redis.eval = AsyncMock(return_value=[9, 1])
+
+    asyncio.run(limiter.sync())
+    args = mock_redis.eval.await_args.args
+    assert args[:4] == (RATE_LIMIT_SYNC_SCRIPT, 2, "rlw:10.0.0.1", "rlw:10.0.0.2")
+    assert args[4:] == (60, 3, 1)
+    assert not limiter.pending
+
+    assert limiter.acquire("10.0.0.1")[:2] == (True, 0)
+    assert limiter.acquire("10.0.0.1")[0] is False
+    assert limiter.acquire("10.0.0.2")[0] is True  # cap 9 > local 9 tokens left
+
+    # nothing new since the last sync → no Redis call
+    limiter.pending.clear()
+    mock_redis.eval.reset_mock()
+    asyncio.run(limiter.sync())
+    mock_redis.eval.assert_not_awaited()
+
+# ---------------------------------------------------------------------------
+# Buffered api_requests logging
+# ---------------------------------------------------------------------------
+
+def test_request_logging_is_buffered_not_inserted_per_request(client, api_key, mock_dependencies):
+    from api.main import request_log
+
+    mock_ch_execute = mock_dependencies[4]
+    request_log.rows.clear()
+    client.get("/v1/asn/0", headers={"X-API-Key": api_key})
+    client.get("/health")  # not an /v1/asn path → not logged
+
+    assert len(request_log.rows) == 1
+    row = request_log.rows[0]
+    assert row[1:4] == ("/v1/asn/0", "GET", 400)
+    assert not any("api_requests" in c.args[0] for c in mock_ch_execute.await_args_list)
+    request_log.rows.clear()
+
+
+def test_request_log_buffer_flushes_in_batches(mock_dependencies):
+    from api.main import RequestLogBuffer
+
+    mock_ch_execute = mock_dependencies[4]
+    buf = RequestLogBuffer(max_rows=100, batch_size=4, flush_interval=1)
+    for i in range(10):
+        buf.append((i,))
+    assert buf._wakeup.is_set()  # a full batch wakes the flusher early
+
+    assert asyncio.run(buf.flush()) == 10
+    assert [len(c.args[1]) for c in mock_ch_execute.await_args_list] == [4, 4, 2]
+    assert not buf.rows and buf.dropped == 0
+
+
+def test_request_log_buffer_drops_and_counts_under_backpressure(mock_dependencies):
+    from api.main import RequestLogBuffer
+
+    mock_ch_execute = mock_dependencies[4]
+    buf = RequestLogBuffer(max_rows=3, batch_size=2, flush_interval=1)
+    for i in range(5):
+        buf.append((i,))
+    assert list(buf.rows) == [(0,), (1,), (2,)]
+    assert buf.dropped == 2
+
+    # a failed INSERT drops that batch (no retry pile-up) and stops the flush
+    mock_ch_execute.side_effect = RuntimeError("ch down")
+    assert asyncio.run(buf.flush()) == 0
+    assert buf.dropped == 4
+    assert list(buf.rows) == [(2,)]
+
+
+def test_request_log_flusher_runs_on_interval(mock_dependencies):
+    from api.main import RequestLogBuffer
+
+    mock_ch_execute = mock_dependencies[4]
+    buf = RequestLogBuffer(max_rows=10, batch_size=10, flush_interval=0.01)
+    buf.append((1,))
+
+    async def run():
+        task = asyncio.create_task(buf.run())
+        await asyncio.sleep(0.05)
+        task.cancel()
+
+    asyncio.run(run())
+    mock_ch_execute.assert_awaited_once()
+    assert not buf.rows
+
+
 def test_error_envelope_format(client):
     """Error responses use structured envelope with error + code fields."""
     response = client.get("/v1/asn/1234")
@@ -301,6 +438,156 @@ def test_get_asn_history_success(client, api_key, mock_dependencies):
     assert data["data"][0]["score"] == 97
 
 
+def test_get_asn_history_keyset_cursor(client, api_key, mock_dependencies):
+    mock_ch_execute = mock_dependencies[4]
+    page = [(datetime(2024, 1, 15), 98), (datetime(2024, 1, 14), 98)]
+    mock_ch_execute.side_effect = [[[3]], page]
+
+    response = client.get(
+        "/v1/asn/15169/history?limit=2&cursor=2024-01-16 00:00:00,1",
+        headers={"X-API-Key": api_key},
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total"] == 3
+    assert data["next_cursor"] == "2024-01-14 00:00:00,1"  # full page: maybe more
+    count_call, data_call = mock_ch_execute.await_args_list
+    assert "timestamp <" not in count_call.args[0]
+    assert "timestamp <= %(before)s" in data_call.args[0]
+    assert "ORDER BY timestamp DESC, score DESC" in data_call.args[0]
+    assert "OFFSET %(offset)s" in data_call.args[0]
+    assert data_call.args[1]["before"] == datetime(2024, 1, 16)
+    assert data_call.args[1]["offset"] == 1
+
+    # A short page is the last one
+    mock_ch_execute.side_effect = [[[3]], [(datetime(2024, 1, 13), 97)]]
+    response = client.get(
+        "/v1/asn/15169/history?limit=2&cursor=2024-01-14 00:00:00,1",
+        headers={"X-API-Key": api_key},
+    )
+    assert response.json()["next_cursor"] is None
+
+
+def test_get_asn_history_cursor_keeps_rows_sharing_the_boundary_second(
+    client, api_key, mock_dependencies
+):
+    """Five points, three in the same second, read two at a time: every row
+    comes back exactly once."""
+    mock_ch_execute = mock_dependencies[4]
+    tie = datetime(2024, 1, 14, 12)
+    rows = [
+        (datetime(2024, 1, 15), 98),
+        (tie, 97),
+        (tie, 96),
+        (tie, 96),
+        (datetime(2024, 1, 13), 95),
+    ]
+
+    def fake_execute(query, params):
+        if query.lstrip().startswith("SELECT count()"):
+            return [[len(rows)]]
+        page = rows
+        if "%(before)s" in query:
+            page = [r for r in rows if r[0] <= params["before"]]
+        return page[params["offset"] :][: params["limit"]]
+
+    mock_ch_execute.side_effect = fake_execute
+    seen, cursors, url = [], [], "/v1/asn/15169/history?limit=2"
+    while True:
+        data = client.get(url, headers={"X-API-Key": api_key}).json()
+        seen += [(p["timestamp"], p["score"]) for p in data["data"]]
+        if data["next_cursor"] is None:
+            break
+        cursors.append(data["next_cursor"])
+        url = f"/v1/asn/15169/history?limit=2&cursor={data['next_cursor']}"
+
+    assert seen == [(str(ts), score) for ts, score in rows]
+    assert cursors == ["2024-01-14 12:00:00,1", "2024-01-14 12:00:00,3"]
+
+
+def test_get_asn_history_resolution_buckets(client, api_key, mock_dependencies):
+    mock_ch_execute = mock_dependencies[4]
+    buckets = [
+        (datetime(2024, 1, 15), 95, 98, 97.25, 24),
+        (datetime(2024, 1, 14), 97, 98, 97.5, 24),
+    ]
+    mock_ch_execute.side_effect = [[[2]], buckets]
+
+    response = client.get(
+        "/v1/asn/15169/history?days=365&resolution=day",
+        headers={"X-API-Key": api_key},
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["resolution"], data["total"], data["next_cursor"]) == ("day", 2, None)
+    assert data["data"][0] == {
+        "timestamp": "2024-01-15 00:00:00",
+        "score": 97,
+        "min": 95,
+        "max": 98,
+        "avg": 97.25,
+        "samples": 24,
+    }
+    count_call, data_call = mock_ch_execute.await_args_list
+    assert "uniqExact(toStartOfDay(timestamp))" in count_call.args[0]
+    assert "GROUP BY bucket" in data_call.args[0]
+    assert "avg(score)" in data_call.args[0]
+
+    # Bucket starts are unique: the cursor skips nothing and the next page
+    # starts strictly before the last bucket
+    mock_ch_execute.reset_mock()
+    mock_ch_execute.side_effect = [[[3]], buckets]
+    response = client.get(
+        "/v1/asn/15169/history?resolution=day&limit=2&cursor=2024-01-16 00:00:00,0",
+        headers={"X-API-Key": api_key},
+    )
+    assert response.json()["next_cursor"] == "2024-01-14 00:00:00,0"
+    data_call = mock_ch_execute.await_args_list[1]
+    assert "timestamp < %(before)s" in data_call.args[0]
+    assert data_call.args[1]["offset"] == 0
+
+
+def test_get_asn_history_estimated_total(client, api_key, mock_dependencies):
+    mock_ch_execute = mock_dependencies[4]
+    mock_ch_execute.side_effect = [
+        [("default", "asn_score_history", 2, 16384, 2)],
+        HISTORY_ROWS_15169,
+    ]
+    response = client.get(
+        "/v1/asn/15169/history?estimate=true", headers={"X-API-Key": api_key}
+    )
+    assert response.json()["total"] == 16384
+    assert mock_ch_execute.await_args_list[0].args[0].startswith("EXPLAIN ESTIMATE")
+
+    # Bucketed: the number of buckets in the window, no count query
+    mock_ch_execute.reset_mock(side_effect=True)
+    mock_ch_execute.return_value = []
+    response = client.get(
+        "/v1/asn/15169/history?days=7&resolution=hour&estimate=true",
+        headers={"X-API-Key": api_key},
+    )
+    assert response.json()["total"] == 7 * 24 + 1
+    assert mock_ch_execute.await_count == 1
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "resolution=minute",
+        "cursor=yesterday",
+        "cursor=2024-01-15T00:00:00",
+        "cursor=2024-01-15T00:00:00,-1",
+        "cursor=2024-01-15T00:00:00,0&offset=10",
+    ],
+)
+def test_get_asn_history_rejects_bad_params(query, client, api_key, mock_dependencies):
+    response = client.get(
+        f"/v1/asn/15169/history?{query}", headers={"X-API-Key": api_key}
+    )
+    assert response.status_code == 400
+    mock_dependencies[4].assert_not_awaited()
+
+
 # ---------------------------------------------------------------------------
 # Compare endpoint — Google (AS15169) vs Cloudflare (AS13335)
 # ---------------------------------------------------------------------------
@@ -378,6 +665,245 @@ def test_bulk_risk_check_high_risk_present(client, api_key, mock_dependencies):
     assert result["score"] == ASN_9009_M247_HIGH_RISK["total_score"]
 
 
+def _bulk_pg_by_asn(mock_pg_conn, *rows):
+    """PG mock answering each `= ANY(:asns)` chunk with the matching rows."""
+    by_asn = {r["asn"]: r for r in rows}
+
+    def execute(query, params):
+        result = MagicMock()
+        result.mappings.return_value.fetchall.return_value = [
+            by_asn[a] for a in params["asns"] if a in by_asn
+        ]
+        return result
+
+    mock_pg_conn.execute = AsyncMock(side_effect=execute)
+
+
+def test_bulk_risk_check_stream_ndjson_in_chunks(client, api_key, mock_dependencies):
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    _bulk_pg_by_asn(mock_pg_conn, ASN_15169_GOOGLE, ASN_13335_CLOUDFLARE)
+    body = b'15169\n{"asn": 64512}\n\n13335\n15169'
+
+    with patch("api.main.settings.bulk_stream_chunk_size", 2):
+        response = client.post(
+            "/v1/tools/bulk-risk-check/stream",
+            headers={"X-API-Key": api_key, "Content-Type": "application/x-ndjson"},
+            content=body,
+        )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert response.headers["X-Total-ASNs"] == "4"
+    lines = [orjson.loads(line) for line in response.text.splitlines()]
+    assert [(r["asn"], r["score"], r["level"]) for r in lines] == [
+        (15169, 98, "LOW"),
+        (64512, None, "UNKNOWN"),
+        (13335, 97, "LOW"),
+        (15169, 98, "LOW"),
+    ]
+    chunks = [c.args[1]["asns"] for c in mock_pg_conn.execute.call_args_list]
+    assert chunks == [[15169, 64512], [13335, 15169]]
+
+
+def test_bulk_risk_check_stream_binary_uint32(client, api_key, mock_dependencies):
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    _bulk_pg_by_asn(mock_pg_conn, ASN_13335_CLOUDFLARE)
+
+    response = client.post(
+        "/v1/tools/bulk-risk-check/stream",
+        headers={"X-API-Key": api_key, "Content-Type": "application/octet-stream"},
+        content=struct.pack(">3I", 13335, 4294967295, 1),
+    )
+
+    assert response.status_code == 200
+    lines = [orjson.loads(line) for line in response.text.splitlines()]
+    assert [r["asn"] for r in lines] == [13335, 4294967295, 1]
+    assert lines[0]["name"] == "CLOUDFLARENET"
+
+
+@pytest.mark.parametrize(
+    "content_type, body, status",
+    [
+        ("application/x-ndjson", b"15169\nAS13335\n", 400),
+        ("application/x-ndjson", b"0\n", 400),
+        ("application/x-ndjson", b"true\n", 400),
+        ("application/x-ndjson", b"4294967296", 400),
+        ("application/octet-stream", b"\x00\x00\x3b\x41\x00", 400),
+        ("application/octet-stream", b"\x00\x00\x00\x00", 400),
+        ("application/x-ndjson", b"1\n2\n3\n4", 413),
+        ("application/x-ndjson", b"1\n" + b" " * 300 + b"2\n", 400),
+        ("application/x-ndjson", b" " * 300 + b"1", 400),
+    ],
+)
+def test_bulk_risk_check_stream_rejects_bad_bodies(
+    client, api_key, mock_dependencies, content_type, body, status
+):
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    with patch("api.main.settings.bulk_stream_max_asns", 3):
+        response = client.post(
+            "/v1/tools/bulk-risk-check/stream",
+            headers={"X-API-Key": api_key, "Content-Type": content_type},
+            content=body,
+        )
+    assert response.status_code == status
+    mock_pg_conn.execute.assert_not_called()
+
+
+def test_bulk_risk_check_stream_caps_unterminated_line(
+    client, api_key, mock_dependencies
+):
+    """A body with no newline is rejected once the partial line passes the
+    cap, not buffered until the stream ends."""
+    from api.main import BULK_STREAM_MAX_LINE
+
+    def body():
+        for _ in range(1000):
+            yield b" " * 100
+
+    response = client.post(
+        "/v1/tools/bulk-risk-check/stream",
+        headers={"X-API-Key": api_key, "Content-Type": "application/x-ndjson"},
+        content=body(),
+    )
+    assert response.status_code == 400
+    assert response.json()["error"] == f"Line 1 exceeds {BULK_STREAM_MAX_LINE} bytes"
+
+
+# ---------------------------------------------------------------------------
+# In-process score snapshot
+# ---------------------------------------------------------------------------
+
+_T0 = datetime(2024, 1, 15, 10, 30)
+
+
+def _snapshot_rows(*rows):
+    """(asn, name, cc, total, level, hygiene, threat, stability, last_scored_at)"""
+    result = MagicMock()
+    result.fetchall.return_value = list(rows)
+    return result
+
+
+def _loaded_snapshot(mock_pg_conn):
+    from api.main import ScoreSnapshot
+
+    snap = ScoreSnapshot()
+    mock_pg_conn.execute = AsyncMock(
+        return_value=_snapshot_rows(
+            (9009, "M247", "RO", 45, "HIGH", 70, 40, 80, _T0),
+            (13335, "CLOUDFLARENET", "US", 97, "LOW", 100, 97, 95, _T0),
+            (15169, "GOOGLE", "US", 98, "LOW", 100, 98, 96, _T0),
+            (64512, None, None, 100, "UNKNOWN", 100, 100, 100, None),
+        )
+    )
+    asyncio.run(snap.load())
+    mock_pg_conn.execute.reset_mock()
+    return snap
+
+
+def test_score_snapshot_load_and_lookup(mock_dependencies):
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    snap = _loaded_snapshot(mock_pg_conn)
+
+    assert len(snap) == 4
+    assert list(snap.asns) == [9009, 13335, 15169, 64512]
+    assert snap.get(9009) == {
+        "asn": 9009,
+        "name": "M247",
+        "country_code": "RO",
+        "total_score": 45,
+        "risk_level": "HIGH",
+        "hygiene_score": 70,
+        "threat_score": 40,
+        "stability_score": 80,
+    }
+    assert snap.get(1) is None
+    assert snap.at_most(50) == [9009]
+    assert snap.at_most(100) == [9009, 13335, 15169, 64512]
+    assert snap.watermark == _T0
+
+
+def test_score_snapshot_refresh_applies_watermark_rows(mock_dependencies):
+    from api.main import SNAPSHOT_WATERMARK_OVERLAP
+
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    snap = _loaded_snapshot(mock_pg_conn)
+    later = _T0 + timedelta(minutes=5)
+    mock_pg_conn.execute = AsyncMock(
+        return_value=_snapshot_rows(
+            (15169, "GOOGLE", "US", 60, "HIGH", 100, 60, 96, later),
+            (20000, "NEWNET", "DE", None, None, 100, 100, 100, later),
+        )
+    )
+
+    assert asyncio.run(snap.refresh()) == 2
+
+    query, params = mock_pg_conn.execute.call_args.args
+    assert "last_scored_at > :since" in str(query)
+    assert params == {"since": _T0 - SNAPSHOT_WATERMARK_OVERLAP}
+    assert snap.get(15169)["total_score"] == 60
+    assert snap.get(15169)["risk_level"] == "HIGH"
+    assert list(snap.asns) == [9009, 13335, 15169, 20000, 64512]
+    assert snap.get(20000)["total_score"] is None
+    assert snap.get(20000)["risk_level"] is None
+    assert snap.at_most(60) == [9009, 15169]
+    assert snap.watermark == later
+
+
+def test_score_snapshot_invalidated_asns_miss_until_refresh(mock_dependencies):
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    snap = _loaded_snapshot(mock_pg_conn)
+
+    snap.mark_stale([15169])
+    assert snap.get(15169) is None
+    assert snap.get(13335) is not None
+    assert snap.at_most(100) is None  # cannot answer for the whole registry
+
+    mock_pg_conn.execute = AsyncMock(return_value=_snapshot_rows())
+    asyncio.run(snap.refresh())
+    assert snap.get(15169)["total_score"] == 98
+    assert snap.at_most(50) == [9009]
+
+
+def test_evict_l1_marks_snapshot_stale(mock_dependencies):
+    from api.main import _evict_l1, ScoreSnapshot
+
+    snap = ScoreSnapshot()
+    with patch("api.main.score_snapshot", snap):
+        _evict_l1([15169, 3333])
+    assert set(snap._stale) == {15169, 3333}
+
+
+def test_bulk_and_compare_served_from_snapshot(client, api_key, mock_dependencies):
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    snap = _loaded_snapshot(mock_pg_conn)
+    _bulk_pg_by_asn(mock_pg_conn, ASN_3333_RIPE)
+
+    with patch("api.main.score_snapshot", snap):
+        bulk = client.post(
+            "/v1/tools/bulk-risk-check",
+            headers={"X-API-Key": api_key},
+            json={"asns": [15169, 3333, 9009]},
+        )
+        compare = client.get(
+            "/v1/tools/compare?asn_a=15169&asn_b=9009",
+            headers={"X-API-Key": api_key},
+        )
+        edl = client.get("/feeds/edl?max_score=55.5", headers={"X-API-Key": api_key})
+
+    assert bulk.status_code == 200
+    assert [(r["asn"], r["score"]) for r in bulk.json()["results"]] == [
+        (15169, 98),
+        (3333, ASN_3333_RIPE["total_score"]),
+        (9009, 45),
+    ]
+    # Only the snapshot miss went to Postgres
+    assert [c.args[1]["asns"] for c in mock_pg_conn.execute.call_args_list] == [[3333]]
+    assert compare.status_code == 200
+    assert compare.json()["comparison"]["safer_overall"] == 15169
+    assert edl.text == "AS9009"
+    assert mock_pg_conn.execute.call_count == 1
+
+
 # ---------------------------------------------------------------------------
 # EDL feed — M247 (HIGH risk, Spamhaus-listed) + generic blocked ASN
 # ---------------------------------------------------------------------------
@@ -395,6 +921,81 @@ def test_get_edl_feed(client, api_key, mock_dependencies):
     assert "AS666" in response.text
 
 
+def _materialized_edl(mock_redis, version, members):
+    mock_redis.get.side_effect = lambda key: (
+        str(version) if key == "edl:v1:50:version" else None
+    )
+    pipe = MagicMock()
+    pipe.execute = AsyncMock(return_value=[str(version), members])
+    mock_redis.pipeline = MagicMock(return_value=pipe)
+    return pipe
+
+
+def test_edl_feed_served_from_materialized_list(client, api_key, mock_dependencies):
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    _materialized_edl(mock_redis, 7, {"64500", "174", "3257"})
+
+    with patch.dict("api.main._edl_bodies", clear=True):
+        response = client.get("/feeds/edl", headers={"X-API-Key": api_key})
+        assert response.status_code == 200
+        assert response.text == "AS174\nAS3257\nAS64500"
+        assert response.headers["etag"] == 'W/"edl-50-7"'
+        assert response.headers["x-edl-version"] == "7"
+
+        # Same version again: in-process bytes, no Redis set read
+        mock_redis.pipeline.reset_mock()
+        response = client.get("/feeds/edl", headers={"X-API-Key": api_key})
+        assert response.text == "AS174\nAS3257\nAS64500"
+        mock_redis.pipeline.assert_not_called()
+    mock_pg_conn.execute.assert_not_called()
+
+
+def test_edl_feed_not_modified(client, api_key, mock_dependencies):
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    _materialized_edl(mock_redis, 7, {"174"})
+
+    response = client.get(
+        "/feeds/edl",
+        headers={"X-API-Key": api_key, "If-None-Match": 'W/"edl-50-7"'},
+    )
+    assert response.status_code == 304
+    mock_redis.pipeline.assert_not_called()
+
+
+def test_edl_feed_since_returns_net_changes(client, api_key, mock_dependencies):
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    pipe = _materialized_edl(mock_redis, 7, set())
+    pipe.execute = AsyncMock(
+        return_value=[
+            "7",
+            [("5:+1", 5.0)],
+            ["6:+10", "6:-20", "6:+40", "7:-10", "7:+30", "7:+40"],
+        ]
+    )
+    mock_redis.smismember = AsyncMock(return_value=[0, 0, 1, 1])
+
+    response = client.get("/feeds/edl?since=5", headers={"X-API-Key": api_key})
+    assert response.status_code == 200
+    # AS10 was added and removed again within the window: no net change. The
+    # repeated +AS40 still yields a single addition.
+    assert response.text == "-AS20\n+AS30\n+AS40"
+    assert response.headers["x-edl-version"] == "7"
+    pipe.zrangebyscore.assert_called_once_with("edl:v1:50:log", 6, "+inf")
+    mock_redis.smismember.assert_awaited_once_with(
+        "edl:v1:50:asns", ["10", "20", "30", "40"]
+    )
+
+
+def test_edl_feed_since_beyond_log_is_gone(client, api_key, mock_dependencies):
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    pipe = _materialized_edl(mock_redis, 900, set())
+    pipe.execute = AsyncMock(return_value=["900", [("400:+1", 400.0)], []])
+
+    response = client.get("/feeds/edl?since=5", headers={"X-API-Key": api_key})
+    assert response.status_code == 410
+    assert response.headers["x-edl-version"] == "900"
+
+
 def test_edl_feed_requires_auth(client):
     """EDL must not dump the ASN inventory to anonymous callers (H2)."""
     response = client.get("/feeds/edl?max_score=100")
@@ -441,6 +1042,14 @@ def test_peeringdb_info(mock_client_cls, client, api_key, mock_dependencies):
 # Domain risk — google.com resolves to real Google IP space (AS15169)
 # ---------------------------------------------------------------------------
 
+def _dns_answer(*rdata, ttl=300):
+    """dnspython Answer stand-in: iterates `rdata`, carries rrset.ttl."""
+    answer = MagicMock()
+    answer.__iter__.return_value = list(rdata)
+    answer.rrset.ttl = ttl
+    return answer
+
+
 @patch("api.main.dns.asyncresolver.resolve", new_callable=AsyncMock)
 def test_domain_risk(mock_resolve, client, api_key, mock_dependencies):
     mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
@@ -451,7 +1060,7 @@ def test_domain_risk(mock_resolve, client, api_key, mock_dependencies):
     mock_txt = MagicMock()
     mock_txt.to_text.return_value = '"15169 | 142.250.185.0/24 | US | arin | 2012-04-23"'
 
-    mock_resolve.side_effect = [[mock_a], [mock_txt]]
+    mock_resolve.side_effect = [_dns_answer(mock_a), _dns_answer(mock_txt)]
     mock_pg_conn.execute.return_value.mappings.return_value.fetchone.return_value = ASN_15169_GOOGLE
 
     response = client.get(
@@ -474,7 +1083,7 @@ def test_domain_risk_private_ip_rejected(mock_resolve, client, api_key, mock_dep
 
     mock_a = MagicMock()
     mock_a.to_text.return_value = "192.168.1.1"
-    mock_resolve.return_value = [mock_a]
+    mock_resolve.return_value = _dns_answer(mock_a)
 
     response = client.get(
         "/v1/tools/domain-risk?domain=internal.local",
@@ -521,55 +1130,117 @@ def test_websocket_wrong_key_rejected(client):
             ws.receive_text()
 
 
+def _stream_pubsub(mock_redis, *events):
+    """Shared-subscriber pubsub that yields `events` then stays connected."""
+
+    async def _listen():
+        yield {"type": "subscribe", "data": 1}
+        for event in events:
+            yield {"type": "message", "data": event}
+        await asyncio.Event().wait()
+
+    mock_pubsub = AsyncMock()
+    mock_pubsub.listen = MagicMock(side_effect=lambda: _listen())
+    mock_redis.pubsub = MagicMock(return_value=mock_pubsub)
+    return mock_pubsub
+
+
 def test_websocket_stream_receives_message(client, api_key, mock_dependencies):
-    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    from api.main import stream_hub
 
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
     event_payload = '{"asn": 15169, "score": 98, "risk_level": "LOW"}'
-    message_sent = {"type": "message", "data": event_payload}
-    sentinel = {"type": "message", "data": None}
+    mock_pubsub = _stream_pubsub(mock_redis, event_payload)
 
-    async def _fake_listen():
-        yield message_sent
-        yield sentinel
+    with client.websocket_connect(f"/v1/stream?api_key={api_key}") as ws:
+        assert ws.receive_text() == event_payload
 
-    mock_pubsub = AsyncMock()
-    mock_pubsub.subscribe = AsyncMock()
-    mock_pubsub.unsubscribe = AsyncMock()
-    mock_pubsub.listen.return_value = _fake_listen()
-    mock_redis.pubsub.return_value = mock_pubsub
-
-    with patch("api.main.redis_client", mock_redis):
-        try:
-            with client.websocket_connect(f"/v1/stream?api_key={api_key}") as ws:
-                msg = ws.receive_text()
-                assert msg == event_payload
-        except Exception:
-            pass
+    mock_pubsub.subscribe.assert_awaited_once_with("events:asn_updates")
+    assert not stream_hub.clients
 
 
 def test_websocket_queue_overflow_disconnects_client(client, api_key, mock_dependencies):
-    """If pubsub floods faster than the client reads, the engine emits close(1008)."""
+    """If pubsub floods faster than the client reads, the server closes with 1008."""
+    from starlette.websockets import WebSocketDisconnect
+
     mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    _stream_pubsub(mock_redis, *(str(i) for i in range(101)))  # QUEUE_MAX + 1
 
-    OVERFLOW = 101  # one more than QUEUE_MAX=100
+    received = []
+    with client.websocket_connect(f"/v1/stream?api_key={api_key}") as ws:
+        with pytest.raises(WebSocketDisconnect) as exc:
+            while True:
+                received.append(ws.receive_text())
+    assert exc.value.code == 1008
+    assert received == [str(i) for i in range(100)]
 
-    async def _flood():
-        for i in range(OVERFLOW):
-            yield {"type": "message", "data": f"{i}"}
 
-    mock_pubsub = AsyncMock()
-    mock_pubsub.subscribe = AsyncMock()
-    mock_pubsub.unsubscribe = AsyncMock()
-    mock_pubsub.listen.return_value = _flood()
-    mock_redis.pubsub.return_value = mock_pubsub
+def test_websocket_stream_filters(client, api_key, mock_dependencies):
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    events = [
+        '{"asn": 13335, "risk_level": "HIGH", "previous_risk_level": "LOW"}',
+        '{"asn": 15169, "risk_level": "LOW", "previous_risk_level": "LOW"}',
+        "not json",
+        '{"asn": 15169, "risk_level": "HIGH", "previous_risk_level": "LOW"}',
+    ]
+    _stream_pubsub(mock_redis, *events)
+
+    url = f"/v1/stream?api_key={api_key}&asns=15169,3333&level_change=true"
+    with client.websocket_connect(url) as ws:
+        assert ws.receive_text() == events[3]
+
+
+def test_websocket_stream_rejects_bad_asn_filter(client, api_key, mock_dependencies):
+    from starlette.websockets import WebSocketDisconnect
+
+    for bad in ("abc", "0", ",".join(str(a) for a in range(1, 1002))):
+        with pytest.raises(WebSocketDisconnect) as exc:
+            with client.websocket_connect(
+                f"/v1/stream?api_key={api_key}&asns={bad}"
+            ) as ws:
+                ws.receive_text()
+        assert exc.value.code == 1008
+
+
+def test_stream_hub_shares_one_subscription(mock_dependencies):
+    from api.main import StreamHub
+
+    mock_redis = mock_dependencies[0]
+    mock_pubsub = _stream_pubsub(mock_redis, '{"asn": 1}', '{"asn": 2}')
+
+    async def run():
+        hub = StreamHub(queue_max=10)
+        everything = hub.join()
+        only_two = hub.join(frozenset({2}))
+        assert await asyncio.wait_for(everything.get(), 1) == '{"asn": 1}'
+        assert await asyncio.wait_for(everything.get(), 1) == '{"asn": 2}'
+        assert await asyncio.wait_for(only_two.get(), 1) == '{"asn": 2}'
+        task = hub._task
+        hub.leave(everything)
+        assert not task.cancelled()
+        hub.leave(only_two)
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return hub
+
+    hub = asyncio.run(run())
+    mock_redis.pubsub.assert_called_once()
+    mock_pubsub.aclose.assert_awaited()
 
-    with patch("api.main.redis_client", mock_redis):
-        try:
-            with client.websocket_connect(f"/v1/stream?api_key={api_key}") as ws:
-                while True:
-                    ws.receive_text()
-        except Exception:
-            pass  # WebSocketDisconnect expected
+    # The stopped loop's task is not reused by a client on a new loop
+    async def rejoin():
+        hub._task = asyncio.get_running_loop().create_future()
+        return hub._task
+
+    stale = asyncio.run(rejoin())
+
+    async def again():
+        queue = hub.join()
+        assert hub._task is not stale
+        assert await asyncio.wait_for(queue.get(), 1) == '{"asn": 1}'
+        hub.leave(queue)
+
+    asyncio.run(again())
 
 
 # ---------------------------------------------------------------------------
@@ -620,13 +1291,117 @@ def test_get_asn_score_redis_cache_hit(client, api_key, mock_dependencies):
         },
         "details": [],
     }
-    mock_redis.get.return_value = orjson.dumps(cached_payload)
+    mock_redis.get.return_value = _cache_entry(cached_payload)
 
     response = client.get("/v1/asn/15169", headers={"X-API-Key": api_key})
     assert response.status_code == 200
     data = response.json()
     assert data["asn"] == 15169
     assert data["risk_level"] == "LOW"
+    assert response.headers["X-Cache-Tier"] == "L2"
+
+
+def test_get_asn_score_cache_hit_serves_stored_bytes(client, api_key, mock_dependencies):
+    """A hit returns the cached body and ETag verbatim — no decode/validate."""
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    mock_redis.get.return_value = b'1e12 W/"cafe" {"asn":15169,"opaque":true}'
+
+    with patch("api.main.RiskScoreResponse.model_validate", side_effect=AssertionError):
+        response = client.get("/v1/asn/15169", headers={"X-API-Key": api_key})
+    assert response.status_code == 200
+    assert response.content == b'{"asn":15169,"opaque":true}'
+    assert response.headers["ETag"] == 'W/"cafe"'
+    assert response.headers["content-type"] == "application/json"
+
+    response = client.get(
+        "/v1/asn/15169", headers={"X-API-Key": api_key, "if-none-match": 'W/"cafe"'}
+    )
+    assert response.status_code == 304
+
+
+def _stale_score_card(client, api_key):
+    """A real AS15169 card from one fill, aged to an older score of 90."""
+    from api.main import l1_cache
+
+    card = client.get("/v1/asn/15169", headers={"X-API-Key": api_key}).json()
+    l1_cache.clear()
+    return {**card, "risk_score": 90, "last_updated": "2024-01-01 00:00:00"}
+
+
+def test_get_asn_score_serves_stale_l2_and_revalidates(client, api_key, mock_dependencies):
+    """Past the soft expiry: answer from the stale entry, refresh in the background."""
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    mock_redis.hgetall.return_value = {"50": "1"}
+    mock_pg_conn.execute.return_value.mappings.return_value.fetchone.return_value = ASN_15169_GOOGLE
+    stale = _stale_score_card(client, api_key)
+    mock_redis.get.side_effect = lambda key: (
+        "gen-1" if key.startswith("score:gen:") else _cache_entry(stale, soft_in=-5)
+    )
+    mock_redis.eval.reset_mock()
+
+    response = client.get("/v1/asn/15169", headers={"X-API-Key": api_key})
+    assert response.status_code == 200
+    assert response.headers["X-Cache-Tier"] == "L2-STALE"
+    assert response.headers["Cache-Control"] == "public, max-age=0"
+    assert response.json()["risk_score"] == 90
+
+    # the background fill rewrote the cache with the fresh score
+    from api.main import CACHE_WRITE_SCRIPT
+
+    writes = [
+        c.args for c in mock_redis.eval.await_args_list if c.args[0] == CACHE_WRITE_SCRIPT
+    ]
+    assert len(writes) == 1
+    _script, _nkeys, key, gen_key, generation, ttl, value = writes[0]
+    assert (key, gen_key, generation) == ("score:v4:15169", "score:gen:15169", "gen-1")
+    from api.main import l1_cache, _decode_cache_entry
+
+    refreshed = _decode_cache_entry(value)
+    assert orjson.loads(refreshed["body"])["risk_score"] == ASN_15169_GOOGLE["total_score"]
+    assert refreshed["soft_expires"] > time.time()
+    assert l1_cache["score:v4:15169"]["body"] == refreshed["body"]
+
+
+def test_fill_not_cached_when_invalidated_meanwhile(client, api_key, mock_dependencies):
+    """A score write between the fill's Postgres read and its cache write
+    replaces score:gen; the refused write leaves neither L1 nor L2 behind."""
+    from api.main import l1_cache
+
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    mock_pg_conn.execute.return_value.mappings.return_value.fetchone.return_value = ASN_15169_GOOGLE
+    mock_redis.eval.return_value = 0  # generation changed
+
+    response = client.get("/v1/asn/15169", headers={"X-API-Key": api_key})
+    assert response.status_code == 200
+    assert response.json()["risk_score"] == ASN_15169_GOOGLE["total_score"]
+    assert "score:v4:15169" not in l1_cache
+
+
+def test_cache_write_script_checks_generation():
+    fakeredis = pytest.importorskip("fakeredis")
+    from api.main import CACHE_WRITE_SCRIPT
+
+    r = fakeredis.FakeRedis(decode_responses=True)
+    assert r.eval(CACHE_WRITE_SCRIPT, 2, "entry", "gen", "", 60, "v1") == 1
+    r.set("gen", "abc")  # invalidated after the fill started
+    assert r.eval(CACHE_WRITE_SCRIPT, 2, "entry", "gen", "", 60, "v2") == 0
+    assert r.eval(CACHE_WRITE_SCRIPT, 2, "entry", "gen", "abc", 60, "v3") == 1
+    assert r.get("entry") == "v3"
+    assert 0 < r.ttl("entry") <= 60
+
+
+def test_get_asn_score_serves_stale_l1_when_l2_gone(client, api_key, mock_dependencies):
+    from api.main import l1_cache, _decode_cache_entry
+
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    mock_redis.hgetall.return_value = {"50": "1"}
+    mock_pg_conn.execute.return_value.mappings.return_value.fetchone.return_value = ASN_15169_GOOGLE
+    stale = _stale_score_card(client, api_key)
+    l1_cache["score:v4:15169"] = _decode_cache_entry(_cache_entry(stale, soft_in=-5))
+
+    response = client.get("/v1/asn/15169", headers={"X-API-Key": api_key})
+    assert response.headers["X-Cache-Tier"] == "L1-STALE"
+    assert response.json()["risk_score"] == 90
 
 
 # ---------------------------------------------------------------------------
@@ -680,6 +1455,50 @@ def test_cache_invalidation_key_not_present(client, api_key, mock_dependencies):
     assert response.json()["invalidated"] is False
 
 
+def test_cache_invalidation_reaches_every_worker(client, api_key, mock_dependencies):
+    """Evicts this worker's L1 and publishes for the other workers' L1."""
+    from api.main import l1_cache, CACHE_INVALIDATION_CHANNEL
+
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    l1_cache["score:v4:15169"] = {"data": {}, "soft_expires": time.time() + 60}
+
+    client.delete("/v1/internal/cache/15169", headers={"X-API-Key": api_key})
+    assert "score:v4:15169" not in l1_cache
+    mock_redis.delete.assert_awaited_with("score:v4:15169")
+    mock_redis.publish.assert_awaited_once_with(CACHE_INVALIDATION_CHANNEL, b"[15169]")
+
+
+def test_l1_invalidation_listener_evicts_published_asns(mock_dependencies):
+    from api.main import _l1_invalidation_listener, l1_cache
+
+    mock_redis = mock_dependencies[0]
+    evicted = asyncio.Event()
+
+    async def _messages():
+        yield {"type": "subscribe", "data": 1}
+        for asn in (15169, 3333, 13335):
+            l1_cache[f"score:v4:{asn}"] = {"data": {}, "soft_expires": 0}
+        yield {"type": "message", "data": "not json"}  # ignored, keeps listening
+        yield {"type": "message", "data": "[15169, 13335]"}
+        evicted.set()
+        await asyncio.Event().wait()
+
+    mock_pubsub = AsyncMock()
+    mock_pubsub.listen = MagicMock(return_value=_messages())
+    mock_redis.pubsub = MagicMock(return_value=mock_pubsub)
+
+    async def run():
+        task = asyncio.create_task(_l1_invalidation_listener())
+        await asyncio.wait_for(evicted.wait(), 1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert list(l1_cache) == ["score:v4:3333"]
+    mock_pubsub.aclose.assert_awaited()
+
+
 # ---------------------------------------------------------------------------
 # Peer pressure — full upstreams data path (lines 987-1033)
 # ---------------------------------------------------------------------------
@@ -819,6 +1638,276 @@ def test_peeringdb_network_error_503(mock_client_cls, client, api_key, mock_depe
     assert response.status_code == 503
 
 
+# ---------------------------------------------------------------------------
+# Local IP -> ASN longest-prefix-match index and /v1/tools/ip-risk
+# ---------------------------------------------------------------------------
+
+ROUTES = [
+    ("142.250.0.0/15", 15169),
+    ("142.250.185.0/24", 15169),
+    ("142.250.186.0/24", 64500),  # more specific, different origin
+    ("1.1.1.0/24", 13335),
+    ("2001:4860::/32", 15169),
+    ("2001:4860:4802:32::/64", 64501),
+    ("0.0.0.0/0", 64666),  # default route: never indexed
+    ("2000::/3", 64667),  # too short: never indexed
+    ("bogus", 1),
+    ("10.0.0.0/40", 2),
+]
+
+
+def _ip_index():
+    from api.main import PrefixIndex
+
+    index = PrefixIndex()
+    index.load(ROUTES)
+    return index
+
+
+def test_prefix_index_longest_match():
+    index = _ip_index()
+    assert index.size == 6
+    assert index.lookup("142.250.185.46") == (15169, "142.250.185.0/24")
+    assert index.lookup("142.250.186.1") == (64500, "142.250.186.0/24")
+    assert index.lookup("142.251.1.1") == (15169, "142.250.0.0/15")
+    assert index.lookup("1.1.1.1") == (13335, "1.1.1.0/24")
+    assert index.lookup("2001:4860:4802:32::a") == (64501, "2001:4860:4802:32::/64")
+    assert index.lookup("2001:4860::8888") == (15169, "2001:4860::/32")
+    assert index.lookup("8.8.8.8") is None
+    assert index.lookup("2a00::1") is None
+
+
+def test_prefix_index_matches_ipaddress_reference():
+    from api.main import PrefixIndex
+
+    rng = random.Random(42)
+    routes = []
+    for asn in range(1, 400):
+        length = rng.randint(8, 28)
+        addr = ipaddress.IPv4Address(rng.getrandbits(32) & 0x3FFFFFFF)
+        routes.append((f"{addr}/{length}", asn))
+    index = PrefixIndex()
+    index.load(routes)
+    nets = {}
+    for prefix, asn in routes:  # later duplicates win, as in the index
+        nets[ipaddress.ip_network(prefix, strict=False)] = asn
+
+    for _ in range(2000):
+        ip = ipaddress.IPv4Address(rng.getrandbits(32) & 0x3FFFFFFF)
+        covering = [n for n in nets if ip in n]
+        expected = None
+        if covering:
+            best = max(covering, key=lambda n: n.prefixlen)
+            expected = (nets[best], str(best))
+        assert index.lookup(ip) == expected, ip
+
+
+def test_prefix_index_refresh_queries_routing_view(mock_dependencies):
+    from api.main import PrefixIndex, settings
+
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    mock_ch_execute.return_value = ROUTES
+    index = PrefixIndex()
+    asyncio.run(index.refresh())
+
+    query, params = mock_ch_execute.call_args.args
+    assert "argMax(asn, timestamp)" in query
+    assert params == {"hours": settings.ip_index_window_hours}
+    assert index.lookup("1.1.1.1") == (13335, "1.1.1.0/24")
+
+
+@patch("api.main.dns.asyncresolver.resolve", new_callable=AsyncMock)
+def test_domain_risk_uses_local_index(mock_resolve, client, api_key, mock_dependencies):
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    mock_a = MagicMock()
+    mock_a.to_text.return_value = "142.250.185.46"
+    mock_resolve.side_effect = [_dns_answer(mock_a)]  # no Cymru TXT lookup
+    mock_pg_conn.execute.return_value.mappings.return_value.fetchone.return_value = (
+        ASN_15169_GOOGLE
+    )
+
+    with patch("api.main.ip_index", _ip_index()):
+        response = client.get(
+            "/v1/tools/domain-risk?domain=google.com",
+            headers={"X-API-Key": api_key},
+        )
+
+    assert response.status_code == 200
+    assert response.json()["asn"] == 15169
+    assert mock_resolve.await_count == 1
+
+
+@patch("api.main.dns.asyncresolver.resolve", new_callable=AsyncMock)
+def test_ip_risk_batch(mock_resolve, client, api_key, mock_dependencies):
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    _bulk_pg_by_asn(mock_pg_conn, ASN_15169_GOOGLE, ASN_13335_CLOUDFLARE)
+    mock_txt = MagicMock()
+    mock_txt.to_text.return_value = '"3333 | 193.0.0.0/21 | NL | ripencc | 1993-09-01"'
+    mock_resolve.return_value = _dns_answer(mock_txt)
+
+    with patch("api.main.ip_index", _ip_index()):
+        response = client.post(
+            "/v1/tools/ip-risk",
+            headers={"X-API-Key": api_key},
+            json={
+                "ips": [
+                    "142.250.185.46",
+                    "1.1.1.1",
+                    "193.0.6.139",
+                    "10.1.2.3",
+                    "not-an-ip",
+                    "1.1.1.1",
+                ]
+            },
+        )
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["total"] == 6
+    r = body["results"]
+    assert (r[0]["asn"], r[0]["source"], r[0]["score"]) == (15169, "bgp", 98)
+    assert r[0]["prefix"] == "142.250.185.0/24"
+    assert (r[1]["asn"], r[1]["name"]) == (13335, "CLOUDFLARENET")
+    assert (r[2]["asn"], r[2]["source"], r[2]["prefix"]) == (
+        3333,
+        "cymru",
+        "193.0.0.0/21",
+    )
+    assert r[2]["level"] == "UNKNOWN"  # not in the registry
+    assert r[3] == {"ip": "10.1.2.3", "asn": None, "error": "Not a global IP address"}
+    assert r[4]["error"] == "Invalid IP address"
+    assert r[5] == r[1]
+    # Only the index miss went to Cymru; one registry query for every ASN
+    mock_resolve.assert_awaited_once_with("139.6.0.193.origin.asn.cymru.com", "TXT")
+    assert [c.args[1]["asns"] for c in mock_pg_conn.execute.call_args_list] == [
+        [3333, 13335, 15169]
+    ]
+
+
+@patch("api.main.dns.asyncresolver.resolve", new_callable=AsyncMock)
+def test_resolve_caches_answers_for_their_ttl(mock_resolve, mock_dependencies):
+    import dns.resolver
+    from api.main import _resolve, dns_cache
+
+    mock_a = MagicMock()
+    mock_a.to_text.return_value = "142.250.185.46"
+    mock_resolve.return_value = _dns_answer(mock_a, ttl=300)
+
+    assert asyncio.run(_resolve("google.com", "A")) == ["142.250.185.46"]
+    assert asyncio.run(_resolve("Google.com.", "A")) == ["142.250.185.46"]
+    assert mock_resolve.await_count == 1
+
+    # An expired answer is looked up again
+    expires, records, error = dns_cache[("google.com", "A")]
+    dns_cache[("google.com", "A")] = (time.monotonic() - 1, records, error)
+    asyncio.run(_resolve("google.com", "A"))
+    assert mock_resolve.await_count == 2
+
+    # NXDOMAIN is remembered; a timeout is not
+    mock_resolve.side_effect = dns.resolver.NXDOMAIN()
+    for _ in range(2):
+        with pytest.raises(dns.resolver.NXDOMAIN):
+            asyncio.run(_resolve("nx.invalid", "A"))
+    assert mock_resolve.await_count == 3
+    # ...and so is an empty answer, as itself rather than as NXDOMAIN
+    mock_resolve.side_effect = dns.resolver.NoAnswer()
+    for _ in range(2):
+        with pytest.raises(dns.resolver.NoAnswer):
+            asyncio.run(_resolve("google.com", "AAAA"))
+    assert mock_resolve.await_count == 4
+    mock_resolve.side_effect = dns.exception.Timeout()
+    for _ in range(2):
+        with pytest.raises(dns.exception.Timeout):
+            asyncio.run(_resolve("slow.example", "A"))
+    assert mock_resolve.await_count == 6
+
+
+@patch("api.main.dns.asyncresolver.resolve", new_callable=AsyncMock)
+def test_domain_risk_batch(mock_resolve, client, api_key, mock_dependencies):
+    import dns.resolver
+
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    _bulk_pg_by_asn(mock_pg_conn, ASN_15169_GOOGLE, ASN_13335_CLOUDFLARE)
+    records = {
+        "google.com": "142.250.185.46",
+        "www.google.com": "142.250.185.46",
+        "one.one.one.one": "1.1.1.1",
+        "internal.corp": "10.0.0.5",
+        "ripe.net": "193.0.6.139",
+        "139.6.0.193.origin.asn.cymru.com": (
+            '"3333 | 193.0.0.0/21 | NL | ripencc | 1993-09-01"'
+        ),
+    }
+
+    async def resolve(name, rdtype):
+        if name not in records:
+            raise dns.resolver.NXDOMAIN()
+        rdata = MagicMock()
+        rdata.to_text.return_value = records[name]
+        return _dns_answer(rdata)
+
+    mock_resolve.side_effect = resolve
+    domains = [
+        "google.com",
+        "one.one.one.one",
+        "internal.corp",
+        "nx.invalid",
+        "ripe.net",
+        "www.google.com",
+        "google.com",
+    ]
+
+    with patch("api.main.ip_index", _ip_index()):
+        response = client.post(
+            "/v1/tools/domain-risk",
+            headers={"X-API-Key": api_key},
+            json={"domains": domains},
+        )
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["total"] == 7
+    r = body["results"]
+    assert [x["domain"] for x in r] == domains
+    assert (r[0]["resolved_ip"], r[0]["asn"], r[0]["source"]) == (
+        "142.250.185.46",
+        15169,
+        "bgp",
+    )
+    assert (r[0]["score"], r[0]["prefix"]) == (98, "142.250.185.0/24")
+    assert (r[1]["asn"], r[1]["name"]) == (13335, "CLOUDFLARENET")
+    assert r[2] == {
+        "domain": "internal.corp",
+        "resolved_ip": "10.0.0.5",
+        "asn": None,
+        "error": "Domain resolves to a local or private IP",
+    }
+    assert r[3] == {"domain": "nx.invalid", "asn": None, "error": "Could not resolve domain"}
+    assert (r[4]["asn"], r[4]["source"], r[4]["level"]) == (3333, "cymru", "UNKNOWN")
+    assert r[5] == {**r[0], "domain": "www.google.com"}
+    assert r[6] == r[0]
+    # One A lookup per distinct domain, one Cymru lookup for the index miss,
+    # one registry query for every ASN
+    assert mock_resolve.await_count == 7
+    assert [c.args[1]["asns"] for c in mock_pg_conn.execute.call_args_list] == [
+        [3333, 13335, 15169]
+    ]
+
+
+@patch("api.main.dns.asyncresolver.resolve", new_callable=AsyncMock)
+def test_cymru_origin_ipv6_zone(mock_resolve, mock_dependencies):
+    from api.main import _cymru_origin
+
+    mock_txt = MagicMock()
+    mock_txt.to_text.return_value = '"15169 | 2001:4860::/32 | US | arin | 2005-03-14"'
+    mock_resolve.return_value = _dns_answer(mock_txt)
+
+    assert asyncio.run(_cymru_origin("2001:4860::1")) == (15169, "2001:4860::/32")
+    name = mock_resolve.call_args.args[0]
+    assert name.endswith(".origin6.asn.cymru.com")
+    assert name.startswith("1.0.0.0.")
+
+
 # ---------------------------------------------------------------------------
 # Domain risk — unresolvable Cymru TXT (line 1263)
 # ---------------------------------------------------------------------------
@@ -833,7 +1922,7 @@ def test_domain_risk_cymru_lookup_fails(mock_resolve, client, api_key, mock_depe
 
     import dns.exception as dns_exc
     mock_resolve.side_effect = [
-        [mock_a],               # A record succeeds
+        _dns_answer(mock_a),    # A record succeeds
         dns_exc.DNSException(), # TXT record fails
     ]
 
@@ -1098,7 +2187,7 @@ def test_get_asn_score_etag_304(client, api_key, mock_dependencies):
         },
         "details": [],
     }
-    mock_redis.get.return_value = orjson.dumps(payload)
+    mock_redis.get.return_value = _cache_entry(payload)
 
     # First call to discover the ETag
     r1 = client.get("/v1/asn/15169", headers={"X-API-Key": api_key})
@@ -1115,28 +2204,140 @@ def test_get_asn_score_etag_304(client, api_key, mock_dependencies):
 
 
 # ---------------------------------------------------------------------------
-# total_count cached in Redis (lines 670-671) + setex branch (684)
+# rank_percentile from the engine-maintained score histogram
 # ---------------------------------------------------------------------------
 
-def test_get_asn_score_with_total_count_cached(client, api_key, mock_dependencies):
-    """When redis has stats:asn_total_count cached the DB count query is skipped."""
+def test_get_asn_score_percentile_from_histogram(client, api_key, mock_dependencies):
+    """With the histogram in Redis the registry row is the only DB query."""
     mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
 
-    # redis.get is called twice: once for score cache, once for stats:asn_total_count
-    mock_redis.get.side_effect = [
-        None,      # score cache miss
-        "80000",   # total_count_cached hit (decode_responses=True → str)
-    ]
-
-    scalar_mock = MagicMock()
-    scalar_mock.scalar.return_value = 70_000  # c_lower only (no t_count query)
-    mock_pg_conn.execute.return_value = scalar_mock
+    # decode_responses=True → str fields/values; 98 of 100 ASNs score below 98
+    mock_redis.hgetall.return_value = {"40": "8", "97": "90", "98": "1", "100": "1"}
     mock_pg_conn.execute.return_value.mappings.return_value.fetchone.return_value = ASN_15169_GOOGLE
 
     response = client.get("/v1/asn/15169", headers={"X-API-Key": api_key})
     assert response.status_code == 200
+    assert response.json()["rank_percentile"] == 98.0
+    assert mock_pg_conn.execute.await_count == 1
+
+
+def test_get_asn_score_percentile_fallback_without_histogram(client, api_key, mock_dependencies):
+    """No histogram yet → range counts over scored registry rows."""
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+
+    row = MagicMock()
+    row.mappings.return_value.fetchone.return_value = ASN_15169_GOOGLE
+    total, lower = MagicMock(), MagicMock()
+    total.scalar.return_value = 80_000
+    lower.scalar.return_value = 70_000
+    mock_pg_conn.execute.side_effect = [row, total, lower]
+
+    response = client.get("/v1/asn/15169", headers={"X-API-Key": api_key})
+    assert response.status_code == 200
+    assert response.json()["rank_percentile"] == 87.5
+
+
+@pytest.mark.parametrize(
+    "histogram, score, expected",
+    [
+        ({"10": "1", "50": "2", "90": "1"}, 50, 25.0),
+        ({"10": "1", "50": "2", "90": "1"}, 0, 0.0),
+        ({"10": "1", "50": "2", "90": "1"}, 100, 100.0),
+        ({}, 50, None),
+        (None, 50, None),
+        ({"50": "0"}, 50, None),
+    ],
+)
+def test_percentile_from_histogram(histogram, score, expected):
+    from api.main import _percentile_from_histogram
+
+    assert _percentile_from_histogram(histogram, score) == expected
+
+
+# ---------------------------------------------------------------------------
+# Single-flight cache fills
+# ---------------------------------------------------------------------------
+
+def test_single_flight_coalesces_concurrent_fills():
+    from api.main import _single_flight, _inflight
+
+    calls = []
+
+    async def fill():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"asn": 15169}
+
+    async def burst():
+        return await asyncio.gather(*(_single_flight("k", fill) for _ in range(50)))
+
+    results = asyncio.run(burst())
+    assert len(calls) == 1
+    assert all(r == {"asn": 15169} for r in results)
+    assert "k" not in _inflight
+
+
+def test_single_flight_shares_the_fill_error():
+    from api.main import _single_flight
+
+    calls = []
+
+    async def fill():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("pg down")
+
+    async def burst():
+        return await asyncio.gather(
+            *(_single_flight("k", fill) for _ in range(5)), return_exceptions=True
+        )
+
+    results = asyncio.run(burst())
+    assert len(calls) == 1
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_get_asn_score_waits_for_other_process_fill(client, api_key, mock_dependencies):
+    """Another worker holds the fill lease → poll L2 instead of querying PG."""
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    mock_pg_conn.execute.return_value.mappings.return_value.fetchone.return_value = ASN_15169_GOOGLE
+    mock_redis.hgetall.return_value = {"50": "1"}
+
+    # Build a real payload once to serve as the other worker's cache write.
+    first = client.get("/v1/asn/15169", headers={"X-API-Key": api_key})
+    cached = _cache_entry(first.json())
+    from api.main import l1_cache
+
+    l1_cache.clear()
+    mock_pg_conn.execute.reset_mock()
+    mock_redis.set = AsyncMock(return_value=None)  # lease held elsewhere
+    mock_redis.exists = AsyncMock(return_value=1)
+    mock_redis.get = AsyncMock(side_effect=[None, None, cached])
+
+    with patch("api.main.SCORE_FILL_POLL_INTERVAL", 0):
+        response = client.get("/v1/asn/15169", headers={"X-API-Key": api_key})
+    assert response.status_code == 200
+    assert response.json() == first.json()
+    mock_pg_conn.execute.assert_not_called()
+
+
+def test_get_asn_score_fills_itself_when_lease_released(client, api_key, mock_dependencies):
+    """Lease gone without a cache write (e.g. the filler failed) → fill locally."""
+    mock_redis, mock_pg, mock_ch, mock_pg_conn, mock_ch_execute = mock_dependencies
+    mock_redis.set = AsyncMock(return_value=None)
+    mock_redis.exists = AsyncMock(return_value=0)
+    mock_redis.hgetall.return_value = {"50": "1"}
+    mock_pg_conn.execute.return_value.mappings.return_value.fetchone.return_value = ASN_15169_GOOGLE
+
+    with patch("api.main.SCORE_FILL_POLL_INTERVAL", 0):
+        response = client.get("/v1/asn/15169", headers={"X-API-Key": api_key})
+    assert response.status_code == 200
     assert response.json()["asn"] == 15169
+    mock_pg_conn.execute.assert_awaited_once()
+    from api.main import RELEASE_LOCK_SCRIPT
 
+    # never held the lease → nothing to release
+    assert all(c.args[0] != RELEASE_LOCK_SCRIPT for c in mock_redis.eval.await_args_list)
 
 # ---------------------------------------------------------------------------
 # Whitelist DB exception → 500  (lines 864-869)
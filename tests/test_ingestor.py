@@ -0,0 +1,510 @@
+# Copyright by Fabrizio Salmi (fabrizio.salmi@gmail.com)
+
+import sys
+import os
+import random
+import ipaddress
+import asyncio
+import threading
+import gzip
+import json
+from datetime import datetime
+import pytest
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../services/ingestor"))
+)
+
+import start_ingestion_stream as ingest  # noqa: E402
+from start_ingestion_stream import (  # noqa: E402
+    SCORE_ENQUEUE_SCRIPT,
+    SCORE_MIN_INTERVAL,
+    SCORE_PRIORITY_BAND,
+    SCORE_QUEUE_KEY,
+    SCORE_LAST_DISPATCH_KEY,
+    BGP_INSERT_QUERY,
+    BgpBatch,
+    DataIngestor,
+    NullClickHouse,
+    PrefixIntervals,
+    iter_ris_jsonl,
+    shard_collectors,
+    _prefix_bounds,
+)
+
+
+class MockIngestor(DataIngestor):
+    def __init__(self):
+        self.running = True
+
+
+def _queue_ingestor():
+    fakeredis = pytest.importorskip("fakeredis")
+    ingestor = MockIngestor()
+    ingestor.redis_client = fakeredis.FakeRedis(decode_responses=True)
+    ingestor._enqueue_scores = ingestor.redis_client.register_script(
+        SCORE_ENQUEUE_SCRIPT
+    )
+    return ingestor
+
+
+def _reference_overlap(route: str, threat_prefixes) -> bool:
+    """ipaddress-based reference for PrefixIntervals.overlaps()."""
+    net = ipaddress.ip_network(route, strict=False)
+    for p in threat_prefixes:
+        try:
+            other = ipaddress.ip_network(p, strict=False)
+        except ValueError:
+            continue
+        if other.version == net.version and net.overlaps(other):
+            return True
+    return False
+
+
+def _random_prefix(rng: random.Random, version: int) -> str:
+    if version == 4:
+        # Keep everything inside 10/8 so random blocks actually collide.
+        addr = ipaddress.IPv4Address((10 << 24) | rng.getrandbits(24))
+        return f"{addr}/{rng.randint(8, 32)}"
+    addr = ipaddress.IPv6Address((0x2001_0DB8 << 96) | rng.getrandbits(96))
+    return f"{addr}/{rng.randint(32, 128)}"
+
+
+def test_prefix_bounds_matches_ipaddress():
+    for prefix in (
+        "10.1.2.3/8",
+        "192.0.2.0/24",
+        "198.51.100.7",
+        "2001:db8::1/32",
+        "::/0",
+    ):
+        net = ipaddress.ip_network(prefix, strict=False)
+        assert _prefix_bounds(prefix) == (
+            net.version,
+            int(net.network_address),
+            int(net.broadcast_address),
+        )
+
+
+@pytest.mark.parametrize(
+    "bad", ["", "bogus", "10.0.0.0/33", "10.0.0.0/x", "2001:db8::/129", "300.0.0.1/8"]
+)
+def test_prefix_bounds_rejects_malformed(bad):
+    with pytest.raises((ValueError, OSError)):
+        _prefix_bounds(bad)
+
+
+def test_prefix_intervals_matches_ipaddress_reference():
+    rng = random.Random(1337)
+    for version in (4, 6):
+        threats = [_random_prefix(rng, version) for _ in range(60)]
+        intervals = PrefixIntervals(threats + ["garbage", "10.0.0.0/40"])
+        for _ in range(500):
+            route = _random_prefix(rng, version)
+            assert intervals.overlaps(*_prefix_bounds(route)) == _reference_overlap(
+                route, threats
+            ), route
+
+
+def test_prefix_intervals_merges_adjacent_blocks_per_family():
+    intervals = PrefixIntervals(
+        ["10.0.0.0/25", "10.0.0.128/25", "10.0.0.64/26", "2001:db8::/32"]
+    )
+    assert len(intervals) == 2
+    assert intervals.overlaps(*_prefix_bounds("10.0.0.0/24"))
+    assert not intervals.overlaps(*_prefix_bounds("10.0.1.0/24"))
+    # Same integers, other family: no match.
+    assert not intervals.overlaps(6, *_prefix_bounds("10.0.0.0/24")[1:])
+
+
+def test_correlate_threats_matches_reference():
+    rng = random.Random(7)
+    threat_prefixes = {_random_prefix(rng, 4) for _ in range(40)}
+    threat_prefixes |= {_random_prefix(rng, 6) for _ in range(40)}
+    threat_prefixes |= {"not-a-prefix", "10.0.0.0/99"}
+    routes = [(_random_prefix(rng, rng.choice((4, 6))), i) for i in range(400)]
+
+    events = DataIngestor._correlate_threats(routes, threat_prefixes, set())
+
+    expected = [
+        asn
+        for route, asn in routes
+        if route in threat_prefixes or _reference_overlap(route, threat_prefixes)
+    ]
+    assert [e["asn"] for e in events] == expected
+    assert expected  # the seed must produce some matches
+
+
+def test_correlate_threats_source_precedence():
+    threat_prefixes = {"192.0.2.0/24", "198.51.100.0/22"}
+    threat_ips = {"192.0.2.0", "198.51.100.0", "203.0.113.0", "2001:db8::"}
+    routes = [
+        ("192.0.2.0/24", 1),  # exact DROP entry and a CINS address
+        ("198.51.100.0/24", 2),  # CINS network address inside a DROP block
+        ("198.51.101.0/24", 3),  # overlap only
+        ("203.0.113.0/24", 4),  # CINS only
+        ("2001:db8::/48", 5),  # IPv6 CINS network address
+        ("2001:db9::/32", 6),  # no match
+    ]
+
+    events = DataIngestor._correlate_threats(routes, threat_prefixes, threat_ips)
+
+    assert [(e["asn"], e["source"], e["category"]) for e in events] == [
+        (1, "Spamhaus (Exact)", "spamhaus"),
+        (2, "CINS/URLHaus (NetAddr Match)", "malware"),
+        (3, "Spamhaus (Overlap)", "spamhaus"),
+        (4, "CINS/URLHaus (NetAddr Match)", "malware"),
+        (5, "CINS/URLHaus (NetAddr Match)", "malware"),
+    ]
+    assert events[2]["target_ip"] == "198.51.101.0/24"
+
+
+def test_correlate_threats_skips_malformed_routes():
+    routes = [("bogus", 1), ("10.0.0.0/33", 2), ("", 3), ("10.0.0.0/8", 4)]
+    events = DataIngestor._correlate_threats(routes, {"10.1.0.0/16", "junk"}, set())
+    assert [e["asn"] for e in events] == [4]
+
+
+RIS_MESSAGE = {
+    "timestamp": 1700000000.5,
+    "path": [3356, [64512, 64513], 174, 13335],
+    "communities": [[3356, 100], 42, "junk", [1]],
+    "announcements": [
+        {"next_hop": "192.0.2.1", "prefixes": ["1.1.1.0/24", "1.0.0.0/24"]},
+        {"next_hop": "2001:db8::1", "prefixes": ["2606:4700::/32"]},
+    ],
+}
+
+
+def test_parse_ripe_message_builds_columnar_rows():
+    batch = BgpBatch()
+    stamp = datetime(2023, 11, 14, 22, 13, 20)
+
+    assert MockIngestor()._parse_ripe_message(RIS_MESSAGE, batch, stamp) == 3
+
+    ts, asn, prefix, event_type, upstream, path, community = batch.columns
+    assert len(batch) == 3
+    assert ts == [stamp] * 3
+    assert asn == [13335] * 3
+    assert prefix == ["1.1.1.0/24", "1.0.0.0/24", "2606:4700::/32"]
+    assert event_type == ["announce"] * 3
+    assert upstream == [174] * 3
+    # AS_SETs are dropped from the stored path; communities are packed.
+    assert path[0] == [3356, 174, 13335]
+    assert community[0] == [3356 * 65536 + 100, 42]
+    # One path/community object per message, shared by all of its rows.
+    assert path[0] is path[1] is path[2]
+    assert community[0] is community[2]
+
+
+def test_parse_ripe_message_skips_unusable_messages():
+    ingestor = MockIngestor()
+    batch = BgpBatch()
+    for msg in (
+        {},
+        {"path": [], "announcements": [{"prefixes": ["10.0.0.0/8"]}]},
+        {"path": [64500]},
+        {"path": [64500], "announcements": []},
+        {"path": [64500, [64501, 64502]], "announcements": [{"prefixes": ["x"]}]},
+        {"path": ["AS64500"], "announcements": [{"prefixes": ["10.0.0.0/8"]}]},
+    ):
+        assert ingestor._parse_ripe_message(msg, batch) == 0
+    assert len(batch) == 0
+
+
+def test_bgp_batch_due_thresholds():
+    with patch.object(ingest.time, "monotonic", return_value=100.0):
+        batch = BgpBatch()
+    row = (datetime(2024, 1, 1), 1, "10.0.0.0/8", "announce", 0, [1], [])
+
+    with patch.object(ingest.time, "monotonic", return_value=500.0):
+        assert not batch.due(2, 1.0)  # empty batches are never due
+    batch.append(*row)
+    with patch.object(ingest.time, "monotonic", return_value=100.5):
+        assert not batch.due(2, 1.0)
+        batch.append(*row)
+        assert batch.due(2, 1.0)  # row threshold
+        assert not batch.due(3, 1.0)
+    with patch.object(ingest.time, "monotonic", return_value=101.0):
+        assert batch.due(3, 1.0)  # age threshold
+
+
+def test_flush_bgp_batch_inserts_columnar():
+    ingestor = MockIngestor()
+    ingestor.ch_client = MagicMock()
+    ingestor._ch_lock = threading.Lock()
+    batch = BgpBatch()
+    ingestor._parse_ripe_message(RIS_MESSAGE, batch)
+
+    assert asyncio.run(ingestor._flush_bgp_batch(batch, "rrc21"))
+    query, cols = ingestor.ch_client.execute.call_args.args
+    assert query == BGP_INSERT_QUERY
+    assert ingestor.ch_client.execute.call_args.kwargs == {"columnar": True}
+    assert cols == list(batch.columns)
+
+    ingestor.ch_client.execute.side_effect = RuntimeError("ch down")
+    assert not asyncio.run(ingestor._flush_bgp_batch(batch, "rrc21"))
+    ingestor.ch_client.execute.reset_mock(side_effect=True)
+    assert asyncio.run(ingestor._flush_bgp_batch(BgpBatch(), "rrc21"))
+    ingestor.ch_client.execute.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "collectors, workers, shards",
+    [
+        (["rrc00", "rrc01", "rrc21"], 0, [["rrc00"], ["rrc01"], ["rrc21"]]),
+        (["rrc00", "rrc01", "rrc21"], 3, [["rrc00"], ["rrc01"], ["rrc21"]]),
+        (["rrc00", "rrc01", "rrc21"], 8, [["rrc00"], ["rrc01"], ["rrc21"]]),
+        (
+            ["rrc00", "rrc01", "rrc03", "rrc21", "rrc25"],
+            2,
+            [["rrc00", "rrc03", "rrc25"], ["rrc01", "rrc21"]],
+        ),
+        (["rrc00", "rrc01"], 1, [["rrc00", "rrc01"]]),
+        ([], 0, []),
+    ],
+)
+def test_shard_collectors_round_robin(collectors, workers, shards):
+    assert shard_collectors(collectors, workers) == shards
+
+
+def test_supervise_ris_workers_restarts_dead_workers():
+    ingestor = MockIngestor()
+    started = []
+
+    def make_process(target, args, name, daemon):
+        proc = MagicMock(name=name)
+        proc.is_alive.return_value = True
+        proc.exitcode = None
+        started.append((args[0], proc))
+        return proc
+
+    ctx = MagicMock()
+    ctx.Process.side_effect = make_process
+    ticks = []
+
+    async def fake_sleep(_seconds):
+        ticks.append(_seconds)
+        if len(ticks) == 1:
+            started[0][1].is_alive.return_value = False  # rrc00 worker died
+            started[0][1].exitcode = 1
+        else:
+            ingestor.running = False
+
+    with (
+        patch.object(ingest, "RIS_COLLECTORS", ["rrc00", "rrc01", "rrc21"]),
+        patch.object(ingest, "RIS_WORKERS", 2),
+        patch.object(ingest.multiprocessing, "get_context", return_value=ctx),
+        patch.object(ingest.asyncio, "sleep", fake_sleep),
+    ):
+        asyncio.run(ingestor.supervise_ris_workers())
+
+    assert [shard for shard, _ in started] == [
+        ["rrc00", "rrc21"],
+        ["rrc01"],
+        ["rrc00", "rrc21"],
+    ]
+    for _, proc in started:
+        proc.start.assert_called_once_with()
+    # Workers still registered at shutdown are terminated; the dead one is not.
+    started[0][1].terminate.assert_not_called()
+    started[1][1].terminate.assert_called_once_with()
+    started[2][1].terminate.assert_called_once_with()
+
+
+def _write_recording(path, messages, opener=open):
+    lines = []
+    for i, msg in enumerate(messages):
+        # Alternate full websocket frames and bare payloads.
+        lines.append(json.dumps({"type": "ris_message", "data": msg} if i % 2 else msg))
+    lines[1:1] = [
+        "",
+        "not json",
+        json.dumps({"type": "ris_error", "data": {"message": "bad"}}),
+        json.dumps([1, 2, 3]),
+    ]
+    with opener(path, "wt") as fh:
+        fh.write("\n".join(lines) + "\n")
+
+
+def _recorded_messages(n):
+    return [
+        {
+            "timestamp": 1700000000 + i,
+            "path": [3356, 64500 + i],
+            "announcements": [
+                {"prefixes": [f"10.{i}.0.0/16", f"10.{i}.1.0/24"][: 1 + i % 2]}
+            ],
+        }
+        for i in range(n)
+    ]
+
+
+@pytest.mark.parametrize("suffix, opener", [(".jsonl", open), (".jsonl.gz", gzip.open)])
+def test_iter_ris_jsonl_reads_frames_and_bare_payloads(tmp_path, suffix, opener):
+    messages = _recorded_messages(4)
+    path = str(tmp_path / f"rrc21{suffix}")
+    _write_recording(path, messages, opener)
+    assert list(iter_ris_jsonl(path)) == messages
+
+
+def test_null_clickhouse_counts_rows():
+    ch = NullClickHouse()
+    assert ch.execute("SELECT 1") == []
+    ch.execute(BGP_INSERT_QUERY, [[1, 2, 3], [4, 5, 6]], columnar=True)
+    ch.execute("INSERT INTO threat_events VALUES", [{"asn": 1}, {"asn": 2}])
+    assert ch.rows == 5
+
+
+def test_replay_reports_stats(tmp_path):
+    path = str(tmp_path / "rrc21.jsonl")
+    _write_recording(path, _recorded_messages(5))
+    ingestor = MockIngestor()
+    ingestor.ch_client = NullClickHouse()
+    ingestor._ch_lock = threading.Lock()
+
+    with patch.object(ingest, "BGP_BATCH_SIZE", 3):
+        stats = asyncio.run(ingestor.replay(path))
+
+    # 5 messages -> 1+2+1+2+1 rows, flushed at 3 and 6, then the remaining 1.
+    assert stats["messages"] == 5
+    assert stats["events"] == 7
+    assert stats["flushes"] == 3
+    assert stats["flush_errors"] == 0
+    assert ingestor.ch_client.rows == 7
+    for key in ("seconds", "messages_per_s", "events_per_s", "flush_ms_p50"):
+        assert stats[key] >= 0
+    assert stats["flush_ms_p50"] <= stats["flush_ms_p95"] <= stats["flush_ms_max"]
+
+
+def test_replay_keeps_recorded_timestamps(tmp_path):
+    path = str(tmp_path / "rrc21.jsonl")
+    _write_recording(path, _recorded_messages(2))
+    ingestor = MockIngestor()
+    batches = []
+
+    async def capture(batch, label):
+        batches.append((list(batch.columns[0]), label))
+        return True
+
+    ingestor._flush_bgp_batch = capture
+    asyncio.run(ingestor.replay(path))
+
+    assert batches == [
+        (
+            [
+                datetime.fromtimestamp(1700000000),
+                datetime.fromtimestamp(1700000001),
+                datetime.fromtimestamp(1700000001),
+            ],
+            f"replay:{path}",
+        )
+    ]
+
+
+def test_main_replay_dry_run_discards_inserts(tmp_path):
+    path = str(tmp_path / "rrc21.jsonl.gz")
+    _write_recording(path, _recorded_messages(4), gzip.open)
+    created = []
+
+    class ReplayIngestor(MockIngestor):
+        def __init__(self):
+            super().__init__()
+            self.ch_client = MagicMock()
+            self._ch_lock = threading.Lock()
+            created.append(self)
+
+    with patch.object(ingest, "DataIngestor", ReplayIngestor):
+        ingest.main(["replay", path, "--dry-run"])
+
+    (ingestor,) = created
+    assert isinstance(ingestor.ch_client, NullClickHouse)
+    assert ingestor.ch_client.rows == 6
+
+
+NOW = 1_700_000_000
+
+
+def test_request_scores_coalesces_duplicates():
+    ingestor = _queue_ingestor()
+    with patch.object(ingest.time, "time", return_value=NOW):
+        assert ingestor.request_scores([1, 2, 2, "1"], "churn") == 2
+        assert ingestor.request_scores([2, 3], "churn") == 1
+        assert ingestor.request_scores([], "threat") == 0
+    r = ingestor.redis_client
+    assert r.zrange(SCORE_QUEUE_KEY, 0, -1, withscores=True) == [
+        ("1", 2 * SCORE_PRIORITY_BAND + NOW),
+        ("2", 2 * SCORE_PRIORITY_BAND + NOW),
+        ("3", 2 * SCORE_PRIORITY_BAND + NOW),
+    ]
+
+
+def test_request_scores_promotes_but_never_demotes():
+    ingestor = _queue_ingestor()
+    r = ingestor.redis_client
+    with patch.object(ingest.time, "time", return_value=NOW):
+        ingestor.request_scores([7], "churn")
+        ingestor.request_scores([7], "threat")
+        assert r.zscore(SCORE_QUEUE_KEY, "7") == NOW
+        ingestor.request_scores([7], "leak")
+        ingestor.request_scores([7], "churn")
+    assert r.zscore(SCORE_QUEUE_KEY, "7") == NOW
+    assert r.zcard(SCORE_QUEUE_KEY) == 1
+
+
+def test_request_scores_respects_min_interval():
+    ingestor = _queue_ingestor()
+    r = ingestor.redis_client
+    r.hset(SCORE_LAST_DISPATCH_KEY, mapping={"5": NOW - 10, "6": NOW - 10_000})
+    with patch.object(ingest.time, "time", return_value=NOW):
+        ingestor.request_scores([5, 6], "leak")
+    band = 1 * SCORE_PRIORITY_BAND
+    assert r.zscore(SCORE_QUEUE_KEY, "5") == band + NOW - 10 + SCORE_MIN_INTERVAL
+    assert r.zscore(SCORE_QUEUE_KEY, "6") == band + NOW
+
+
+def test_request_scores_swallows_redis_errors():
+    ingestor = MockIngestor()
+    ingestor._enqueue_scores = MagicMock(side_effect=ConnectionError("down"))
+    assert ingestor.request_scores([1], "threat") == 0
+
+
+def test_score_queue_due_ignores_entries_inside_min_interval():
+    ingestor = _queue_ingestor()
+    r = ingestor.redis_client
+    r.hset(SCORE_LAST_DISPATCH_KEY, mapping={"1": NOW, "2": NOW})
+    with patch.object(ingest.time, "time", return_value=NOW):
+        ingestor.request_scores([1], "threat")
+        ingestor.request_scores([2], "churn")
+    assert r.zcard(SCORE_QUEUE_KEY) == 2
+    assert not ingestor._score_queue_due(NOW)
+    assert ingestor._score_queue_due(NOW + SCORE_MIN_INTERVAL)
+    r.delete(SCORE_QUEUE_KEY)
+    with patch.object(ingest.time, "time", return_value=NOW):
+        ingestor.request_scores([3], "churn")
+    assert ingestor._score_queue_due(NOW)
+
+
+def test_dispatch_score_queue_triggers_drain_only_when_due():
+    ingestor = _queue_ingestor()
+    ingestor.celery_app = MagicMock()
+    r = ingestor.redis_client
+    r.hset(SCORE_LAST_DISPATCH_KEY, "1", NOW)
+    ticks = []
+
+    async def fake_sleep(_seconds):
+        ticks.append(_seconds)
+        if len(ticks) == 1:
+            ingestor.request_scores([2], "leak")
+        else:
+            ingestor.running = False
+
+    with (
+        patch.object(ingest.time, "time", return_value=NOW),
+        patch.object(ingest.asyncio, "sleep", fake_sleep),
+    ):
+        ingestor.request_scores([1], "threat")  # pending, not due
+        asyncio.run(ingestor.dispatch_score_queue())
+
+    ingestor.celery_app.send_task.assert_called_once_with("tasks.drain_score_queue")
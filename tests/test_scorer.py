@@ -2,8 +2,17 @@
 
 import sys
 import os
+import json
+import random
+import ipaddress
+import re
+import threading
 import pytest
-from unittest.mock import patch
+from collections import Counter
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy import text
 
 # Ensure engine path is available for scorer import
 sys.path.insert(
@@ -14,7 +23,7 @@ sys.path.insert(
 with patch("sqlalchemy.create_engine"), patch("clickhouse_driver.Client"), patch(
     "redis.Redis"
 ):
-    from scorer import RiskScorer
+    from scorer import RiskScorer, VrpIndex, VrpSnapshot, load_vrp_file
 
 
 class MockScorer(RiskScorer):
@@ -333,12 +342,47 @@ def test_shannon_entropy_generated_vs_real():
         (["1.0.0.0/8", "1.1.0.0/16"], 50),  # /16 is a more-specific of /8 → 1 of 2
         (["1.0.0.0/8", "1.1.0.0/16", "2.0.0.0/8"], 33),  # 1 of 3
         (["1.0.0.0/8", "bad", "1.1.0.0/16"], 50),  # malformed ignored → 1 of 2
+        (["1.1.0.0/16", "1.0.0.0/8"], 50),  # order-independent
+        (["1.0.0.0/8", "1.2.3.4/8"], 0),  # same network twice is not nested
+        (["1.0.0.0/16", "1.0.0.0/24", "1.0.1.0/24", "1.1.0.0/24"], 50),
+        (["::/0", "0.0.0.0/8"], 0),  # IPv4 is never inside an IPv6 prefix
+        (["2001:db8::/32", "2001:db8:1::/48", "10.0.0.0/8", "10.1.0.0/16"], 50),
     ],
 )
 def test_prefix_granularity(prefixes, expected):
     assert RiskScorer._prefix_granularity(prefixes) == expected
 
 
+def _granularity_pairwise(prefixes):
+    """The original O(n²) subnet_of definition, as an oracle."""
+    nets = [ipaddress.ip_network(p, strict=False) for p in prefixes]
+    covered = sum(
+        any(
+            a.version == b.version and a.prefixlen > b.prefixlen and a.subnet_of(b)
+            for b in nets
+        )
+        for a in nets
+    )
+    return round(100 * covered / len(nets))
+
+
+def test_prefix_granularity_matches_pairwise():
+    rng = random.Random(7)
+    for _ in range(50):
+        prefixes = []
+        for _ in range(rng.randint(1, 60)):
+            if rng.random() < 0.7:
+                plen = rng.randint(8, 24)
+                addr = rng.getrandbits(8) << 24 | rng.getrandbits(3) << 21
+                prefixes.append(f"{addr >> 24}.{addr >> 16 & 255}.0.0/{plen}")
+            else:
+                plen = rng.randint(29, 48)
+                prefixes.append(f"2001:db8:{rng.getrandbits(2):x}::/{plen}")
+        assert RiskScorer._prefix_granularity(prefixes) == _granularity_pairwise(
+            prefixes
+        )
+
+
 def test_rpki_percentages():
     assert RiskScorer._rpki_percentages([]) is None
     assert RiskScorer._rpki_percentages(["valid", "valid"]) == (0.0, 0.0)
@@ -353,3 +397,1035 @@ def test_rpki_percentages():
         25.0,
         50.0,
     )
+
+
+_VRPS = [
+    (13335, "1.1.1.0/24", 24),
+    (13335, "104.16.0.0/12", 20),
+    (64500, "104.16.0.0/12", 12),
+    (0, "192.0.2.0/24", 32),  # AS0: nothing may originate it
+    (15169, "2001:4860::/32", 48),
+]
+
+
+@pytest.mark.parametrize(
+    "asn,prefix,expected",
+    [
+        (13335, "1.1.1.0/24", "valid"),
+        (13335, "1.1.1.0/25", "invalid_length"),  # longer than maxLength
+        (64501, "1.1.1.0/24", "invalid_asn"),  # covered, wrong origin
+        (13335, "104.17.0.0/16", "valid"),  # covered by the /12, within /20
+        (64500, "104.17.0.0/16", "invalid_length"),
+        (13335, "104.17.1.0/24", "invalid_length"),
+        (0, "192.0.2.0/24", "invalid_asn"),  # AS0 never validates
+        (64500, "192.0.2.0/24", "invalid_asn"),
+        (64500, "8.8.8.0/24", "unknown"),  # not covered
+        (15169, "2001:4860:4860::/48", "valid"),
+        (15169, "2001:4860:4860::/64", "invalid_length"),
+        (15169, "2001:db8::/32", "unknown"),
+        (13335, "bad", "unknown"),
+    ],
+)
+def test_vrp_index_validate(asn, prefix, expected):
+    assert VrpIndex(_VRPS).validate(asn, prefix) == expected
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        # rpki-client JSON
+        '{"metadata": {}, "roas": [{"asn": 13335, "prefix": "1.1.1.0/24",'
+        ' "maxLength": 24, "ta": "apnic"}, {"asn": 64500, "prefix": "bad"}]}',
+        # Routinator JSON
+        '{"roas": [{"asn": "AS13335", "prefix": "1.1.1.0/24", "maxLength": 24,'
+        ' "ta": "apnic"}]}',
+        # Routinator / rpki-client CSV
+        "ASN,IP Prefix,Max Length,Trust Anchor\nAS13335,1.1.1.0/24,24,apnic\n"
+        "AS64500,10.0.0.0/8,x,arin\n",
+    ],
+)
+def test_load_vrp_file_formats(tmp_path, content):
+    path = tmp_path / "vrps"
+    path.write_text(content)
+    vrps = load_vrp_file(str(path))
+    assert (13335, "1.1.1.0/24", 24) in vrps
+    assert VrpIndex(vrps).validate(13335, "1.1.1.0/24") == "valid"
+
+
+def test_vrp_snapshot_reloads_on_change(tmp_path):
+    path = tmp_path / "vrps.csv"
+    assert VrpSnapshot("").current() is None
+    assert VrpSnapshot(str(path)).current() is None  # missing file
+
+    path.write_text("AS13335,1.1.1.0/24,24,apnic\n")
+    snapshot = VrpSnapshot(str(path))
+    assert snapshot.current().validate(13335, "1.1.1.0/24") == "valid"
+
+    path.write_text("AS64500,1.1.1.0/24,24,apnic\n")
+    os.utime(path, (0, 0))
+    assert snapshot.current().validate(13335, "1.1.1.0/24") == "invalid_asn"
+
+
+def test_derive_rpki_ripe_samples_the_busiest_given_prefixes():
+    """Without a VRP snapshot, both scoring paths hand over the originated
+    prefixes busiest first; RIPE Stat checks the first RPKI_MAX_PREFIXES."""
+    scorer = MockScorer()
+    scorer.vrp_snapshot = MagicMock(current=MagicMock(return_value=None))
+    scorer.redis_client = MagicMock()
+    scorer.redis_client.get.return_value = None
+    scorer.ch_client = MagicMock()
+    scorer._cb_lock = threading.Lock()
+    scorer._cb_state = {"failures": 0, "last_failure": 0, "open": False}
+    prefixes = [f"10.{i}.0.0/16" for i in range(12)]
+    response = MagicMock(status_code=200)
+    response.json.return_value = {"data": {"status": "valid"}}
+
+    with patch("scorer.http_requests.get", return_value=response) as get:
+        derived = scorer._derive_rpki(64500, prefixes)
+
+    checked = [c.kwargs["params"]["prefix"] for c in get.call_args_list]
+    assert checked == prefixes[: RiskScorer.RPKI_MAX_PREFIXES]
+    assert derived == {"rpki_invalid_percent": 0.0, "rpki_unknown_percent": 0.0}
+    scorer.ch_client.execute.assert_not_called()
+
+
+def test_derive_rpki_uses_vrp_snapshot_without_http():
+    scorer = MockScorer()
+    scorer.vrp_snapshot = MagicMock(current=MagicMock(return_value=VrpIndex(_VRPS)))
+    scorer.ch_client = MagicMock()
+    scorer.ch_client.execute.return_value = [
+        ("1.1.1.0/24", 50),
+        ("104.17.0.0/16", 9),
+        ("104.17.1.0/24", 3),
+        ("8.8.8.0/24", 1),
+    ]
+    with patch("scorer.http_requests.get") as get:
+        derived = scorer._derive_rpki(13335)
+    get.assert_not_called()
+    assert derived == {"rpki_invalid_percent": 25.0, "rpki_unknown_percent": 25.0}
+    # every originated prefix, not a LIMITed sample
+    assert "LIMIT" not in scorer.ch_client.execute.call_args[0][0]
+
+
+# ---------------------------------------------------------------------------
+# Batch scoring — calculate_scores() assembles the same inputs as the single
+# path from per-family GROUP BY results.
+# ---------------------------------------------------------------------------
+
+
+def _families(**over):
+    fam = {
+        "bgp": {},
+        "upstreams": {},
+        "downstreams": {},
+        "transit": {},
+        "prefixes": {},
+        "threats": {},
+        "threats_spam": {},
+        "withdrawals": {},
+        "prepends": {},
+    }
+    fam.update(over)
+    return fam
+
+
+def test_bgp_signals_shared_helper():
+    derived = RiskScorer._bgp_signals(
+        ["10.0.0.0/8", "10.1.0.0/16"], transit_hops=4, originated_30d=2, spam_flagged=1
+    )
+    assert derived == {
+        "has_bogon_ads": True,
+        "prefix_granularity_score": 50,
+        "is_stub_but_transit": True,
+        "spam_emission_rate": 0.5,
+    }
+
+
+def test_temporal_from_families():
+    fam = _families(
+        bgp={
+            64500: {
+                "upstream_churn_90d": 3,
+                "current_prefix_count": 0,
+                "ddos_blackhole_count": 6,
+                "originated_30d": 1,
+                # mean 34, CV ~1.37 → below the 1.5 oracle threshold
+                "daily_counts": [1, 1, 100],
+            }
+        },
+        upstreams={64500: [174, 64999]},  # 64999 unscored → ignored
+        downstreams={64500: [64501]},
+        threats={64500: {"spamhaus": {"ips": 1, "n": 4}, "malware": {"ips": 2, "n": 3}}},
+        withdrawals={64500: 150},
+        prepends={64500: 11},
+    )
+    registry = {174: ("COGENT", 40), 64501: ("DOWN", 60)}
+    t = MockScorer()._temporal_from_families(64500, fam, registry)
+    assert t["upstream_churn_90d"] == 3
+    assert t["recent_withdrawals"] == 150
+    assert t["recent_threat_count"] == 7
+    assert t["avg_upstream_score"] == 40
+    assert t["downstream_score"] == 60
+    assert t["zombie_status"] is True
+    assert t["ddos_blackhole_count"] == 6
+    assert t["excessive_prepending_count"] == 11
+    assert t["is_predictive_unstable"] is False
+
+
+def test_temporal_from_families_no_data_is_neutral():
+    t = MockScorer()._temporal_from_families(64500, _families(), {})
+    assert t["avg_upstream_score"] == 100.0
+    assert t["downstream_score"] == 100.0
+    assert t["recent_threat_count"] == 0
+    assert t["is_predictive_unstable"] is False
+
+
+def test_is_predictive_unstable():
+    assert RiskScorer._is_predictive_unstable(20, 40) is True
+    assert RiskScorer._is_predictive_unstable(20, 20) is False
+    assert RiskScorer._is_predictive_unstable(5, 50) is False  # too quiet
+
+
+def test_calculate_scores_batch():
+
+    scorer = MockScorer()
+    scorer._whitelisted = MagicMock(return_value={15169})
+    scorer._get_or_create_signals_batch = MagicMock(
+        return_value={64500: _base_signals(), 64501: _base_signals()}
+    )
+    scorer._fetch_metric_families = MagicMock(
+        return_value=_families(
+            bgp={64501: {"current_prefix_count": 3}},
+            threats={64500: {"spamhaus": {"ips": 1, "n": 1}}},
+        )
+    )
+    scorer._registry_rows = MagicMock(return_value={64500: ("Example", 100)})
+    scorer._submit_enrichment = MagicMock()
+    scorer._derive_rpki = MagicMock(return_value={})
+    scorer._persist_derived_signals_batch = MagicMock()
+    scorer._save_scores = MagicMock()
+    scorer._invalidate_caches = MagicMock()
+
+    scores = scorer.calculate_scores([64500, 15169, 0, 64501, 64500])
+
+    # 0 is invalid and dropped, duplicates collapsed, whitelisted forced to 100
+    assert set(scores) == {64500, 15169, 64501}
+    assert scores[15169] == 100
+    # spamhaus (-30) + zombie (-15)
+    assert scores[64500] == 55
+    assert scores[64501] == 100
+    scorer._fetch_metric_families.assert_called_once_with([64500, 64501])
+    scorer._submit_enrichment.assert_called_once_with([64501])  # name unknown
+    saved = scorer._save_scores.call_args[0][0]
+    assert [r[0] for r in saved] == [15169, 64500, 64501]
+    scorer._invalidate_caches.assert_called_once_with(
+        [15169, 64500, 64501], scorer._save_scores.return_value
+    )
+
+
+def test_calculate_scores_threat_family_failure_leaves_signals():
+
+    scorer = MockScorer()
+    scorer._whitelisted = MagicMock(return_value=set())
+    scorer._get_or_create_signals_batch = MagicMock(
+        return_value={64500: _base_signals(spamhaus_listed=True)}
+    )
+    scorer._fetch_metric_families = MagicMock(
+        return_value=_families(
+            bgp={64500: {"current_prefix_count": 1}}, threats=None
+        )
+    )
+    scorer._registry_rows = MagicMock(return_value={64500: ("Example", 100)})
+    scorer._submit_enrichment = MagicMock()
+    scorer._derive_rpki = MagicMock(return_value={})
+    scorer._persist_derived_signals_batch = MagicMock()
+    scorer._save_scores = MagicMock()
+    scorer._invalidate_caches = MagicMock()
+
+    # stored spamhaus_listed=True survives a failed threat query
+    assert scorer.calculate_scores([64500]) == {64500: 70}
+
+
+def test_calculate_scores_local_rpki_reuses_prefix_family():
+    """With a VRP snapshot the batch path validates fam["prefixes"] instead of
+    running one prefix query per ASN."""
+    scorer = MockScorer()
+    scorer.vrp_snapshot = MagicMock(current=MagicMock(return_value=VrpIndex(_VRPS)))
+    scorer.ch_client = MagicMock()
+    scorer._whitelisted = MagicMock(return_value=set())
+    scorer._get_or_create_signals_batch = MagicMock(
+        return_value={13335: _base_signals(), 64501: _base_signals()}
+    )
+    scorer._fetch_metric_families = MagicMock(
+        return_value=_families(
+            prefixes={13335: ["1.1.1.0/24", "104.17.0.0/16", "8.8.8.0/24"]}
+        )
+    )
+    scorer._registry_rows = MagicMock(return_value={})
+    scorer._submit_enrichment = MagicMock()
+    scorer._persist_derived_signals_batch = MagicMock()
+    scorer._save_scores = MagicMock()
+    scorer._invalidate_caches = MagicMock()
+
+    scorer.calculate_scores([13335, 64501])
+
+    scorer.ch_client.execute.assert_not_called()
+    derived = scorer._persist_derived_signals_batch.call_args[0][0]
+    assert derived[13335]["rpki_unknown_percent"] == pytest.approx(100 / 3, 0.01)
+    assert "rpki_invalid_percent" not in derived[64501]
+
+
+def test_calculate_score_fetches_prefixes_once():
+    """BGP signals and local RPKI validation share one originated-prefix query."""
+    scorer = MockScorer()
+    scorer.vrp_snapshot = MagicMock(current=MagicMock(return_value=VrpIndex(_VRPS)))
+    scorer._check_whitelist = MagicMock(return_value=False)
+    scorer._get_or_create_signals = MagicMock(return_value=_base_signals())
+    scorer._derive_signals_from_events = MagicMock(return_value={})
+    scorer._get_originated_prefixes = MagicMock(return_value=["1.1.1.0/24"])
+    scorer._whois_entropy = MagicMock(return_value=None)
+    scorer._ch_rows = MagicMock(return_value=None)
+    scorer._ch_scalar = MagicMock(return_value=0)
+    scorer._persist_derived_signals = MagicMock()
+    scorer._calculate_temporal_metrics = MagicMock(
+        return_value=MockScorer()._temporal_from_families(13335, _families(), {})
+    )
+    scorer._save_score = MagicMock()
+    scorer._invalidate_cache = MagicMock()
+
+    scorer.calculate_score(13335)
+
+    scorer._get_originated_prefixes.assert_called_once_with(13335, None)
+    derived = scorer._persist_derived_signals.call_args[0][1]
+    assert derived["rpki_invalid_percent"] == 0.0
+    assert derived["prefix_granularity_score"] == 0
+
+
+# ---------------------------------------------------------------------------
+# Single round-trip temporal metrics vs. the per-query implementation
+# ---------------------------------------------------------------------------
+
+_NOW = datetime(2024, 6, 1, 12, 0)
+_BLACKHOLE = 4294902426
+_TARGET = 64500
+
+
+def _ev(days_ago, asn, prefix, upstream_as, event_type="announce", community=()):
+    return {
+        "timestamp": _NOW - timedelta(days=days_ago),
+        "asn": asn,
+        "prefix": prefix,
+        "upstream_as": upstream_as,
+        "event_type": event_type,
+        "community": list(community),
+    }
+
+
+def _fixture_events():
+    ev = []
+    # Upstreams within 30d: 174 x5, 3356 x3, 1299 x2, 6939 x1 (no ties at the cut).
+    for n, up in ((5, 174), (3, 3356), (2, 1299), (1, 6939)):
+        ev += [_ev(3 + i, _TARGET, "203.0.113.0/24", up) for i in range(n)]
+    # Older upstreams only count towards 90-day churn; origin-only paths (0) too.
+    ev += [_ev(60, _TARGET, "198.51.100.0/24", 2914), _ev(1, _TARGET, "192.0.2.0/24", 0)]
+    ev.append(_ev(80, _TARGET, "198.51.100.0/24", 7018, event_type="withdraw"))
+    # Blackholes: two in the 7-day window, one outside it.
+    ev += [_ev(d, _TARGET, "203.0.113.7/32", 174, community=[_BLACKHOLE]) for d in (1, 2, 9)]
+    # Bursty 14-day profile for the oracle: 200 events on one day.
+    ev += [_ev(5, _TARGET, "203.0.113.0/24", 174) for _ in range(200)]
+    # Downstreams (we are their upstream) plus unrelated noise.
+    for n, down in ((4, 65001), (2, 65002), (1, 65003)):
+        ev += [_ev(2, down, "100.64.0.0/24", _TARGET) for _ in range(n)]
+    ev += [_ev(1, 65009, "100.65.0.0/24", 174), _ev(95, _TARGET, "10.0.0.0/8", 9999)]
+    return ev
+
+
+_ROLLUP_MERGE = re.compile(
+    r"(uniqMergeIf|countMergeIf)\((\w+), date (>=|>) today\(\) - (\d+)\)"
+)
+
+
+class _FakeClickHouse:
+    """Answers both the legacy per-metric queries and the single round-trip
+    query (raw scan + asn_signal_daily rollup + daily_metrics) from one
+    in-memory dataset, so the two implementations can be compared.
+
+    The rollup columns are evaluated from the merge windows parsed out of the
+    query text, so a changed window changes the answer. The other SQL of the
+    single query (filters, raw-scan windows) is asserted directly by
+    test_single_scan_query_windows_and_filters."""
+
+    def __init__(self, events, threats, withdrawals, prepends):
+        self.events = events
+        self.threats = threats
+        self.withdrawals = withdrawals
+        self.prepends = prepends
+        self.calls = 0
+
+    def _within(self, days, asn=None, upstream_as=None):
+        return [
+            e
+            for e in self.events
+            if e["timestamp"] > _NOW - timedelta(days=days)
+            and (asn is None or e["asn"] == asn)
+            and (upstream_as is None or e["upstream_as"] == upstream_as)
+        ]
+
+    @staticmethod
+    def _top(counter, k):
+        return [v for v, _ in counter.most_common(k)]
+
+    def _daily(self, asn):
+        return Counter(e["timestamp"].date() for e in self._within(14, asn=asn))
+
+    def _rollup(self, query, asn):
+        """Evaluate each `*MergeIf(column, date <op> today() - N)` of `query`
+        over the asn_signal_daily partials the fixture events would produce."""
+        values = []
+        for func, column, op, n in _ROLLUP_MERGE.findall(query):
+            days = int(n) + (op == ">=")
+            rows = [
+                e
+                for e in self.events
+                if e["asn"] == asn
+                and (_NOW.date() - e["timestamp"].date()).days < days
+            ]
+            announced = [e for e in rows if e["event_type"] == "announce"]
+            if column == "upstreams":
+                values.append(len({e["upstream_as"] for e in announced}))
+            elif column == "prefixes":
+                values.append(len({e["prefix"] for e in announced}))
+            elif column == "blackholes":
+                values.append(sum(_BLACKHOLE in e["community"] for e in rows))
+            else:
+                values.append(0)  # transit hops: not part of temporal metrics
+        assert values, "no rollup merges in the single query"
+        return tuple(values)
+
+    def execute(self, query, params):
+        self.calls += 1
+        q = " ".join(query.split())
+        a = params["asn"]
+        blackholes = sum(_BLACKHOLE in e["community"] for e in self._within(7, asn=a))
+        if "topKIf" in q:
+            daily = self._daily(a)
+            rollup = self._rollup(q, a)
+            return [
+                (
+                    self._top(Counter(e["upstream_as"] for e in self._within(30, asn=a) if e["upstream_as"]), params["ups"]),
+                    self._top(Counter(e["asn"] for e in self._within(30, upstream_as=a)), params["downs"]),
+                    rollup,
+                    [daily[d] for d in sorted(daily)],
+                    self.withdrawals,
+                    self.threats,
+                    self.prepends,
+                )
+            ]
+        if "uniq(upstream_as)" in q:
+            return [[len({e["upstream_as"] for e in self._within(90, asn=a) if e["event_type"] == "announce"})]]
+        if "withdraw_count" in q:
+            return [[self.withdrawals]]
+        if "uniq(prefix)" in q:
+            return [[len({e["prefix"] for e in self._within(2, asn=a)})]]
+        if "threat_events" in q:
+            return [[self.threats]]
+        if "prepends_count" in q:
+            return [[self.prepends]]
+        if "has(community" in q:
+            return [[blackholes]]
+        if "stddevPop" in q:
+            c = list(self._daily(a).values())
+            if not c:
+                return [(None, None)]
+            mean = sum(c) / len(c)
+            return [(mean, (sum((x - mean) ** 2 for x in c) / len(c)) ** 0.5)]
+        if "SELECT upstream_as, count(*)" in q:
+            top = Counter(e["upstream_as"] for e in self._within(30, asn=a) if e["upstream_as"])
+            return top.most_common(params["lim"])
+        if "WHERE upstream_as = %(asn)s" in q:
+            return Counter(e["asn"] for e in self._within(30, upstream_as=a)).most_common(params["lim"])
+        raise AssertionError(f"unexpected query: {q[:80]}")
+
+
+def _fake_pg(registry):
+    def execute(stmt, params):
+        rows = [(a, registry[a]) for a in params["asns"] if a in registry]
+        if str(stmt).startswith("SELECT total_score"):
+            rows = [(score,) for _, score in rows]
+        return MagicMock(fetchall=MagicMock(return_value=rows))
+
+    conn = MagicMock()
+    conn.execute.side_effect = execute
+    engine = MagicMock()
+    engine.connect.return_value.__enter__.return_value = conn
+    return engine
+
+
+class _LegacyTemporalScorer(MockScorer):
+    """The pre-consolidation implementation: one round-trip per metric."""
+
+    def _calculate_temporal_metrics(self, asn):
+        params = {"asn": asn}
+        q = self._ch_scalar
+        churn = q("SELECT uniq(upstream_as) FROM bgp_events WHERE asn = %(asn)s AND event_type = 'announce' AND timestamp > now() - INTERVAL 90 DAY", params)
+        withdrawals = q("SELECT sum(withdraw_count) FROM daily_metrics WHERE asn = %(asn)s AND date > now() - INTERVAL 7 DAY", params)
+        prefixes = q("SELECT uniq(prefix) FROM bgp_events WHERE asn = %(asn)s AND timestamp > now() - INTERVAL 2 DAY", params)
+        threats = q("SELECT count(*) FROM threat_events WHERE asn = %(asn)s AND timestamp > now() - INTERVAL 30 DAY", params)
+        upstreams = self.ch_client.execute("SELECT upstream_as, count(*) as c FROM bgp_events WHERE asn = %(asn)s AND upstream_as != 0 AND timestamp > now() - INTERVAL 30 DAY GROUP BY upstream_as ORDER BY c DESC LIMIT %(lim)s", {**params, "lim": self.UPSTREAM_SAMPLE})
+        avg_up = 100.0
+        if upstreams:
+            with self.pg_engine.connect() as conn:
+                res = conn.execute(text("SELECT total_score FROM asn_registry WHERE asn = ANY(:asns)"), {"asns": [u[0] for u in upstreams]}).fetchall()
+                avg_up = self._mean_score([r[0] for r in res])
+        oracle = self.ch_client.execute("SELECT avg(c) as u, stddevPop(c) as s FROM (SELECT toDate(timestamp) as d, count(*) as c FROM bgp_events WHERE asn = %(asn)s AND timestamp > now() - INTERVAL 14 DAY GROUP BY d)", params)
+        unstable = bool(oracle and oracle[0][0]) and self._is_predictive_unstable(oracle[0][0], oracle[0][1])
+        downs = self.ch_client.execute("SELECT asn, count(*) as c FROM bgp_events WHERE upstream_as = %(asn)s AND timestamp > now() - INTERVAL 30 DAY GROUP BY asn ORDER BY c DESC LIMIT %(lim)s", {**params, "lim": self.DOWNSTREAM_SAMPLE})
+        down_score = 100.0
+        if downs:
+            with self.pg_engine.connect() as conn:
+                res = conn.execute(text("SELECT total_score FROM asn_registry WHERE asn = ANY(:asns)"), {"asns": [d[0] for d in downs]}).fetchall()
+                down_score = self._mean_score([r[0] for r in res])
+        return {
+            "upstream_churn_90d": churn,
+            "recent_withdrawals": withdrawals,
+            "current_prefix_count": prefixes,
+            "recent_threat_count": threats,
+            "avg_upstream_score": avg_up,
+            "is_predictive_unstable": unstable,
+            "downstream_score": down_score,
+            "zombie_status": prefixes == 0,
+            "ddos_blackhole_count": q("SELECT count() FROM bgp_events WHERE asn = %(asn)s AND timestamp > now() - INTERVAL 7 DAY AND has(community, 4294902426)", params),
+            "excessive_prepending_count": q("SELECT sum(prepends_count) FROM forensic_metrics WHERE asn = %(asn)s AND date > now() - INTERVAL 7 DAY", params),
+        }
+
+
+def _temporal_pair(events, registry, asn=_TARGET, **rollups):
+    out = []
+    for cls in (_LegacyTemporalScorer, MockScorer):
+        scorer = cls()
+        scorer.ch_client = _FakeClickHouse(events, **{"threats": 0, "withdrawals": 0, "prepends": 0, **rollups})
+        scorer.pg_engine = _fake_pg(registry)
+        out.append((scorer._calculate_temporal_metrics(asn), scorer.ch_client.calls))
+    return out
+
+
+def _assert_matches_legacy(single, legacy):
+    """Equal, except that the rollup's prefix count covers whole calendar days
+    back to the day before yesterday: a superset of the legacy 48 hours."""
+    prefix_keys = ("current_prefix_count", "zombie_status")
+    assert {k: v for k, v in single.items() if k not in prefix_keys} == {
+        k: v for k, v in legacy.items() if k not in prefix_keys
+    }
+    assert single["current_prefix_count"] >= legacy["current_prefix_count"]
+    assert single["zombie_status"] <= legacy["zombie_status"]
+
+
+@pytest.mark.parametrize("asn", [_TARGET, 65001, 65009, 1])
+def test_single_scan_temporal_metrics_match_per_query(asn):
+    registry = {174: 40, 3356: 90, 6939: 10, 65001: 20, 65002: 60, 65003: 100}
+    (legacy, legacy_calls), (single, single_calls) = _temporal_pair(
+        _fixture_events(), registry, asn=asn, threats=7, withdrawals=12, prepends=3
+    )
+    _assert_matches_legacy(single, legacy)
+    assert single_calls == 1
+    assert legacy_calls == 9
+
+
+def test_single_scan_query_windows_and_filters():
+    """The parts of the single query the fake does not evaluate: the raw-scan
+    filter and windows, the side-table windows and the bound parameters."""
+    scorer = MockScorer()
+    scorer.ch_client = MagicMock()
+    scorer.ch_client.execute.return_value = [
+        ([], [], (0, 0, 0, 0, 0), [], 0, 0, 0)
+    ]
+    scorer._calculate_temporal_metrics(_TARGET)
+
+    scorer.ch_client.execute.assert_called_once()
+    query, params = scorer.ch_client.execute.call_args.args
+    q = " ".join(query.split())
+    assert params == {"asn": _TARGET, "ups": 3, "downs": 20}
+    assert q.endswith(
+        "FROM bgp_events WHERE (asn = %(asn)s OR upstream_as = %(asn)s) "
+        "AND timestamp > now() - INTERVAL 30 DAY"
+    )
+    assert "topKIf(%(ups)s)(upstream_as, asn = %(asn)s AND upstream_as != 0)" in q
+    assert "topKIf(%(downs)s)(asn, upstream_as = %(asn)s)" in q
+    assert "FROM asn_signal_daily WHERE asn = %(asn)s AND date > today() - 90" in q
+    assert (
+        "FROM daily_metrics WHERE asn = %(asn)s AND date > today() - 14 "
+        "GROUP BY date HAVING n > 0" in q
+    )
+    assert (
+        "sum(withdraw_count) FROM daily_metrics "
+        "WHERE asn = %(asn)s AND date > now() - INTERVAL 7 DAY" in q
+    )
+    assert (
+        "count() FROM threat_events "
+        "WHERE asn = %(asn)s AND timestamp > now() - INTERVAL 30 DAY" in q
+    )
+    assert (
+        "sum(prepends_count) FROM forensic_metrics "
+        "WHERE asn = %(asn)s AND date > now() - INTERVAL 7 DAY" in q
+    )
+
+
+def test_rollup_merge_windows():
+    """Windows merged from asn_signal_daily by both scoring paths, in the
+    order the callers unpack them."""
+    from scorer import RiskScorer
+
+    assert _ROLLUP_MERGE.findall(RiskScorer._ROLLUP_AGGREGATES) == [
+        ("uniqMergeIf", "upstreams", ">", "90"),
+        ("uniqMergeIf", "prefixes", ">=", "2"),  # superset of the last 48h
+        ("countMergeIf", "blackholes", ">", "7"),
+        ("uniqMergeIf", "prefixes", ">", "30"),
+        ("countMergeIf", "transit_hops", ">", "30"),
+    ]
+
+
+def test_single_scan_temporal_metrics_exercise_every_signal():
+    (legacy, _), (single, _) = _temporal_pair(
+        _fixture_events(), {174: 40, 3356: 90, 65001: 20, 65002: 60}
+    )
+    _assert_matches_legacy(single, legacy)
+    assert single["upstream_churn_90d"] == 6  # 174, 3356, 1299, 6939, 2914, 0
+    assert single["ddos_blackhole_count"] == 2
+    assert single["avg_upstream_score"] == 65.0  # 1299 unscored
+    assert single["downstream_score"] == 40.0
+    assert single["is_predictive_unstable"] is True
+
+
+@pytest.mark.parametrize("hours_ago", [1, 25, 47])
+def test_prefix_count_covers_the_last_48_hours(hours_ago):
+    """An ASN whose only announcement is under 48 hours old is not a zombie,
+    whatever the time of day (47h before noon is the day before yesterday)."""
+    events = [_ev(hours_ago / 24, _TARGET, "203.0.113.0/24", 174)]
+    (legacy, _), (single, _) = _temporal_pair(events, {})
+    assert legacy["current_prefix_count"] == single["current_prefix_count"] == 1
+    assert single["zombie_status"] is False
+
+
+def test_single_scan_temporal_metrics_no_data_is_neutral():
+    (legacy, _), (single, _) = _temporal_pair([], {})
+    assert single == legacy
+    assert single["zombie_status"] is True
+    assert single["avg_upstream_score"] == 100.0
+
+
+def test_fetch_metric_families_reads_rollups():
+    """bgp/transit come from asn_signal_daily, the oracle's daily counts from
+    daily_metrics; ASNs missing from the rollup still get their daily counts."""
+    canned = {
+        "asn_signal_daily": [(64500, 4, 2, 1, 3, 17), (64501, 1, 1, 0, 1, 0)],
+        "topK(%(ups)s)": [(64500, [174, 3356])],
+        "topK(%(downs)s)": [(174, [64500])],
+        "GROUP BY asn, prefix": [
+            (64500, "203.0.113.0/24", 9),
+            (64501, "192.0.2.0/24", 4),
+            (64500, "198.51.100.0/24", 2),
+        ],
+        "threat_events": [(64500, "spamhaus", 2, 5)],
+        "daily_metrics": [(64500, 12, [3, 40]), (64502, 0, [1])],
+        "forensic_metrics": [(64500, 6)],
+    }
+    scorer = MockScorer()
+    scorer._ch_rows = lambda q, p: next(v for k, v in canned.items() if k in q)
+    fam = scorer._fetch_metric_families([64500, 64501, 64502])
+
+    assert fam["bgp"][64500] == {
+        "upstream_churn_90d": 4,
+        "current_prefix_count": 2,
+        "ddos_blackhole_count": 1,
+        "originated_30d": 3,
+        "daily_counts": [3, 40],
+    }
+    assert fam["bgp"][64502] == {"daily_counts": [1]}
+    assert fam["transit"] == {64500: 17}
+    assert fam["prefixes"] == {
+        64500: ["203.0.113.0/24", "198.51.100.0/24"],
+        64501: ["192.0.2.0/24"],
+    }
+    assert fam["upstreams"] == {64500: [174, 3356]}
+    assert fam["downstreams"] == {174: [64500]}
+    assert fam["withdrawals"] == {64500: 12, 64502: 0}
+    assert fam["prepends"] == {64500: 6}
+    assert fam["threats_spam"] == {64500: 2}
+
+
+# ---------------------------------------------------------------------------
+# Score histogram (API rank_percentile) maintenance
+# ---------------------------------------------------------------------------
+
+
+def test_invalidate_caches_deletes_and_publishes():
+    scorer = MockScorer()
+    scorer.redis_client = MagicMock()
+    pipe = scorer.redis_client.pipeline.return_value
+
+    scorer._invalidate_caches([15169, 3333])
+
+    # fresh fill generations, so in-flight API fills cannot re-cache old cards
+    assert [c.args[0] for c in pipe.set.call_args_list] == [
+        "score:gen:15169",
+        "score:gen:3333",
+    ]
+    assert pipe.set.call_args_list[0].args[1] != pipe.set.call_args_list[1].args[1]
+    pipe.delete.assert_called_once_with("score:v4:15169", "score:v4:3333")
+    pipe.publish.assert_called_once_with("cache:invalidate", "[15169, 3333]")
+    pipe.execute.assert_called_once()
+
+
+def test_update_score_histogram_moves_buckets():
+    scorer = MockScorer()
+    scorer.redis_client = MagicMock()
+    scorer.redis_client.exists.return_value = 1
+    pipe = scorer.redis_client.pipeline.return_value
+    scorer._update_score_histogram(
+        # moved, unchanged, first score
+        [(1, True, 90, 70), (2, True, 80, 80), (3, False, 100, 55)]
+    )
+    calls = [c.args for c in pipe.hincrby.call_args_list]
+    assert calls == [
+        ("stats:score_histogram", 90, -1),
+        ("stats:score_histogram", 70, 1),
+        ("stats:score_histogram", 55, 1),
+    ]
+    pipe.execute.assert_called_once()
+
+
+def test_update_score_histogram_defers_rebuild_when_missing():
+    scorer = MockScorer()
+    scorer.redis_client = MagicMock()
+    scorer.redis_client.exists.return_value = 0
+    scorer.pg_engine = MagicMock()
+
+    assert scorer._update_score_histogram([(1, True, 90, 70)]) is False
+    scorer.redis_client.pipeline.assert_not_called()
+    scorer.pg_engine.connect.assert_not_called()
+
+
+def test_rebuild_score_histogram_swaps_in_registry_counts():
+    scorer = MockScorer()
+    scorer.redis_client = MagicMock()
+    scorer.pg_engine = _fake_pg({})
+    conn = scorer.pg_engine.connect.return_value.__enter__.return_value
+    conn.execute.side_effect = None
+    conn.execute.return_value.fetchall.return_value = [(40, 2), (100, 5)]
+    pipe = scorer.redis_client.pipeline.return_value
+
+    assert scorer.rebuild_score_histogram() == 7
+    pipe.delete.assert_called_once_with("stats:score_histogram")
+    pipe.hset.assert_called_once_with(
+        "stats:score_histogram", mapping={"40": 2, "100": 5}
+    )
+
+
+def test_update_edl_applies_only_threshold_crossings():
+    scorer = MockScorer()
+    scorer.redis_client = MagicMock()
+    scorer.redis_client.exists.return_value = 1
+    with patch("scorer.EDL_THRESHOLDS", (50, 89)):
+        scorer._update_edl(
+            [
+                (1, True, 90, 40),  # joins both lists
+                (2, True, 45, 60),  # leaves the 50 list only
+                (3, True, 70, 75),  # no crossing
+                (4, False, 100, 95),  # first score, still above both
+            ]
+        )
+    calls = [c.args for c in scorer.redis_client.eval.call_args_list]
+    assert [c[2:5] for c in calls] == [
+        ("edl:v1:50:asns", "edl:v1:50:version", "edl:v1:50:log"),
+        ("edl:v1:89:asns", "edl:v1:89:version", "edl:v1:89:log"),
+    ]
+    assert calls[0][6:] == ("+1", "-2")
+    assert calls[1][6:] == ("+1",)
+
+
+def test_edl_update_script_logs_only_real_changes():
+    """The log must only hold real membership flips (the API's ?since= diff
+    relies on it), a batch that changes nothing keeps the version, and only
+    the last EDL_LOG_VERSIONS versions are retained."""
+    fakeredis = pytest.importorskip("fakeredis")
+    from scorer import EDL_UPDATE_SCRIPT
+
+    r = fakeredis.FakeRedis(decode_responses=True)
+
+    def apply(*ops):
+        return r.eval(EDL_UPDATE_SCRIPT, 3, "s", "v", "log", 2, *ops)
+
+    assert apply() == 1  # first build of an empty list still gets a version
+    assert apply("+1", "+2") == 2
+    assert apply("+1") == 2  # already listed: no new version
+    assert apply("-3", "+1") == 2
+    assert apply("-1", "+5") == 3
+    assert r.smembers("s") == {"2", "5"}
+    assert r.zrange("log", 0, -1) == ["2:+1", "2:+2", "3:+5", "3:-1"]
+    assert apply("-2") == 4
+    assert r.zrange("log", 0, -1) == ["3:+5", "3:-1", "4:-2"]
+
+
+def test_rebuild_edl_applies_set_difference():
+    scorer = MockScorer()
+    scorer.redis_client = MagicMock()
+    scorer.redis_client.smembers.return_value = {"1", "2"}
+    scorer.redis_client.exists.return_value = 1
+    scorer.pg_engine = _fake_pg({})
+    conn = scorer.pg_engine.connect.return_value.__enter__.return_value
+    conn.execute.side_effect = None
+    conn.execute.return_value.fetchall.return_value = [(2,), (3,)]
+
+    with patch("scorer.EDL_THRESHOLDS", (50,)):
+        assert scorer.rebuild_edl() == 2
+    args = scorer.redis_client.eval.call_args.args
+    assert args[5:] == (1000, "+3", "-1")
+
+
+def test_save_scores_moves_from_locked_rows():
+    """Old scores come from a SELECT ... FOR UPDATE in the same transaction, and
+    the Redis updates run before the commit releases the row locks."""
+    scorer = MockScorer()
+    scorer.ch_client = MagicMock()
+    conn = MagicMock()
+    events = []
+
+    def execute(stmt, params):
+        sql = str(stmt)
+        if "FOR UPDATE" in sql:
+            events.append("lock")
+            rows = [
+                (1, True, 90, "LOW", 100, 90, 100),
+                (2, False, 100, "UNKNOWN", 100, 100, 100),
+            ]
+        elif "UPDATE asn_registry" in sql:
+            rows = [(1, 70), (2, 55)]
+        else:
+            rows = []
+        return MagicMock(fetchall=MagicMock(return_value=rows))
+
+    conn.execute.side_effect = execute
+    conn.commit.side_effect = lambda: events.append("commit")
+    scorer.pg_engine = MagicMock()
+    scorer.pg_engine.connect.return_value.__enter__.return_value = conn
+    scorer._update_score_histogram = MagicMock(
+        side_effect=lambda moves: events.append("histogram") or True
+    )
+    scorer._update_edl = MagicMock(
+        side_effect=lambda moves: events.append("edl") or True
+    )
+
+    breakdown = {"hygiene": 0, "threat": 0, "stability": 0}
+    scorer._save_scores(
+        [(1, 70, breakdown, "HIGH", None), (2, 55, breakdown, "HIGH", None)]
+    )
+
+    moves = [(1, True, 90, 70), (2, False, 100, 55)]
+    scorer._update_score_histogram.assert_called_once_with(moves)
+    scorer._update_edl.assert_called_once_with(moves)
+    assert events == ["lock", "histogram", "edl", "commit"]
+
+
+def test_save_scores_first_batch_builds_histogram_and_edl_after_commit():
+    """With an empty Redis the first batch must land in the histogram and the
+    EDLs: they are rebuilt from the registry only once the batch committed."""
+    fakeredis = pytest.importorskip("fakeredis")
+    scorer = MockScorer()
+    scorer.ch_client = MagicMock()
+    scorer.redis_client = fakeredis.FakeRedis(decode_responses=True)
+    committed = {1: None, 2: 80}  # asn -> total_score (None = never scored)
+    pending = {}
+    conn = MagicMock()
+
+    def execute(stmt, params=None):
+        sql = str(stmt)
+        if "FOR UPDATE" in sql:
+            rows = [
+                (a, committed[a] is not None, committed[a] or 100, "LOW", 100, 100, 100)
+                for a in params["asn"]
+            ]
+        elif "UPDATE asn_registry" in sql:
+            pending.update(zip(params["asn"], params["score"]))
+            rows = list(zip(params["asn"], params["score"]))
+        elif "GROUP BY total_score" in sql:
+            scores = [v for v in committed.values() if v is not None]
+            rows = [(v, scores.count(v)) for v in set(scores)]
+        elif "total_score <= :t" in sql:
+            rows = [
+                (a,) for a, v in committed.items() if v is not None and v <= params["t"]
+            ]
+        else:
+            rows = []
+        return MagicMock(fetchall=MagicMock(return_value=rows))
+
+    conn.execute.side_effect = execute
+    conn.commit.side_effect = lambda: committed.update(pending)
+    scorer.pg_engine = MagicMock()
+    scorer.pg_engine.connect.return_value.__enter__.return_value = conn
+
+    breakdown = {"hygiene": 0, "threat": 0, "stability": 0}
+    with patch("scorer.EDL_THRESHOLDS", (50,)):
+        scorer._save_scores(
+            [(1, 40, breakdown, "CRITICAL", None), (2, 85, breakdown, "MEDIUM", None)]
+        )
+
+    assert scorer.redis_client.hgetall("stats:score_histogram") == {"40": "1", "85": "1"}
+    assert scorer.redis_client.smembers("edl:v1:50:asns") == {"1"}
+    assert scorer.redis_client.get("edl:v1:50:version") == "1"
+
+
+def _save_scores_with(before, updated, results):
+    scorer = MockScorer()
+    scorer.ch_client = MagicMock()
+    scorer._update_score_histogram = MagicMock()
+    scorer._update_edl = MagicMock()
+    conn = MagicMock()
+
+    def execute(stmt, params):
+        sql = str(stmt)
+        if "FOR UPDATE" in sql:
+            rows = before
+        elif "UPDATE asn_registry" in sql:
+            rows = updated
+        else:
+            rows = []
+        return MagicMock(fetchall=MagicMock(return_value=rows))
+
+    conn.execute.side_effect = execute
+    scorer.pg_engine = MagicMock()
+    scorer.pg_engine.connect.return_value.__enter__.return_value = conn
+    return scorer._save_scores(results)
+
+
+def test_save_scores_returns_deltas_for_changed_asns_only():
+    events = _save_scores_with(
+        before=[
+            (1, True, 90, "LOW", 100, 90, 100),  # score and threat drop
+            (2, True, 80, "MEDIUM", 100, 80, 100),  # unchanged
+            (3, True, 70, "MEDIUM", 90, 80, 100),  # level-only change
+            (4, False, 100, "UNKNOWN", 100, 100, 100),  # first score
+        ],
+        # 5 is not registered: nothing was updated, nothing to announce
+        updated=[(1, 60), (2, 80), (3, 70), (4, 100)],
+        results=[
+            (1, 60, {"hygiene": 0, "threat": -40, "stability": 0}, "HIGH", None),
+            (2, 80, {"hygiene": 0, "threat": -20, "stability": 0}, "MEDIUM", None),
+            (3, 70, {"hygiene": -10, "threat": -20, "stability": 0}, "HIGH", None),
+            (4, 100, {"hygiene": 0, "threat": 0, "stability": 0}, "LOW", None),
+            (5, 40, {"hygiene": 0, "threat": -60, "stability": 0}, "CRITICAL", None),
+        ],
+    )
+
+    assert [
+        (e["asn"], e["score"], e["previous_score"], e["risk_level"]) for e in events
+    ] == [(1, 60, 90, "HIGH"), (3, 70, 70, "HIGH"), (4, 100, None, "LOW")]
+    assert events[0]["previous_risk_level"] == "LOW"
+    assert events[0]["changed"] == {"threat": [90, 60]}
+    assert events[1]["changed"] == {}
+    assert events[2]["previous_risk_level"] == "UNKNOWN"
+    assert events[0]["timestamp"].endswith("Z")
+
+
+def test_invalidate_caches_publishes_score_events_last():
+    scorer = MockScorer()
+    scorer.redis_client = MagicMock()
+    pipe = scorer.redis_client.pipeline.return_value
+    event = {"asn": 15169, "score": 60, "previous_score": 90}
+
+    scorer._invalidate_caches([15169], [event])
+
+    assert [c.args for c in pipe.publish.call_args_list] == [
+        ("cache:invalidate", "[15169]"),
+        ("events:asn_updates", json.dumps(event)),
+    ]
+    pipe.execute.assert_called_once()
+
+
+def _tasks_module():
+    with (
+        patch("sqlalchemy.create_engine"),
+        patch("clickhouse_driver.Client"),
+        patch("redis.Redis"),
+    ):
+        import tasks
+    return tasks
+
+
+def _score_queue(tasks, r, now):
+    """Seed score:pending the way the ingestor does: band * priority + due."""
+    band = tasks.SCORE_PRIORITY_BAND
+    r.zadd(
+        tasks.SCORE_QUEUE_KEY,
+        {
+            "30": 2 * band + now - 5,  # churn
+            "10": 0 * band + now,  # threat
+            "20": 1 * band + now - 100,  # leak
+            "11": 0 * band + now - 1,  # threat, older
+            "99": 0 * band + now + 60,  # threat, inside its min interval
+        },
+    )
+
+
+def test_score_pop_script_drains_bands_in_priority_order():
+    fakeredis = pytest.importorskip("fakeredis")
+    tasks = _tasks_module()
+    r = fakeredis.FakeRedis(decode_responses=True)
+    now = 1_700_000_000
+    _score_queue(tasks, r, now)
+    keys = [tasks.SCORE_QUEUE_KEY, tasks.SCORE_LAST_DISPATCH_KEY]
+    band = tasks.SCORE_PRIORITY_BAND
+
+    def pop(limit):
+        return r.eval(tasks.SCORE_POP_SCRIPT, 2, *keys, now, limit, band, 3)
+
+    assert pop(3) == ["11", "10", "20"]
+    assert pop(10) == ["30"]
+    assert pop(10) == []
+    assert r.zrange(tasks.SCORE_QUEUE_KEY, 0, -1) == ["99"]
+    assert r.hgetall(tasks.SCORE_LAST_DISPATCH_KEY) == {
+        a: str(now) for a in ("10", "11", "20", "30")
+    }
+
+
+def test_drain_score_queue_fans_out_batches():
+    fakeredis = pytest.importorskip("fakeredis")
+    tasks = _tasks_module()
+    r = fakeredis.FakeRedis(decode_responses=True)
+    now = 1_700_000_000
+    _score_queue(tasks, r, now)
+
+    with (
+        patch.object(
+            tasks, "_pop_due_scores", r.register_script(tasks.SCORE_POP_SCRIPT)
+        ),
+        patch.object(tasks.calculate_asn_scores, "delay") as delay,
+        patch.object(tasks.time, "time", return_value=now),
+        patch.object(tasks.settings, "score_batch_size", 2),
+        patch.object(tasks.settings, "score_drain_max_batches", 20),
+    ):
+        assert tasks.drain_score_queue() == 4
+
+    assert [c.args[0] for c in delay.call_args_list] == [[11, 10], [20, 30]]
+    assert r.zrange(tasks.SCORE_QUEUE_KEY, 0, -1) == ["99"]
+
+
+def test_drain_score_queue_stops_at_max_batches():
+    fakeredis = pytest.importorskip("fakeredis")
+    tasks = _tasks_module()
+    r = fakeredis.FakeRedis(decode_responses=True)
+    now = 1_700_000_000
+    _score_queue(tasks, r, now)
+
+    with (
+        patch.object(
+            tasks, "_pop_due_scores", r.register_script(tasks.SCORE_POP_SCRIPT)
+        ),
+        patch.object(tasks.calculate_asn_scores, "delay") as delay,
+        patch.object(tasks.time, "time", return_value=now),
+        patch.object(tasks.settings, "score_batch_size", 1),
+        patch.object(tasks.settings, "score_drain_max_batches", 2),
+    ):
+        assert tasks.drain_score_queue() == 2
+
+    assert [c.args[0] for c in delay.call_args_list] == [[11], [10]]
+    assert r.zcard(tasks.SCORE_QUEUE_KEY) == 3